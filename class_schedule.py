@@ -1,19 +1,136 @@
 import pandas as pd
+import numpy as np
 import os
 import re
 from math import ceil
 from openpyxl import load_workbook, Workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.comments import Comment
+from openpyxl.drawing.image import Image as SheetImage
 from openpyxl.styles import Alignment, Font, PatternFill
+from openpyxl.worksheet.hyperlink import Hyperlink
+from openpyxl.cell.cell import MergedCell
+from openpyxl.writer.excel import ExcelWriter
 import hashlib
-import tkinter as tk
-from tkinter import filedialog, messagebox
+from copy import copy, deepcopy
 import sys
 import tempfile
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import time
+import logging
+import contextlib
+import tracemalloc
+import csv
+import io
+import random
+import subprocess
+import zipfile
+import atexit
+import shutil
+import threading
+import multiprocessing
+import functools
+from urllib.parse import quote
+import xml.etree.ElementTree as ET
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, WINDOWS_EPOCH, from_excel, from_ISO8601
+from collections import Counter, OrderedDict, deque
+from bisect import bisect_left
+from datetime import date, datetime, timedelta, timezone
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:   # بدون inotify پوشه به صورت دوره‌ای بررسی می‌شود
+    INotify = None
+try:
+    import python_calamine  # noqa: F401  (موتور سریع‌تر pandas برای xlsx)
+    XLSX_ENGINE = 'calamine'
+except ImportError:
+    XLSX_ENGINE = 'openpyxl'
+
+# ==== گزارش اجرا ====
+# رویدادهای تکرارشونده (هر شیت، هر کاشی، ...) با log_event فقط شمرده می‌شوند و نمونه‌ای
+# محدود از آن‌ها چاپ می‌شود؛ log_summary در پایان هر مرحله جمع هر دسته را گزارش می‌کند.
+LOG = logging.getLogger('class_schedule')
+LOG_ENV = 'CLASS_SCHEDULE_LOG'   # quiet / verbose / json (پیش‌فرض سطح پیام‌ها برای هر دو رابط)
+LOG_RATE = 10      # حداکثر پیام هر دسته در هر ثانیه (0: بدون محدودیت)
+LOG_SAMPLE = 1     # از هر چند پیام یک دسته یکی چاپ شود
+LOG_SETTINGS = (None, LOG_RATE, LOG_SAMPLE)   # آخرین (mode, rate, sample) در configure_logging، برای پردازه‌های تبدیل
+
+_log_counts = Counter()
+
+class CategoryLimiter(logging.Filter):
+    """Pass every sample-th record of a category, at most rate per second; records without a category always pass"""
+
+    def __init__(self, rate=LOG_RATE, sample=LOG_SAMPLE):
+        super().__init__()
+        self.rate = rate
+        self.sample = max(1, sample)
+        self.seen = Counter()
+        self.windows = {}
+
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        if category is None:
+            return True
+        self.seen[category] += 1
+        if (self.seen[category] - 1) % self.sample:
+            return False
+        if self.rate:
+            second = int(time.monotonic())
+            window, passed = self.windows.get(category, (second, 0))
+            if window != second:
+                window, passed = second, 0
+            if passed >= self.rate:
+                return False
+            self.windows[category] = (window, passed + 1)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message and category / counts when present"""
+
+    def format(self, record):
+        data = {'time': self.formatTime(record), 'level': record.levelname, 'message': record.getMessage()}
+        for key in ('category', 'counts'):
+            if hasattr(record, key):
+                data[key] = getattr(record, key)
+        return json.dumps(data, ensure_ascii=False)
+
+def configure_logging(mode=None, rate=LOG_RATE, sample=LOG_SAMPLE):
+    """Console logging for both entry points
+
+    mode: 'quiet' (warnings and errors only), 'verbose' (every sampled event),
+    'json' (structured lines) or None for the LOG_ENV variable / plain INFO.
+    """
+    global LOG_SETTINGS
+    mode = mode or os.environ.get(LOG_ENV, '')
+    LOG_SETTINGS = (mode, rate, sample)
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if mode == 'json' else logging.Formatter('%(message)s'))
+    handler.addFilter(CategoryLimiter(rate, sample))
+    LOG.handlers[:] = [handler]
+    LOG.setLevel({'quiet': logging.WARNING, 'verbose': logging.DEBUG}.get(mode, logging.INFO))
+    LOG.propagate = False
+
+def log_event(category, message, *args, level=logging.DEBUG):
+    """Count one repetitive event and log it subject to the level, sampling and rate limit"""
+    _log_counts[category] += 1
+    if LOG.isEnabledFor(level):
+        LOG.log(level, message, *args, extra={'category': category})
+
+def log_summary(title):
+    """Log the event counters collected since the last summary and reset them"""
+    if _log_counts:
+        counts = dict(_log_counts)
+        _log_counts.clear()
+        LOG.info("%s: %s", title, "، ".join(f"{k}={v}" for k, v in counts.items()), extra={'counts': counts})
 
 def show_welcome_message():
     """Show welcome message before file selection"""
+    import tkinter as tk
+    from tkinter import messagebox
     root = tk.Tk()
     root.withdraw()
     
@@ -26,19 +143,24 @@ def show_welcome_message():
     messagebox.showinfo("خوش آمدید", welcome_text)
 
 def select_input_file():
-    """Open file dialog to select input CSV file"""
+    """Open file dialog to select the input export (CSV or XLSX)"""
+    import tkinter as tk
+    from tkinter import filedialog
     root = tk.Tk()
     root.withdraw()  # Hide the main window
     
     file_path = filedialog.askopenfilename(
-        title="لطفا فایل CSV را انتخاب کنید",
-        filetypes=[("CSV files", "*.csv"), ("All files", "*.*")]
+        title="لطفا فایل خروجی آموزشیار (CSV یا XLSX) را انتخاب کنید",
+        filetypes=[("Amozeshyar exports", "*.csv *.xlsx"), ("CSV files", "*.csv"), ("Excel files", "*.xlsx"),
+                   ("All files", "*.*")]
     )
     
     return file_path
 
 def select_output_file():
     """Open file dialog to select output Excel file location"""
+    import tkinter as tk
+    from tkinter import filedialog
     root = tk.Tk()
     root.withdraw()  # Hide the main window
     
@@ -50,528 +172,2699 @@ def select_output_file():
     
     return file_path
 
-def phase1_extract_data(input_file, temp_output_file):
-    """Phase 1: Extract important data from CSV and save to Excel"""
-    print("📖 در حال خواندن فایل CSV ...")
-    
-    try:
-        # ==== خواندن فایل ورودی ====
-        df = pd.read_csv(input_file, encoding='utf-8-sig')
-        print(f"✅ فایل خوانده شد. تعداد ردیف‌ها: {len(df)}")
-        
-        # ==== انتخاب ستون‌ها بر اساس شماره ====
-        selected_columns = {
-            'نام درس': 2,           # C
-            'کد ارائه درس': 0,      # A
-            'واحد نظری': 11,        # L
-            'واحد عملی': 12,        # M
-            'مکان': 22,             # W
-            'گروه آموزشی': 43,      # AR
-            'مقطع': 53,             # BB
-            'تعداد ثبت نامی': 57,   # BF
-            'نیم‌سال': 59,          # BH
-            'نام استاد': 68,        # BQ
-            'رشته': 70,             # BS
-            'روز': 72,              # BU
-            'ساعت شروع': 73,        # BV
-            'ساعت پایان': 74,       # BW
-            'تقويم كلاس درس': 71   # BT - اضافه شد
-        }
-        
-        # ==== استخراج فقط ستون‌های مورد نیاز ====
-        df_selected = df.iloc[:, list(selected_columns.values())].copy()
-        df_selected.columns = list(selected_columns.keys())
-        
-        # ==== پاکسازی و نرمال‌سازی ====
-        def normalize_text(s):
-            return (
-                str(s)
-                .replace('\u200c', '')   # حذف نیم‌فاصله
-                .replace('ي', 'ی')       # ی عربی → فارسی
-                .replace('ك', 'ک')       # ک عربی → فارسی
-                .replace('‌', '')        # حذف ZWNJ اضافی
-                .strip()
-            )
-        
-        df_selected = df_selected.fillna("").astype(str)
-        
-        # NEW: استخراج اطلاعات از ستون تقويم كلاس درس اگر ستون‌های روز و ساعت خالی باشند
-        def extract_from_calendar(calendar_text):
-            """استخراج روز، ساعت شروع و پایان از متن تقويم كلاس درس"""
-            if not calendar_text or calendar_text.strip() == "":
-                return "", "", ""
-            
-            text = str(calendar_text).strip()
-            # نرمال‌سازی متن قبل از پردازش
-            text = normalize_text(text)
-            
-            # جستجوی روز با الگوی دقیق
-            day = ""
-            
-            # استفاده از regex برای شناسایی تمام اشکال ممکن
-            patterns = [
-                (r'^شنبه', 'شنبه'),
-                (r'^یکشنبه', 'یکشنبه'),
-                (r'^دوشنبه', 'دوشنبه'),
-                (r'^سه[‌_\s]*شنبه', 'سه‌شنبه'),  # سه‌شنبه، سه_شنبه، سه شنبه، سهشنبه
-                (r'^چهار[‌_\s]*شنبه', 'چهارشنبه'),  # چهارشنبه، چهار_شنبه، چهار شنبه
-                (r'^پنج[‌_\s]*شنبه', 'پنج‌شنبه'),  # پنج‌شنبه، پنج_شنبه، پنج شنبه، پنجشنبه
-                (r'^جمعه', 'جمعه')
-            ]
-            
-            for pattern, day_name in patterns:
-                if re.match(pattern, text, re.UNICODE):
-                    day = day_name
-                    break
-            
-            # جستجوی ساعت‌ها با الگوی "ساعت تا ساعت"
-            time_pattern = r'(\d{1,2}[:\.]\d{2})\s*تا\s*(\d{1,2}[:\.]\d{2})'
-            time_match = re.search(time_pattern, text)
-            
-            start_time = ""
-            end_time = ""
-            
-            if time_match:
-                start_time = time_match.group(1).replace('.', ':')
-                end_time = time_match.group(2).replace('.', ':')
-            
-            return day, start_time, end_time
-        
-        # پردازش هر ردیف
-        for idx, row in df_selected.iterrows():
-            # اگر روز یا ساعت خالی باشد، از ستون تقويم كلاس درس استخراج کن
-            if (row['روز'].strip() == "" or 
-                row['ساعت شروع'].strip() == "" or 
-                row['ساعت پایان'].strip() == ""):
-                
-                calendar_text = row['تقويم كلاس درس']
-                day_from_cal, start_from_cal, end_from_cal = extract_from_calendar(calendar_text)
-                
-                if row['روز'].strip() == "" and day_from_cal:
-                    df_selected.at[idx, 'روز'] = day_from_cal
-                
-                if row['ساعت شروع'].strip() == "" and start_from_cal:
-                    df_selected.at[idx, 'ساعت شروع'] = start_from_cal
-                
-                if row['ساعت پایان'].strip() == "" and end_from_cal:
-                    df_selected.at[idx, 'ساعت پایان'] = end_from_cal
-        
-        # نرمال‌سازی روزها (همانند قبل)
-        df_selected['روز'] = df_selected['روز'].apply(normalize_text)
-        
-        # ==== نگاشت دقیق اسامی روزها ====
-        day_map = {
-            'شنبه': 'شنبه',
-            'یکشنبه': 'یکشنبه',
-            'يکشنبه': 'یکشنبه',
-            'يكشنبه': 'یکشنبه',
-            'یكشنبه': 'یکشنبه',
-            'دوشنبه': 'دوشنبه',
-            'سه شنبه': 'سه‌شنبه',
-            'سه‌شنبه': 'سه‌شنبه',
-            'سهشنبه': 'سه‌شنبه',  # اضافه شد
-            'چهارشنبه': 'چهارشنبه',
-            'چهار شنبه': 'چهارشنبه',
-            'پنجشنبه': 'پنج‌شنبه',
-            'پنج شنبه': 'پنج‌شنبه',
-            'پنج‌شنبه': 'پنج‌شنبه',
-            'پنچشنبه': 'پنج‌شنبه',      # حالت اشتباه تایپی احتمالی
-            'پنچ شنبه': 'پنج‌شنبه',
-            'جمعه': 'جمعه'
-        }
-        
-        # 🔹 نگاشت با تطبیق دقیق (نه جستجوی درون رشته)
-        df_selected['روز'] = df_selected['روز'].apply(
-            lambda x: day_map[x] if x in day_map else x
+# ==== ساختار خروجی آموزشیار ====
+# ستون‌های مورد نیاز بر اساس شماره
+SELECTED_COLUMNS = {
+    'نام درس': 2,           # C
+    'کد ارائه درس': 0,      # A
+    'واحد نظری': 11,        # L
+    'واحد عملی': 12,        # M
+    'مکان': 22,             # W
+    'گروه آموزشی': 43,      # AR
+    'مقطع': 53,             # BB
+    'تعداد ثبت نامی': 57,   # BF
+    'نیم‌سال': 59,          # BH
+    'نام استاد': 68,        # BQ
+    'رشته': 70,             # BS
+    'روز': 72,              # BU
+    'ساعت شروع': 73,        # BV
+    'ساعت پایان': 74,       # BW
+    'تقويم كلاس درس': 71   # BT
+}
+
+# نام‌های شناخته‌شده عنوان ستون هر فیلد (پس از نرمال‌سازی، تطبیق کامل و سپس جزئی)
+HEADER_ALIASES = {
+    'نام درس': ['نام درس', 'نام کلاس'],
+    'کد ارائه درس': ['کد ارائه', 'کد درس'],
+    'واحد نظری': ['واحد نظری', 'تعداد واحد'],
+    'واحد عملی': ['واحد عملی'],
+    'مکان': ['مکان'],
+    'گروه آموزشی': ['گروه'],
+    'مقطع': ['مقطع'],
+    'تعداد ثبت نامی': ['ثبت نام', 'ثبتنام'],
+    'نیم‌سال': ['نیمسال', 'ترم'],
+    'نام استاد': ['استاد', 'PR S_FNAME', 'نام کامل'],
+    'رشته': ['رشته'],
+    'روز': ['روز'],
+    'ساعت شروع': ['شروع'],
+    'ساعت پایان': ['پایان'],
+    'تقويم كلاس درس': ['تقویم']
+}
+
+# بدون این ستون‌ها ساخت جدول ممکن نیست
+REQUIRED_FIELDS = ['نام درس', 'مکان', 'روز', 'ساعت شروع', 'ساعت پایان']
+
+_layout_cache = {}
+
+# ==== تنظیمات جدول ====
+SLOT_MIN = 30   # minutes
+DAY_START_MIN = 8 * 60  # start at 08:00
+WEEKDAYS = ['شنبه', 'یکشنبه', 'دوشنبه', 'سه‌شنبه', 'چهارشنبه', 'پنج‌شنبه', 'جمعه']
+
+# ==== کدهای رد شدن ردیف‌ها (به ترتیب اولویت) ====
+REJECT_REASONS = {
+    'NO_DAY': 'روز نامشخص',
+    'DUPLICATE': 'ردیف تکراری',
+    'NO_TIME': 'ساعت شروع یا پایان خالی است',
+    'BAD_TIME': 'ساعت قابل خواندن نیست',
+    'INVERTED_TIME': 'ساعت پایان قبل از ساعت شروع است',
+    'OFF_GRID': 'کمتر از یک خانه کامل از جدول را پوشش می‌دهد'
+}
+
+DIGITS_TABLE = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+NORMALIZE_TABLE = str.maketrans({'\u200c': None, 'ي': 'ی', 'ك': 'ک'})   # نیم‌فاصله، ی و ک عربی
+TIME_RE = re.compile(r'^(?:(?P<hm>[0-9]{1,4})$|(?P<h>[0-9]+)\s*:(?:(?P<m>[0-9]+)(?=:|$))?)')
+
+# ==== نگاشت دقیق اسامی روزها (پس از normalize_text) ====
+DAY_MAP = {
+    'شنبه': 'شنبه',
+    'یکشنبه': 'یکشنبه',
+    'دوشنبه': 'دوشنبه',
+    'سه شنبه': 'سه‌شنبه',
+    'سهشنبه': 'سه‌شنبه',
+    'چهارشنبه': 'چهارشنبه',
+    'چهار شنبه': 'چهارشنبه',
+    'پنجشنبه': 'پنج‌شنبه',
+    'پنج شنبه': 'پنج‌شنبه',
+    'پنچشنبه': 'پنج‌شنبه',      # حالت اشتباه تایپی احتمالی
+    'پنچ شنبه': 'پنج‌شنبه',
+    'جمعه': 'جمعه'
+}
+UNKNOWN_DAY = 'نامشخص'
+
+# ==== جلسات ستون تقويم كلاس درس ====
+# هر جلسه: روز، ساعت شروع «تا» ساعت پایان و در صورت وجود هفته فرد/زوج (روی متن نرمال‌شده)
+WEEK_COL = 'هفته'
+WEEK_PARITIES = ('فرد', 'زوج')
+_DAY_ALT = r'یکشنبه|دوشنبه|سه[\s_]*شنبه|چهار[\s_]*شنبه|پنج[\s_]*شنبه|پنچ[\s_]*شنبه|شنبه|جمعه'
+_CLOCK = r'[0-9۰-۹]{1,2}[:.][0-9۰-۹]{2}'
+SESSION_RE = re.compile(
+    rf'(?P<day>{_DAY_ALT})[^0-9۰-۹،,؛;]{{0,20}}?'
+    rf'(?P<start>{_CLOCK})\s*تا\s*(?P<end>{_CLOCK})'
+    # فرد/زوج تا پیش از جداکننده یا روز جلسه بعد
+    rf'(?:(?:(?!{_DAY_ALT})[^،,؛;\n])*?(?P<parity>{"|".join(WEEK_PARITIES)}))?'
+)
+DAY_SPACE_RE = re.compile(r'[\s_]+')
+
+def normalize_days(days):
+    """Normalise and map the روز column once per distinct value into an ordered categorical
+
+    Weekdays are the first categories in week order; unrecognised values keep their
+    text and sort after them.
+    """
+    codes, uniques = pd.factorize(days.fillna("").astype(str))
+    mapped = [DAY_MAP.get(v, v) for v in (normalize_text(u) for u in uniques)]
+    categories = WEEKDAYS + sorted(set(mapped) - set(WEEKDAYS))
+    position = {c: i for i, c in enumerate(categories)}
+    unique_codes = np.array([position[m] for m in mapped], dtype=np.int64)
+    values = pd.Categorical.from_codes(unique_codes[codes], categories=categories, ordered=True)
+    return pd.Series(values, index=days.index, name=days.name)
+
+def split_by_day(df_selected):
+    """Partition rows by weekday with a single stable sort on (day, start time)
+
+    Returns {day: slice} in week order plus UNKNOWN_DAY for the rest; the slices are
+    views of one sorted frame, not per-day copies.
+    """
+    start = times_to_minutes(df_selected['ساعت شروع']).fillna(np.inf).to_numpy()
+    group = np.minimum(df_selected['روز'].cat.codes.to_numpy(), len(WEEKDAYS))
+    order = np.lexsort((start, group))
+    ordered = df_selected.iloc[order]
+    bounds = np.searchsorted(group[order], np.arange(len(WEEKDAYS) + 2))
+
+    sheets = {}
+    for i, day in enumerate(WEEKDAYS + [UNKNOWN_DAY]):
+        if bounds[i + 1] > bounds[i]:
+            sheets[day] = ordered.iloc[bounds[i]:bounds[i + 1]]
+    return sheets
+
+class SchemaError(ValueError):
+    """Raised when the export header does not match the expected layout"""
+
+def normalize_text(s):
+    # حذف نیم‌فاصله، ی و ک عربی → فارسی
+    return str(s).translate(NORMALIZE_TABLE).strip()
+
+def normalize_header(s):
+    return ' '.join(normalize_text(s).split())
+
+def resolve_columns(columns, positions=None):
+    """Map each logical field to a column index: by header name first, then by expected position
+
+    The result is cached per header row, so exports (and phase-1 sheets) that share a
+    layout are resolved only once per process.
+    """
+    columns = [str(c) for c in columns]
+    key = hashlib.md5(
+        ('\x1f'.join(columns) + ('|pos' if positions else '')).encode('utf-8')
+    ).hexdigest()
+    if key not in _layout_cache:
+        _layout_cache[key] = _match_columns(columns, positions or {})
+    return _layout_cache[key]
+
+def _match_columns(columns, positions):
+    headers = [normalize_header(c) for c in columns]
+    layout = {'columns': {}, 'by_position': [], 'missing': []}
+    taken = set()
+
+    for field in SELECTED_COLUMNS:
+        candidates = [normalize_header(a) for a in [field] + HEADER_ALIASES[field]]
+        pos = positions.get(field)
+        in_range = pos is not None and pos < len(headers) and pos not in taken
+
+        # the expected position wins if its header still looks right
+        found = pos if in_range and any(c in headers[pos] for c in candidates) else None
+        if found is None:
+            found = _find_header(headers, candidates, taken)
+        if found is None and in_range:
+            found = pos
+            layout['by_position'].append(field)
+
+        if found is None:
+            layout['missing'].append(field)
+        else:
+            taken.add(found)
+        layout['columns'][field] = found
+
+    return layout
+
+def _find_header(headers, candidates, taken):
+    # exact match on any candidate first, then substring match (same order as candidates)
+    for exact in (True, False):
+        for cand in candidates:
+            for i, h in enumerate(headers):
+                if i not in taken and (h == cand if exact else cand in h):
+                    return i
+    return None
+
+def validate_header(columns):
+    """Resolve the export header once and stop early if a required field is missing"""
+    layout = resolve_columns(columns, SELECTED_COLUMNS)
+    missing = [f for f in layout['missing'] if f in REQUIRED_FIELDS]
+    if missing:
+        raise SchemaError(
+            "ستون‌های ضروری در خروجی آموزشیار پیدا نشدند: " + "، ".join(missing)
         )
-        
-        # ==== لیست روزهای معتبر ====
-        days = ['شنبه', 'یکشنبه', 'دوشنبه', 'سه‌شنبه', 'چهارشنبه', 'پنج‌شنبه', 'جمعه']
-        
-        # ==== تقسیم داده‌ها به شیت‌های مجزا و مرتب‌سازی ====
-        sheets = {}
-        for day in days:
-            subset = df_selected[df_selected['روز'] == day].copy()
-            if not subset.empty:
-                # مرتب‌سازی بر اساس ساعت شروع
-                subset['ساعت شروع مرتب'] = subset['ساعت شروع'].str.extract(r'(\d+)').astype(float)
-                subset = subset.sort_values(by='ساعت شروع مرتب', ascending=True).drop(columns=['ساعت شروع مرتب'])
-                sheets[day] = subset
-        
-        # ==== داده‌های با روز نامشخص ====
-        unknown = df_selected[~df_selected['روز'].isin(days)]
-        if not unknown.empty:
-            sheets['نامشخص'] = unknown
-        
-        # ==== ذخیره در فایل اکسل ====
-        with pd.ExcelWriter(temp_output_file, engine='openpyxl') as writer:
-            for day, subset in sheets.items():
-                subset.to_excel(writer, sheet_name=day[:30], index=False)
-        
-        print("✅ فایل اکسل موقت ساخته شد:", temp_output_file)
-        print("📅 روزهای شناسایی‌شده:", list(sheets.keys()))
-        return True
-        
+    return layout
+
+def select_columns(df, layout):
+    """Build the phase-1 table with logical column names from a resolved layout"""
+    data = {}
+    for field, pos in layout['columns'].items():
+        data[field] = df.iloc[:, pos] if pos is not None else pd.Series("", index=df.index)
+    return pd.DataFrame(data)
+
+def times_to_minutes(series):
+    """Vectorized time parser: '8', '08:30', '8.30', '0830', Persian digits -> minutes (NaN if invalid)"""
+    s = series.fillna("").astype(str).str.strip().str.translate(DIGITS_TABLE)
+    s = s.str.replace('.', ':', regex=False).str.replace('：', ':', regex=False)
+    parts = s.str.extract(TIME_RE)
+
+    minutes = pd.Series(float('nan'), index=series.index)
+    compact = pd.to_numeric(parts['hm'], errors='coerce')
+    compact_len = parts['hm'].str.len()
+    short = (compact_len <= 2).fillna(False).astype(bool)
+    minutes[short] = compact[short] * 60
+    long = (compact_len >= 3).fillna(False).astype(bool)
+    minutes[long] = (compact[long] // 100) * 60 + compact[long] % 100
+
+    hours = pd.to_numeric(parts['h'], errors='coerce')
+    mins = pd.to_numeric(parts['m'], errors='coerce').fillna(0)
+    has_hours = hours.notna()
+    minutes[has_hours] = hours[has_hours] * 60 + mins[has_hours]
+    return minutes
+
+def normalize_series(s):
+    """normalize_text for a whole column (vectorized)"""
+    return s.fillna("").astype(str).str.translate(NORMALIZE_TABLE).str.strip()
+
+def parse_calendar_sessions(calendar):
+    """Every session of each تقويم كلاس درس text, in one extractall pass
+
+    Returns one row per session indexed by (row position, session number) with the
+    روز, ساعت شروع, ساعت پایان and WEEK_COL ('' / 'فرد' / 'زوج') columns.
+    """
+    text = normalize_series(calendar.reset_index(drop=True))
+    found = text.str.extractall(SESSION_RE)
+    days = found['day'].str.replace(DAY_SPACE_RE, ' ', regex=True)
+    clock = lambda col: found[col].str.translate(DIGITS_TABLE).str.replace('.', ':', regex=False)
+    return pd.DataFrame({
+        'روز': days.map(DAY_MAP).fillna(days),
+        'ساعت شروع': clock('start'),
+        'ساعت پایان': clock('end'),
+        WEEK_COL: found['parity'].fillna(""),
+    }, index=found.index)
+
+def expand_calendar_sessions(df_selected):
+    """Backfill empty روز / ساعت fields from تقويم كلاس درس and add a row per further session
+
+    Empty fields are taken from the first session. When the row's own day and times
+    match one of its sessions, every other session becomes an extra row right after
+    it (same index label, so reports still point at the file row); rows contradicting
+    their calendar are left as they are. Returns the expanded table and the mask of
+    rows completed or added from the calendar.
+    """
+    fields = ['روز', 'ساعت شروع', 'ساعت پایان']
+    n = len(df_selected)
+    out = df_selected.copy()
+    out[WEEK_COL] = ""
+    sessions = parse_calendar_sessions(df_selected['تقويم كلاس درس'])
+    if sessions.empty:
+        return out, pd.Series(False, index=out.index)
+    pos = sessions.index.get_level_values(0).to_numpy()
+
+    # ==== تکمیل فیلدهای خالی از اولین جلسه ====
+    first = sessions.groupby(level=0).head(1).droplevel(1)
+    filled = np.zeros(n, dtype=bool)
+    for f in fields:
+        value = first[f].reindex(range(n), fill_value="").to_numpy(dtype=object)
+        fill = (out[f].str.strip() == "").to_numpy() & (value != "")
+        out.iloc[fill, out.columns.get_loc(f)] = value[fill]
+        filled |= fill
+
+    # ==== جلسه‌ای که با روز و ساعت خود ردیف یکی است ====
+    own_day = normalize_series(out['روز']).map(DAY_MAP).fillna("").to_numpy(dtype=object)[pos]
+    own_start = times_to_minutes(out['ساعت شروع']).to_numpy()[pos]
+    own_end = times_to_minutes(out['ساعت پایان']).to_numpy()[pos]
+    same = (
+        (sessions['روز'].to_numpy(dtype=object) == own_day)
+        & (times_to_minutes(sessions['ساعت شروع']).to_numpy() == own_start)
+        & (times_to_minutes(sessions['ساعت پایان']).to_numpy() == own_end)
+    )
+    matched = np.zeros(n, dtype=bool)
+    matched[pos[same]] = True
+    own = sessions[same].groupby(level=0).head(1).droplevel(1)
+    out.iloc[own.index.to_numpy(), out.columns.get_loc(WEEK_COL)] = own[WEEK_COL].to_numpy()
+
+    # ==== جلسه‌های دیگر ردیف‌های سازگار با تقویم ====
+    extra_mask = ~same & matched[pos]
+    extra_sessions = sessions[extra_mask]
+    extra_sessions = extra_sessions[~extra_sessions.droplevel(1).reset_index().duplicated().to_numpy()]
+    extra_pos = extra_sessions.index.get_level_values(0).to_numpy()
+    extra = out.iloc[extra_pos].copy()
+    for f in fields + [WEEK_COL]:
+        extra[f] = extra_sessions[f].to_numpy()
+
+    expanded = pd.concat([out, extra])
+    order = np.argsort(np.concatenate([np.arange(n), extra_pos]), kind='stable')
+    backfilled = np.concatenate([filled, np.ones(len(extra), dtype=bool)])
+    expanded = expanded.iloc[order]
+    return expanded, pd.Series(backfilled[order], index=expanded.index)
+
+def classify_rows(df, backfilled):
+    """Classify each phase-1 row as placed / backfilled / rejected with a reason code (vectorized)"""
+    start_raw = df['ساعت شروع'].str.strip()
+    end_raw = df['ساعت پایان'].str.strip()
+    start = times_to_minutes(start_raw)
+    end = times_to_minutes(end_raw)
+
+    # same slot arithmetic as phase 2: first slot containing start, last slot fully before end
+    start_idx = ((start - DAY_START_MIN) // SLOT_MIN).clip(lower=0)
+    end_idx = (end - DAY_START_MIN) // SLOT_MIN - 1
+
+    # phase 2 drops exact duplicates per day sheet
+    keys = df[['روز', 'کد ارائه درس', 'نام درس', 'نام استاد', 'مکان', 'ساعت شروع', 'ساعت پایان']
+              + ([WEEK_COL] if WEEK_COL in df.columns else [])]
+    keys = keys.apply(lambda col: col.str.replace('\u200c', '', regex=False).str.strip())
+
+    conditions = [
+        ~df['روز'].isin(WEEKDAYS),
+        keys.duplicated(),
+        (start_raw == "") | (end_raw == ""),
+        start.isna() | end.isna(),
+        end <= start,
+        end_idx < start_idx,
+    ]
+    reason = np.select(conditions, list(REJECT_REASONS), default="")
+    status = np.where(reason != "", 'rejected', np.where(backfilled, 'backfilled', 'placed'))
+    return pd.DataFrame({'وضعیت': status, 'کد دلیل': reason}, index=df.index)
+
+def write_validation_report(writer, df, report):
+    """Write the rejected rows and per-status / per-reason counters as two sheets"""
+    rejected = report['وضعیت'] == 'rejected'
+    rejects = df.loc[rejected].copy()
+    rejects.insert(0, 'شرح', report.loc[rejected, 'کد دلیل'].map(REJECT_REASONS))
+    rejects.insert(0, 'کد دلیل', report.loc[rejected, 'کد دلیل'])
+    rejects.insert(0, 'ردیف فایل', rejects.index + 2)  # سطر ۱ عنوان ستون‌هاست
+    rejects.to_excel(writer, sheet_name='ردیف‌های ردشده', index=False)
+
+    counts = summarize_validation(report)
+    pd.DataFrame(list(counts.items()), columns=['وضعیت / دلیل', 'تعداد']).to_excel(
+        writer, sheet_name='خلاصه اعتبارسنجی', index=False
+    )
+    return counts
+
+def summarize_validation(report):
+    counts = {status: int((report['وضعیت'] == status).sum()) for status in ('placed', 'backfilled', 'rejected')}
+    reason_counts = report['کد دلیل'].value_counts()
+    for code in REJECT_REASONS:
+        if reason_counts.get(code, 0):
+            counts[code] = int(reason_counts[code])
+    return counts
+
+# ==== توضیحات کاشی‌ها ====
+# full: کامنت روی همه کاشی‌ها / conflicts: فقط کاشی‌های چندکلاسه / none: بدون کامنت، با شیت جزئیات
+COMMENT_MODES = ('full', 'conflicts', 'none')
+COMMENT_MODE = 'full'
+MAX_COMMENT_ENTRIES = 6   # سقف کلاس‌های یک کامنت در حالت conflicts
+DETAIL_SHEET = 'جزئیات کلاس‌ها'
+DETAIL_HEADERS = ['درس', 'استاد', 'کد', 'واحد نظری', 'واحد عملی', 'ثبت‌نام', 'ساعت شروع', 'ساعت پایان', 'هفته', 'مکان پیشنهادی']
+
+def new_tile_notes(wb, mode=COMMENT_MODE):
+    """State shared by the annotate_tile calls of one workbook"""
+    if mode not in COMMENT_MODES:
+        raise ValueError(f"حالت کامنت نامعتبر: {mode} (مجاز: {', '.join(COMMENT_MODES)})")
+    return {'wb': wb, 'mode': mode, 'tooltips': {}, 'comments': {}, 'detail_rows': {}}
+
+def entry_tooltip(notes, ent):
+    """Tooltip payload of one entry, built once per identical payload"""
+    key = tuple(ent[k] for k in ('course', 'teacher', 'code', 'unit_th', 'unit_pr', 'reg', 'start', 'end', 'week', 'proposed'))
+    text = notes['tooltips'].get(key)
+    if text is None:
+        # Simplified tooltip - removed گروه and مقطع to save space
+        text = (
+            f"درس: {ent['course']}\n"
+            f"استاد: {ent['teacher']}\n"
+            f"کد: {ent['code']}\n"
+            f"واحد: {ent['unit_th']}(ن) + {ent['unit_pr']}(ع)\n"
+            f"ثبت‌نام: {ent['reg']}\n"
+            f"ساعت: {ent['start']} - {ent['end']}"
+        )
+        if ent['week']:
+            text += f"\nهفته: {ent['week']}"
+        if ent['proposed']:
+            text += f"\nمکان: {ent['proposed']}"
+        notes['tooltips'][key] = text
+    return key, text
+
+def annotate_tile(notes, anchor, entries):
+    """Attach the tooltip of a tile as a comment, or link the tile to the detail sheet"""
+    if not entries:
+        return
+    mode = notes['mode']
+
+    if mode == 'none':
+        rows = notes['detail_rows']
+        for ent in entries:
+            key, _ = entry_tooltip(notes, ent)
+            rows.setdefault(key, len(rows) + 2)
+        first_row = rows[entry_tooltip(notes, entries[0])[0]]
+        anchor.hyperlink = Hyperlink(ref=anchor.coordinate, location=f"'{DETAIL_SHEET}'!A{first_row}")
+        return
+
+    if mode == 'conflicts' and len(entries) < 2:
+        return
+
+    shown = entries if mode == 'full' else entries[:MAX_COMMENT_ENTRIES]
+    payloads = [entry_tooltip(notes, ent) for ent in shown]
+    comment_key = tuple(key for key, _ in payloads) + (len(entries),)
+    comment_text = notes['comments'].get(comment_key)
+    if comment_text is None:
+        comment_text = "\n" + "─" * 30 + "\n".join(text for _, text in payloads)
+        if len(entries) > len(shown):
+            comment_text += f"\n… و {len(entries) - len(shown)} کلاس دیگر"
+        notes['comments'][comment_key] = comment_text
+
+    try:
+        anchor.comment = Comment(comment_text, "برنامه‌ساز")
+        anchor.comment.width = 350
+        anchor.comment.height = 200
     except Exception as e:
-        print(f"❌ خطا در فاز اول: {e}")
-        return False
-        
-def phase2_create_schedule(temp_file, final_output_file):
-    """Phase 2: Create class schedule tables from the temporary Excel file"""
-    
-    # Configuration
-    SLOT_MIN = 30   # minutes
-    DAY_START_MIN = 8 * 60  # start at 08:00
-    
-    if not os.path.exists(temp_file):
-        raise FileNotFoundError(f"فایل موقت یافت نشد: {temp_file}")
+        log_event('comment_error', "خطا در افزودن کامنت: %s", e, level=logging.WARNING)
+
+def finish_tile_notes(notes):
+    """Write the detail sheet collected in 'none' mode (one row per distinct payload)"""
+    if not notes['detail_rows']:
+        return
+    ws = notes['wb'].create_sheet(title=DETAIL_SHEET)
+    ws.append(DETAIL_HEADERS)
+    for c in ws[1]:
+        c.font = Font(bold=True)
+    for key in notes['detail_rows']:
+        ws.append(['' if pd.isna(v) else v for v in key])
+    for col_idx in range(1, len(DETAIL_HEADERS) + 1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = 25 if col_idx <= 2 else 12
+
+# ==== ذخیره قطعی: ورودی یکسان ← بایت‌های یکسان ====
+# openpyxl زمان ذخیره را در docProps/core.xml و در سرآیند هر عضو zip می‌نویسد؛ در این حالت هر دو
+# ثابت‌اند، پس خروجی‌ها با هش محتوا قابل مقایسه‌اند (ETag در نسخه وب).
+DETERMINISTIC_OUTPUT = True
+OUTPUT_TIMESTAMP = datetime(2000, 1, 1)
+_ZIP_TIMESTAMP = OUTPUT_TIMESTAMP.timetuple()[:6]
+
+class _FixedTimeZipFile(zipfile.ZipFile):
+    """ZipFile whose members all carry OUTPUT_TIMESTAMP and the same permissions"""
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None):
+        if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo_or_arcname = zipfile.ZipInfo(zinfo_or_arcname, date_time=_ZIP_TIMESTAMP)
+            zinfo_or_arcname.compress_type = self.compression
+            zinfo_or_arcname.external_attr = 0o600 << 16
+        super().writestr(zinfo_or_arcname, data, compress_type, compresslevel)
+
+    def write(self, filename, arcname=None, compress_type=None, compresslevel=None):
+        # openpyxl streams worksheets through temporary files
+        with open(filename, 'rb') as f:
+            self.writestr(arcname or os.path.basename(filename), f.read(), compress_type, compresslevel)
+
+def save_workbook(wb, target):
+    """wb.save(target), byte-for-byte reproducible when DETERMINISTIC_OUTPUT is set
+
+    target may be a path or a binary buffer.
+    """
+    if not DETERMINISTIC_OUTPUT:
+        wb.save(target)
+        return
+    wb.properties.created = OUTPUT_TIMESTAMP
+    wb.properties.modified = OUTPUT_TIMESTAMP
+    archive = _FixedTimeZipFile(target, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    ExcelWriter(wb, archive).save()
+
+def content_etag(data):
+    """Strong ETag of the output bytes (quoted, as sent in HTTP headers)"""
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+# ==== پوشه‌های کاربر ====
+# تنظیمات (قالب‌ها) و حافظه نهان هر کاربر در پوشه خود او، نه در پوشه موقت مشترک سیستم
+APP_DIR_NAME = 'class_schedule'
+
+def user_data_dir(kind='config'):
+    """Per-user folder of this program: 'config' (editable files) or 'cache' (disposable data)"""
+    if os.name == 'nt':
+        base = os.environ.get('APPDATA' if kind == 'config' else 'LOCALAPPDATA')
+    else:
+        base = os.environ.get('XDG_CONFIG_HOME' if kind == 'config' else 'XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.config' if kind == 'config' else '.cache')
+    return os.path.join(base, APP_DIR_NAME)
+
+def ensure_private_dir(path):
+    """Create path (mode 0700) if needed and refuse a folder another user owns or may write to"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.name == 'nt':
+        return path
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise PermissionError(f"پوشه {path} متعلق به کاربر دیگری است یا دیگران می‌توانند در آن بنویسند")
+    return path
+
+# ==== قالب شیت‌های جدول ====
+# برای هر پیکربندی خانه‌ها (شروع روز و طول خانه) یک فایل قالب روی دیسک ساخته می‌شود؛
+# با ویرایش آن در اکسل (لوگو، سربرگ/پاورقی، تنظیمات چاپ) همه خروجی‌های بعدی همان قالب را می‌گیرند.
+TEMPLATE_ENV = 'CLASS_SCHEDULE_TEMPLATES'   # پوشه قالب‌ها (یا --template-dir)
+TEMPLATE_DIR = os.environ.get(TEMPLATE_ENV) or os.path.join(user_data_dir('config'), 'templates')
+TEMPLATE_VERSION = 1
+TEMPLATE_SHEET = 'قالب'
+TEMPLATE_END_MIN = 24 * 60
+ROOM_ROW = 3   # سطر نمونه کلاس؛ ارتفاع آن برای همه سطرهای کلاس استفاده می‌شود
+
+_template_cache = {}
+
+def minute_label(m):
+    hh = m//60; mm = m%60
+    return f"{hh:02d}:{mm:02d}"
+
+def template_path(day_start_min=DAY_START_MIN, slot_min=SLOT_MIN):
+    return os.path.join(TEMPLATE_DIR, f"template_v{TEMPLATE_VERSION}_{day_start_min}_{slot_min}.xlsx")
+
+def build_template(path, day_start_min=DAY_START_MIN, slot_min=SLOT_MIN):
+    """Build and save the pre-styled skeleton sheet for one slot configuration"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = TEMPLATE_SHEET
+    slots = list(range(day_start_min, TEMPLATE_END_MIN, slot_min))
+
+    # Title row merged (the text is replaced per weekday)
+    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=1 + len(slots))
+    title_cell = ws.cell(row=1, column=1, value="جدول کلاسی")
+    title_cell.font = Font(size=14, bold=True)
+    title_cell.alignment = Alignment(horizontal="center", vertical="center")
+
+    # header row (slot labels) in row 2
+    corner = ws.cell(row=2, column=1, value="مکان / ساعت")
+    corner.font = Font(bold=True)
+    corner.alignment = Alignment(horizontal="center", vertical="center")
+    for j, m in enumerate(slots, start=2):
+        c = ws.cell(row=2, column=j, value=minute_label(m))
+        c.alignment = Alignment(horizontal="center", vertical="center")
+        c.font = Font(size=9)
+
+    ws.row_dimensions[ROOM_ROW].height = 22
+    ws.column_dimensions[get_column_letter(1)].width = 25
+    for col_idx in range(2, 2 + len(slots)):
+        ws.column_dimensions[get_column_letter(col_idx)].width = 8
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    wb.save(tmp_path)
+    os.replace(tmp_path, path)
+
+def load_template(day_start_min=DAY_START_MIN, slot_min=SLOT_MIN):
+    """Template sheet for a slot configuration and its images; built on first use, reloaded when the file changes
+
+    Images are (bytes, anchor, width, height): openpyxl closes an image's stream once
+    it is written, so every sheet gets its own image object (see template_images).
+    """
+    ensure_private_dir(TEMPLATE_DIR)
+    path = template_path(day_start_min, slot_min)
+    if not os.path.exists(path):
+        build_template(path, day_start_min, slot_min)
+    mtime = os.path.getmtime(path)
+    cached = _template_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        src = load_workbook(path)[TEMPLATE_SHEET]
+        images = [(img._data(), img.anchor, img.width, img.height) for img in src._images]
+        src._images = []
+        cached = (mtime, src, images)
+        _template_cache[path] = cached
+    return cached[1], cached[2]
+
+def template_images(images):
+    """Fresh openpyxl images (own stream and anchor) for one sheet"""
+    fresh = []
+    for data, anchor, width, height in images:
+        img = SheetImage(io.BytesIO(data))
+        img.anchor = deepcopy(anchor)
+        img.width, img.height = width, height
+        fresh.append(img)
+    return fresh
+
+def _copy_style(src, dst):
+    dst.font = copy(src.font)
+    dst.fill = copy(src.fill)
+    dst.border = copy(src.border)
+    dst.alignment = copy(src.alignment)
+    dst.number_format = src.number_format
+    dst.protection = copy(src.protection)
+
+def new_schedule_sheet(wb, title, heading, slot_labels):
+    """Create a weekday table sheet as a copy of the template, trimmed to the needed slots
+
+    Returns the sheet and the height to use for room rows.
+    """
+    src, images = load_template()
+    ws = wb.create_sheet(title=title)
+    total_cols = 1 + len(slot_labels)
+
+    for row in src.iter_rows(min_row=1, max_row=ROOM_ROW - 1, max_col=total_cols):
+        for c in row:
+            if isinstance(c, MergedCell) or (c.value is None and not c.has_style):
+                continue
+            d = ws.cell(row=c.row, column=c.column, value=c.value)
+            if c.has_style:
+                _copy_style(c, d)
+
+    # slots beyond the template's last column reuse the style of its last label
+    template_cols = src.max_column
+    if total_cols > template_cols:
+        last = src.cell(row=2, column=template_cols)
+        for j in range(template_cols + 1, total_cols + 1):
+            c = ws.cell(row=2, column=j, value=slot_labels[j - 2])
+            _copy_style(last, c)
+
+    for rng in src.merged_cells.ranges:
+        if rng.min_row == 1 and rng.min_col == 1:
+            ws.merge_cells(start_row=1, start_column=1, end_row=rng.max_row, end_column=total_cols)
+        elif rng.min_col <= total_cols:
+            ws.merge_cells(start_row=rng.min_row, start_column=rng.min_col,
+                           end_row=rng.max_row, end_column=min(rng.max_col, total_cols))
+
+    last_width = src.column_dimensions[get_column_letter(template_cols)].width
+    for col_idx in range(1, total_cols + 1):
+        letter = get_column_letter(col_idx)
+        src_dim = src.column_dimensions[letter] if col_idx <= template_cols else None
+        ws.column_dimensions[letter].width = src_dim.width if src_dim else last_width
+    for r in range(1, ROOM_ROW):
+        if src.row_dimensions[r].height:
+            ws.row_dimensions[r].height = src.row_dimensions[r].height
+
+    # sheet-level layout: views, print settings, header/footer, images
+    ws.sheet_format = copy(src.sheet_format)
+    ws.views = copy(src.views)
+    ws.print_options = copy(src.print_options)
+    ws.page_margins = copy(src.page_margins)
+    ws.HeaderFooter = copy(src.HeaderFooter)
+    ws.sheet_properties.pageSetUpPr = copy(src.sheet_properties.pageSetUpPr)
+    for attr in ('orientation', 'paperSize', 'scale', 'fitToWidth', 'fitToHeight'):
+        setattr(ws.page_setup, attr, getattr(src.page_setup, attr))
+    if src.print_title_rows:
+        ws.print_title_rows = src.print_title_rows
+    for img in template_images(images):
+        ws.add_image(img)
+
+    ws.cell(row=1, column=1).value = heading
+    return ws, src.row_dimensions[ROOM_ROW].height or 22
+
+# ==== جایگذاری کلاس‌ها روی خانه‌های زمانی ====
+def slot_span(start, end, n_slots, day_start_min=DAY_START_MIN, slot_min=SLOT_MIN):
+    """(start_idx, end_idx) of a class on a slot header, or None if it fills no whole slot
+
+    The start slot is the one containing start (the nearest slot when start is
+    outside the header); the end slot is the last one that ends by end.
+    """
+    start_idx = min(max(int((start - day_start_min) // slot_min), 0), n_slots - 1)
+    end_idx = min(int((end - day_start_min) // slot_min) - 1, n_slots - 1)
+    if end_idx < start_idx:
+        return None
+    return start_idx, end_idx
+
+def sweep_tiles(placements):
+    """Tiles of one room row from its (start_idx, end_idx, entry) placements
+
+    Returns (first_slot, last_slot, entries) for each maximal run of slots covered
+    by the same entries (placement order, first entry per entry_id). Cost grows
+    with the number of placements, not with their length in slots.
+    """
+    starts, ends = {}, {}
+    for i, (first, last, _) in enumerate(placements):
+        starts.setdefault(first, []).append(i)
+        ends.setdefault(last + 1, []).append(i)
+    bounds = sorted(set(starts) | set(ends))
+
+    tiles = []
+    active = {}
+    for a, b in zip(bounds, bounds[1:]):
+        for i in ends.get(a, ()):
+            del active[i]
+        for i in starts.get(a, ()):
+            active[i] = placements[i][2]
+        if not active:
+            continue
+        entries, seen = [], set()
+        for i in sorted(active):
+            if active[i]['entry_id'] not in seen:
+                seen.add(active[i]['entry_id'])
+                entries.append(active[i])
+        if tiles and tiles[-1][1] == a - 1 and tiles[-1][2] == entries:
+            tiles[-1] = (tiles[-1][0], b - 1, entries)
+        else:
+            tiles.append((a, b - 1, entries))
+    return tiles
+
+def clean_course_table(df_selected):
+    # ==== پاکسازی و نرمال‌سازی ====
+    return df_selected.fillna("").astype(str)
+
+def backfill_course_table(df_selected):
+    """Add the sessions of تقويم كلاس درس, then map the weekdays; returns the table and backfilled mask"""
+    # ==== تکمیل روز و ساعت‌های خالی و افزودن همه جلسه‌های تقويم كلاس درس ====
+    rows_before = len(df_selected)
+    df_selected, backfilled = expand_calendar_sessions(df_selected)
+    LOG.info("🔹 تقویم کلاس: %d ردیف تکمیل یا اضافه شد (%d جلسه اضافه)",
+             int(backfilled.sum()), len(df_selected) - rows_before)
     
-    print("در حال خواندن فایل موقت:", temp_file)
-    xls = pd.ExcelFile(temp_file)
-    print("شیت‌های یافت شده:", xls.sheet_names)
+    # ==== نرمال‌سازی و نگاشت روزها (یک بار برای هر مقدار متمایز) ====
+    df_selected['روز'] = normalize_days(df_selected['روز'])
     
-    # helper: normalize time string -> minutes
-    def to_minutes(t):
-        if pd.isna(t) or str(t).strip() == "":
+    return df_selected, backfilled
+
+XLSX_MAGIC = b'PK\x03\x04'   # xlsx is a zip archive
+
+def _open_export(source):
+    """(binary source, is_xlsx) for a path, raw bytes or a binary file object"""
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return source, f.read(4) == XLSX_MAGIC
+    is_xlsx = source.read(4) == XLSX_MAGIC
+    source.seek(0)
+    return source, is_xlsx
+
+# ==== خواندن سریع xlsx: فقط ستون‌های لازم، سطر به سطر از XML شیت ====
+_XL_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_XL_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+def _xlsx_text(element):
+    # متن یک رشته مشترک یا درون‌خطی (با تکه‌های rich text)
+    return ''.join(t.text or '' for t in element.iter(_XL_NS + 't'))
+
+class _XlsxSheet:
+    """First worksheet of an xlsx archive: shared strings, date styles and a streaming row reader"""
+
+    def __init__(self, source):
+        self.archive = zipfile.ZipFile(source)
+        self.wanted = None
+        names = set(self.archive.namelist())
+        book = ET.fromstring(self.archive.read('xl/workbook.xml'))
+        pr = book.find(_XL_NS + 'workbookPr')
+        self.epoch = CALENDAR_MAC_1904 if pr is not None and pr.get('date1904') in ('1', 'true') else WINDOWS_EPOCH
+
+        rel_id = book.find(f'{_XL_NS}sheets/{_XL_NS}sheet').get(_XL_REL_NS + 'id')
+        rels = ET.fromstring(self.archive.read('xl/_rels/workbook.xml.rels'))
+        target = next(r.get('Target') for r in rels.iter(_PKG_REL_NS + 'Relationship') if r.get('Id') == rel_id)
+        self.path = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+        self.shared = []
+        if 'xl/sharedStrings.xml' in names:
+            for _, si in ET.iterparse(self.archive.open('xl/sharedStrings.xml')):
+                if si.tag == _XL_NS + 'si':
+                    self.shared.append(_xlsx_text(si))
+                    si.clear()
+
+        self.date_styles = set()
+        if 'xl/styles.xml' in names:
+            styles = ET.fromstring(self.archive.read('xl/styles.xml'))
+            formats = dict(BUILTIN_FORMATS)
+            for fmt in styles.iter(_XL_NS + 'numFmt'):
+                formats[int(fmt.get('numFmtId'))] = fmt.get('formatCode')
+            xfs = styles.find(_XL_NS + 'cellXfs')
+            for i, xf in enumerate(xfs if xfs is not None else ()):
+                code = formats.get(int(xf.get('numFmtId', 0)))
+                if code and is_date_format(code):
+                    self.date_styles.add(str(i))
+
+    def value(self, cell):
+        """Python value of a <c> element, with the conversions pandas applies to openpyxl cells"""
+        kind = cell.get('t', 'n')
+        if kind == 'inlineStr':
+            inline = cell.find(_XL_NS + 'is')
+            return _xlsx_text(inline) if inline is not None else None
+        text = cell.findtext(_XL_NS + 'v')
+        if text is None or text == '':
             return None
-        s = str(t).strip()
-        s = s.translate(str.maketrans('۰۱۲۳۴۵۶۷۸۹','0123456789'))
-        s = s.replace('.', ':').replace('：', ':')
-        # if input like "8" -> "8:00"
-        if ':' not in s and s.isdigit() and len(s) <= 2:
-            try:
-                return int(s) * 60
-            except:
-                return None
-        if ':' in s:
-            parts = s.split(':')
-            try:
-                h = int(parts[0])
-                m = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
-                return h*60 + m
-            except:
-                return None
-        # fallback try digits-only like "0830"
-        if s.isdigit() and len(s) in (3,4):
-            if len(s)==3: s = '0'+s
-            hh = int(s[:-2]); mm = int(s[-2:])
-            return hh*60 + mm
+        if kind == 's':
+            return self.shared[int(text)]
+        if kind in ('str', 'e'):
+            return text
+        if kind == 'b':
+            return bool(int(text))
+        if kind == 'd':
+            return from_ISO8601(text)
+        number = float(text) if any(ch in text for ch in '.eE') else int(text)
+        if cell.get('s') in self.date_styles:
+            return from_excel(number, self.epoch)
+        if isinstance(number, float) and number.is_integer():
+            return int(number)
+        return number
+
+    def rows(self):
+        """Yield {column index: <c> element} per sheet row, with empty rows for gaps
+
+        Only the columns in self.wanted are kept once it is set (after the header row).
+        """
+        expected = 1
+        row_tag, cell_tag = _XL_NS + 'row', _XL_NS + 'c'
+        columns = {}   # 'BX' -> 75
+        for _, row in ET.iterparse(self.archive.open(self.path)):
+            if row.tag != row_tag:
+                continue
+            number = int(row.get('r', expected))
+            for _ in range(expected, number):
+                yield {}
+            expected = number + 1
+            cells, col = {}, -1
+            for cell in row.iter(cell_tag):
+                ref = cell.get('r')
+                if ref:
+                    letters = ref.rstrip('0123456789')
+                    col = columns.get(letters)
+                    if col is None:
+                        col = columns[letters] = column_index_from_string(letters) - 1
+                else:
+                    col += 1
+                if self.wanted is None or col in self.wanted:
+                    cells[col] = cell
+            yield cells
+            row.clear()
+
+def read_course_columns(source):
+    """Read only the columns the schedule uses from a CSV or XLSX export (content-sniffed)
+
+    The header is validated before any data row is read. XLSX sheets are streamed
+    row by row from their XML and only the needed cells are converted, or read by
+    calamine when it is installed.
+    Returns the phase-1 table with logical column names and the number of export columns.
+    """
+    source, is_xlsx = _open_export(source)
+    if not is_xlsx:
+        header = pd.read_csv(source, encoding='utf-8-sig', nrows=0).columns
+        if not isinstance(source, str):
+            source.seek(0)
+    else:
+        sheet = _XlsxSheet(source)
+        rows = sheet.rows()
+        first = next(rows, {})
+        width = max(first) + 1 if first else 0
+        header = [str(sheet.value(first[i])) if i in first and sheet.value(first[i]) is not None else ''
+                  for i in range(width)]
+
+    layout = validate_header(header)
+    if layout['by_position']:
+        LOG.warning("⚠️ این ستون‌ها با نام پیدا نشدند و بر اساس شماره خوانده شدند: %s", layout['by_position'])
+    wanted = sorted({pos for pos in layout['columns'].values() if pos is not None})
+    if is_xlsx:
+        sheet.wanted = set(wanted)
+
+    if not is_xlsx:
+        df = pd.read_csv(source, encoding='utf-8-sig', usecols=wanted)
+    elif XLSX_ENGINE == 'calamine':
+        sheet.archive.close()
+        if not isinstance(source, str):
+            source.seek(0)
+        df = pd.read_excel(source, engine='calamine', usecols=wanted)
+    else:
+        data, last = [], 0
+        for cells in rows:
+            data.append([sheet.value(cells[i]) if i in cells else None for i in wanted])
+            if any(v is not None for v in data[-1]):
+                last = len(data)
+        del data[last:]   # trailing empty rows, as pandas drops them
+        sheet.archive.close()
+        df = pd.DataFrame(data, columns=[header[i] for i in wanted]).infer_objects()
+
+    # positions in the narrowed frame, in export order
+    narrow = {pos: i for i, pos in enumerate(wanted)}
+    columns = {field: (narrow[pos] if pos is not None else None) for field, pos in layout['columns'].items()}
+    return select_columns(df, {'columns': columns}), len(header)
+
+# ==== نقطه بازیابی جدول نرمال‌شده (checkpoint) ====
+# خروجی فاز اول پیش از نوشتن در اکسل (جدول نرمال‌شده + ماسک تکمیل از تقویم) با کلید
+# «هش ورودی + نسخه پارسر + هش کد» ذخیره می‌شود تا اجراهای بعدی همان فایل (مثلاً فقط با
+# حالت کامنت یا اندازه خانه دیگر) خواندن و نرمال‌سازی را تکرار نکنند.
+# نقاط بازیابی در پوشه خصوصی کاربر و فقط با قالب feather (بدون pickle) ذخیره می‌شوند؛
+# بدون pyarrow غیرفعال‌اند. نسخه وب و رابط HTTP از آن‌ها استفاده نمی‌کنند.
+CHECKPOINT_DIR = os.path.join(user_data_dir('cache'), 'checkpoints')
+CHECKPOINT_VERSION = 1   # با هر تغییر در خواندن یا نرمال‌سازی ورودی افزایش یابد
+CHECKPOINT_MAX_BYTES = 256 * 1024 * 1024
+try:
+    import pyarrow  # noqa: F401
+    CHECKPOINT_ENABLED = True
+except ImportError:
+    CHECKPOINT_ENABLED = False
+
+_code_digest = None
+
+def _source_digest():
+    # هر تغییری در این فایل نقاط بازیابی قبلی را بی‌اعتبار می‌کند
+    global _code_digest
+    if _code_digest is None:
+        with open(os.path.abspath(__file__), 'rb') as f:
+            _code_digest = hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+    return _code_digest
+
+def checkpoint_dir_ok():
+    """Whether CHECKPOINT_DIR exists (created if needed) and only this user can write to it"""
+    try:
+        ensure_private_dir(CHECKPOINT_DIR)
+        return True
+    except OSError as e:
+        LOG.warning("⚠️ نقطه بازیابی استفاده نمی‌شود: %s", e)
+        return False
+
+def checkpoint_key(source):
+    """Key of an input (path, bytes or binary file object): content hash + parser version + code hash"""
+    digest = hashlib.blake2b(f"{CHECKPOINT_VERSION}|{_source_digest()}|".encode(), digest_size=16)
+    if isinstance(source, (bytes, bytearray)):
+        digest.update(source)
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        digest.update(source.read())
+        source.seek(0)
+    return digest.hexdigest()
+
+def _checkpoint_path(key):
+    return os.path.join(CHECKPOINT_DIR, f"{key}.feather")
+
+def load_checkpoint(key):
+    """(df_selected, backfilled) saved under key, or None"""
+    path = _checkpoint_path(key)
+    if not os.path.exists(path):
         return None
-    
-    def minute_label(m):
-        hh = m//60; mm = m%60
-        return f"{hh:02d}:{mm:02d}"
-    
-    # helper: find columns robustly
-    def find_col(df_cols, candidates):
-        for cand in candidates:
-            for c in df_cols:
-                if str(c).strip() == cand:
-                    return c
-        for cand in candidates:
-            for c in df_cols:
-                if cand in str(c):
-                    return c
+    try:
+        stored = pd.read_feather(path)
+    except Exception as e:
+        LOG.warning("⚠️ نقطه بازیابی خراب است و نادیده گرفته شد: %s", e)
+        os.remove(path)
         return None
-    
-    # generate consistent light color based on course name
-    def get_light_color(course_name):
-        """Generate a consistent light pastel color based on course name"""
-        if not course_name:
-            return "FFFFFF"
-        # Use hash to get consistent color for same course
-        hash_val = int(hashlib.md5(course_name.encode()).hexdigest()[:8], 16)
-        
-        # Generate pastel colors using HSL technique (light colors)
-        hues = [0, 30, 60, 120, 180, 240, 300]  # Red, Orange, Yellow, Green, Cyan, Blue, Magenta
-        hue = hues[hash_val % len(hues)]
-        
-        # Light pastel colors (high lightness, medium saturation)
-        if hue == 0:    # Red
-            return "FFE6E6"  # Very light red
-        elif hue == 30:  # Orange
-            return "FFE8CC"  # Very light orange
-        elif hue == 60:  # Yellow
-            return "FFF9C4"  # Very light yellow
-        elif hue == 120: # Green
-            return "E6F7E6"  # Very light green
-        elif hue == 180: # Cyan
-            return "E6F7F7"  # Very light cyan
-        elif hue == 240: # Blue
-            return "E6E6FF"  # Very light blue
-        else:           # Magenta
-            return "F7E6F7"  # Very light magenta
-    
-    # build slots globally as needed per sheet (end depends on data)
-    def build_slots(min_start, max_end):
-        # ensure start is DAY_START_MIN
-        start = DAY_START_MIN
-        # round end up to nearest slot
-        end = ((max_end + SLOT_MIN - 1)//SLOT_MIN)*SLOT_MIN
-        if end <= start:
-            end = start + 10 * 60  # fallback to 10 hours
-        return list(range(start, end, SLOT_MIN))
-    
-    # collect which sheets we will build tables for
-    weekday_names = ['شنبه','یکشنبه','دوشنبه','سه‌شنبه','چهارشنبه','پنج‌شنبه','جمعه']
-    
-    # Load the existing workbook (don't create a new one)
-    wb = load_workbook(temp_file)
-    
+    os.utime(path)   # برای حذف قدیمی‌ترین‌ها
+    stored.index = stored.pop('_row').to_numpy()
+    backfilled = stored.pop('_backfilled').astype(bool)
+    stored['روز'] = normalize_days(stored['روز'])
+    return stored, backfilled
+
+def save_checkpoint(key, df_selected, backfilled):
+    stored = df_selected.assign(روز=df_selected['روز'].astype(str), _backfilled=backfilled.to_numpy(dtype=bool))
+    stored.insert(0, '_row', df_selected.index.to_numpy())
+    stored = stored.reset_index(drop=True)
+    path = _checkpoint_path(key)
+    tmp = path + '.tmp'
+    stored.to_feather(tmp)
+    os.replace(tmp, path)
+    prune_checkpoints()
+
+def prune_checkpoints(max_bytes=CHECKPOINT_MAX_BYTES):
+    """Remove the least recently used checkpoints until the folder fits in max_bytes"""
+    entries = [e for e in os.scandir(CHECKPOINT_DIR) if e.is_file()]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    total = 0
+    for e in entries:
+        total += e.stat().st_size
+        if total > max_bytes:
+            os.remove(e.path)
+
+def load_course_table(source):
+    """Read, normalise and checkpoint one export (CSV or XLSX; path, bytes or buffer)
+
+    Runs the ingest / normalise / backfill stages of the pipeline; returns the
+    course table with logical column names (one row per session) and the mask of
+    rows completed or added from تقويم كلاس درس.
+    """
+    ctx = run_pipeline({'source': source}, ('ingest', 'normalise', 'backfill'))
+    return ctx['table'], ctx['backfilled']
+
+def partition_table(df_selected, backfilled):
+    """Validation classes of the rows and their split by weekday: (sheets, report)"""
+    # ==== اعتبارسنجی ردیف‌ها: جایگذاری‌شده / تکمیل‌شده از تقویم / ردشده ====
+    report = classify_rows(df_selected, backfilled)
+
+    # ==== تقسیم داده‌ها به شیت‌های مجزا و مرتب‌سازی (یک مرتب‌سازی پایدار) ====
+    return split_by_day(df_selected), report
+
+def write_day_sheets(df_selected, sheets, report, target):
+    """Write the phase-1 workbook (day sheets, validation, room proposals); returns the counters"""
+    with pd.ExcelWriter(target, engine='openpyxl') as writer:
+        for day, subset in sheets.items():
+            # حذف ستون تقويم كلاس درس از خروجی نهایی (جلسه‌هایش به ردیف‌ها تبدیل شده‌اند)
+            subset.drop(columns=['تقويم كلاس درس'], errors='ignore').to_excel(writer, sheet_name=day[:30], index=False)
+        counts = write_validation_report(writer, df_selected, report)
+        write_assignment_report(writer, df_selected)
+    return counts
+
+def save_indexes(df_selected, room_index_file=None, search_index_file=None, grid=None):
+    """Save the room occupancy index and / or the search index of a prepared table"""
+    if room_index_file:
+        save_json_index(build_room_index(df_selected), room_index_file)
+        LOG.info("🏫 نمایه اشغال کلاس‌ها: %s", room_index_file)
+    if search_index_file:
+        save_json_index(build_search_index(df_selected, grid), search_index_file)
+        LOG.info("🔍 نمایه جست‌وجو: %s", search_index_file)
+
+def phase1_extract_data(input_file, temp_output_file, room_index_file=None, assign=None, search_index_file=None):
+    """Phase 1: Extract important data from the export and save to Excel
+
+    input_file may be a CSV or XLSX path, raw bytes or a binary buffer (the format is
+    sniffed from the content); temp_output_file a path or a buffer. With
+    room_index_file / search_index_file the room occupancy index / search index is
+    saved there as well; assign proposes rooms for unplaced / conflicting sessions
+    (default: ASSIGN_ROOMS).
+    """
+    try:
+        # ==== خواندن و نرمال‌سازی فایل ورودی (یا نقطه بازیابی آن) تا تقسیم روزها ====
+        ctx = run_pipeline({'source': input_file, 'assign': assign},
+                           ('ingest', 'normalise', 'backfill', 'partition'))
+        counts = write_day_sheets(ctx['table'], ctx['sheets'], ctx['report'], temp_output_file)
+        save_indexes(ctx['table'], room_index_file, search_index_file)
+
+        LOG.info("✅ فایل اکسل موقت ساخته شد")
+        LOG.info("📅 روزهای شناسایی‌شده: %s", list(ctx['sheets']))
+        LOG.info("🔎 نتیجه اعتبارسنجی: %s", counts)
+        return True
+
+    except Exception as e:
+        LOG.error("❌ خطا در فاز اول: %s", e)
+        LOG.debug("جزئیات خطای فاز اول", exc_info=True)
+        return False
+
+def course_color(course_name):
+    """Generate a consistent light pastel color based on course name"""
+    if not course_name:
+        return "FFFFFF"
+    # Use hash to get consistent color for same course
+    hash_val = int(hashlib.md5(course_name.encode()).hexdigest()[:8], 16)
+
+    # Generate pastel colors using HSL technique (light colors)
+    hues = [0, 30, 60, 120, 180, 240, 300]  # Red, Orange, Yellow, Green, Cyan, Blue, Magenta
+    hue = hues[hash_val % len(hues)]
+
+    # Light pastel colors (high lightness, medium saturation)
+    if hue == 0:    # Red
+        return "FFE6E6"  # Very light red
+    elif hue == 30:  # Orange
+        return "FFE8CC"  # Very light orange
+    elif hue == 60:  # Yellow
+        return "FFF9C4"  # Very light yellow
+    elif hue == 120: # Green
+        return "E6F7E6"  # Very light green
+    elif hue == 180: # Cyan
+        return "E6F7F7"  # Very light cyan
+    elif hue == 240: # Blue
+        return "E6E6FF"  # Very light blue
+    else:           # Magenta
+        return "F7E6F7"  # Very light magenta
+
+def render_schedule(wb, grid, comment_mode=COMMENT_MODE):
+    """Add one «جدول کلاسی» sheet per day of a schedule_grid to wb (replacing earlier ones)
+
+    comment_mode: 'full' (comment on every tile), 'conflicts' (only tiles with
+    several classes) or 'none' (no comments, tiles link to a detail sheet).
+    """
     # remove prior phase2 sheets if they exist (start fresh)
     for s in wb.sheetnames[:]:
         if s.startswith("جدول کلاسی "):
             wb.remove(wb[s])
-    
-    # iterate through Phase1 weekday sheets
-    for sheet in xls.sheet_names:
-        if sheet not in weekday_names:
-            continue
-        print("در حال پردازش شیت:", sheet)
-        df = pd.read_excel(xls, sheet_name=sheet)
-        if df.empty:
-            print(" -> شیت خالی است، رد شد.")
-            continue
-        
-        # find relevant columns robustly
-        cols = list(df.columns)
-        col_room = find_col(cols, ['مکان','نام مكان','مكان'])
-        col_course = find_col(cols, ['نام درس','نام کلاس درس','نام کلاس'])
-        col_teacher = find_col(cols, ['نام استاد','نام كامل استاد','PR S_FNAME','نام كامل'])
-        col_code = find_col(cols, ['کد ارائه درس','کد ارائه','کد درس'])
-        col_unit_th = find_col(cols, ['واحد نظری','تعداد واحد نظري','تعداد واحد'])
-        col_unit_pr = find_col(cols, ['واحد عملی','تعداد واحد عملي'])
-        col_group = find_col(cols, ['گروه آموزشی','نام گروه آموزشي','گروه'])
-        col_degree = find_col(cols, ['مقطع'])
-        col_reg = find_col(cols, ['تعداد ثبت نامی','تعداد ثبت نامي','تعداد ثبت نام'])
-        col_M = find_col(cols, ['ساعت شروع','ساعت شروع کلاس','M','BV'])
-        col_N = find_col(cols, ['ساعت پایان','ساعت پایان کلاس','N','BW'])
-        
-        if col_room is None:
-            print(" -> ستون 'مکان' یافت نشد، رد شد.")
-            continue
-        
-        # normalize textual columns
-        for c in [col_room, col_course, col_teacher, col_code, col_unit_th, col_unit_pr, col_group, col_degree, col_reg]:
-            if c is not None and c in df.columns:
-                df[c] = df[c].fillna("").astype(str).str.replace('\u200c','').str.strip()
-        # times
-        if col_M in df.columns:
-            df['_M_min'] = df[col_M].apply(to_minutes)
-        else:
-            df['_M_min'] = None
-        if col_N in df.columns:
-            df['_N_min'] = df[col_N].apply(to_minutes)
-        else:
-            df['_N_min'] = None
-        
-        # drop exact duplicates (same code, same room, same times)
-        keycols = [c for c in [col_code, col_course, col_teacher, col_room, col_M, col_N] if c is not None]
-        if keycols:
-            df = df.drop_duplicates(subset=keycols)
-        
-        # determine slots (start at 08:00, end by max end)
-        starts = df['_M_min'].dropna().tolist()
-        ends = df['_N_min'].dropna().tolist()
-        max_end = max(ends) if ends else (20*60)
-        slots = build_slots(DAY_START_MIN, max_end)
-        slot_labels = [minute_label(s) for s in slots]
-        
-        # prepare rooms: one row per unique room (exact string)
-        rooms = df[col_room].fillna("").astype(str).unique().tolist()
-        
-        # NEW: Sort rooms by extracting numeric part
-        def extract_number(room_name):
-            """Extract numeric part from room name for sorting"""
-            # Find all numbers in the string
-            numbers = re.findall(r'\d+', room_name)
-            if numbers:
-                # Use the first number found
-                return int(numbers[0])
-            return 0  # Default for rooms without numbers
-        
-        # Sort rooms based on extracted number
-        rooms.sort(key=lambda x: extract_number(x))
-        
-        # build a grid: dict room -> list per slot (None or list of entries)
-        grid = {room: [None]*len(slots) for room in rooms}
-        
-        # fill grid: for each record mark slot indices that fully fit inside [M,N)
-        for idx, row in df.iterrows():
-            room = str(row[col_room])
-            start = row.get('_M_min', None)
-            end = row.get('_N_min', None)
-            if start is None or end is None:
-                continue
-            
-            # find start_idx: first slot s.t. slots[i] <= start < slots[i]+SLOT_MIN
-            start_idx = None
-            for i, s in enumerate(slots):
-                if s <= start < s + SLOT_MIN:
-                    start_idx = i
-                    break
-            if start_idx is None:
-                start_idx = min(range(len(slots)), key=lambda k: abs(slots[k]-start))
-            
-            # end_idx: last index where slot_start + SLOT_MIN <= end (fully contained)
-            end_idx = None
-            for i, s in enumerate(slots):
-                if s + SLOT_MIN <= end:
-                    end_idx = i
-            if end_idx is None or end_idx < start_idx:
-                continue
-            
-            # Create unique entry identifier to avoid duplicates
-            entry_id = f"{row[col_course] if col_course else ''}|{row[col_teacher] if col_teacher else ''}|{row[col_code] if col_code else ''}"
-            
-            # Create entry data
-            entry_data = {
-                'course': row[col_course] if col_course else "",
-                'teacher': row[col_teacher] if col_teacher else "",
-                'code': row[col_code] if col_code else "",
-                'unit_th': row[col_unit_th] if col_unit_th else "",
-                'unit_pr': row[col_unit_pr] if col_unit_pr else "",
-                'group': row[col_group] if col_group else "",
-                'degree': row[col_degree] if col_degree else "",
-                'reg': row[col_reg] if col_reg else "",
-                'M': row[col_M] if col_M else "",
-                'N': row[col_N] if col_N else "",
-                'entry_id': entry_id
-            }
-            
-            # assign entry to each slot in range
-            for k in range(start_idx, end_idx+1):
-                if grid[room][k] is None:
-                    grid[room][k] = []
-                
-                # Check if this exact entry already exists to avoid duplicates
-                existing_entry_ids = [e['entry_id'] for e in grid[room][k]]
-                if entry_id not in existing_entry_ids:
-                    grid[room][k].append(entry_data)
-        
-        # Create phase2 sheet
-        out_name = f"جدول کلاسی {sheet}"
+
+    notes = new_tile_notes(wb, comment_mode)
+
+    for day, layout in grid['days'].items():
+        log_event('sheet', "در حال پردازش شیت: %s", day)
+
+        # Create phase2 sheet from the cached template (title, slot header, widths)
+        out_name = f"جدول کلاسی {day}"
         out_name = out_name[:31]
-        ws = wb.create_sheet(title=out_name)
-        
-        # Title row merged
-        total_cols = 1 + len(slot_labels)
-        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=total_cols)
-        title_cell = ws.cell(row=1, column=1, value=f"جدول کلاسی {sheet}")
-        title_cell.font = Font(size=14, bold=True)
-        title_cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # header row (slot labels) in row 2
-        ws.cell(row=2, column=1, value="مکان / ساعت").font = Font(bold=True)
-        for j, lbl in enumerate(slot_labels, start=2):
-            c = ws.cell(row=2, column=j, value=lbl)
-            c.alignment = Alignment(horizontal="center", vertical="center")
-            c.font = Font(size=9)
-        
+        ws, room_height = new_schedule_sheet(wb, out_name, f"جدول کلاسی {day}", layout['slots'])
+
         # write room rows beginning at row 3
         start_row = 3
-        for i, room in enumerate(rooms):
+        for i, row_layout in enumerate(layout['rooms']):
             r = start_row + i
-            ws.cell(row=r, column=1, value=room)
+            ws.cell(row=r, column=1, value=row_layout['room'])
             ws.cell(row=r, column=1).alignment = Alignment(horizontal="center", vertical="center")
-            ws.row_dimensions[r].height = 22
-            
-            # merge contiguous slots with same content
-            j = 0
-            while j < len(slots):
-                cell_entries = grid[room][j]
-                if not cell_entries:
-                    j += 1
-                    continue
-                
-                # Find contiguous slots with identical content
-                k = j
-                while k+1 < len(slots) and grid[room][k+1] == cell_entries:
-                    k += 1
-                
-                excel_start = 2 + j
-                excel_end = 2 + k
-                
+            ws.row_dimensions[r].height = room_height
+
+            # one tile per run of slots with the same classes
+            for tile in row_layout['tiles']:
+                excel_start = 2 + tile['first']
+                excel_end = 2 + tile['last']
+                entries = tile['entries']
+
                 # Merge cells
                 if excel_end > excel_start:
                     ws.merge_cells(start_row=r, start_column=excel_start, end_row=r, end_column=excel_end)
-                
+
                 anchor = ws.cell(row=r, column=excel_start)
-                
-                # Display content (avoid duplicates)
-                unique_entries = []
-                seen_entry_ids = set()
-                for ent in cell_entries:
-                    if ent['entry_id'] not in seen_entry_ids:
-                        unique_entries.append(ent)
-                        seen_entry_ids.add(ent['entry_id'])
-                
-                # Format display text - only show unique entries
-                display_lines = []
-                tooltip_lines = []
-                
-                for ent in unique_entries:
-                    display_line = f"{ent['course']} — {ent['teacher']}"
-                    display_lines.append(display_line)
-                    
-                    # Simplified tooltip - removed گروه and مقطع to save space
-                    tooltip_text = (
-                        f"درس: {ent['course']}\n"
-                        f"استاد: {ent['teacher']}\n"
-                        f"کد: {ent['code']}\n"
-                        f"واحد: {ent['unit_th']}(ن) + {ent['unit_pr']}(ع)\n"
-                        f"ثبت‌نام: {ent['reg']}\n"
-                        f"ساعت: {ent['M']} - {ent['N']}"
-                    )
-                    tooltip_lines.append(tooltip_text)
-                
-                # Only show unique display lines (avoid duplicates in display)
-                unique_display_lines = list(set(display_lines))
-                anchor.value = "\n".join(unique_display_lines)
+
+                # Format display text; only show unique display lines (avoid duplicates in display)
+                display_lines = [f"{ent['course']} — {ent['teacher']}" + (f" ({ent['week']})" if ent['week'] else "")
+                                 + (f" [{PROPOSED_LABEL}]" if ent['proposed'] else "")
+                                 for ent in entries]
+                anchor.value = "\n".join(dict.fromkeys(display_lines))
                 anchor.alignment = Alignment(wrap_text=True, horizontal="center", vertical="center")
-                
-                # Add tooltip comment with increased height
-                if tooltip_lines:
-                    try:
-                        comment_text = "\n" + "─" * 30 + "\n".join(tooltip_lines)
-                        anchor.comment = Comment(comment_text, "برنامه‌ساز")
-                        anchor.comment.width = 350  # Increased width
-                        anchor.comment.height = 200  # Increased height for better visibility
-                    except Exception as e:
-                        print(f"خطا در افزودن کامنت: {e}")
-                
+
+                # Tooltip comment (or link to the detail sheet), depending on comment_mode
+                annotate_tile(notes, anchor, entries)
+
                 # Apply light color based on course name
-                if unique_entries:
-                    first_course = unique_entries[0]['course']
-                    color_hex = get_light_color(first_course)
+                if entries:
+                    color_hex = course_color(entries[0]['course'])
                     fill = PatternFill(start_color=color_hex, end_color=color_hex, fill_type="solid")
                     anchor.fill = fill
-                    
+
                     # Apply same fill to all merged cells
                     for col in range(excel_start, excel_end + 1):
                         ws.cell(row=r, column=col).fill = fill
-                
-                j = k + 1
-        
-        # Adjust column widths (reduced as requested)
-        ws.column_dimensions[get_column_letter(1)].width = 25  # Reduced room column width
-        for col_idx in range(2, 2 + len(slot_labels)):
-            col_letter = get_column_letter(col_idx)
-            ws.column_dimensions[col_letter].width = 8  # Reduced from 20 to 8 (less than half)
-        
-        # center alignment for header area
-        for row in ws.iter_rows(min_row=2, max_row=2, min_col=1, max_col=1+len(slot_labels)):
+
+    finish_tile_notes(notes)
+
+def read_phase1_sheets(temp_file):
+    """Weekday sheets of a phase-1 workbook as {day: rows} with the logical column names, all text"""
+    xls = pd.ExcelFile(temp_file)
+    LOG.info("شیت‌های یافت شده: %s", xls.sheet_names)
+    sheets = {}
+    for sheet in xls.sheet_names:
+        if sheet not in WEEKDAYS:
+            continue
+        df = pd.read_excel(xls, sheet_name=sheet)
+        if df.empty:
+            log_event('empty_sheet', " -> شیت خالی است، رد شد: %s", sheet)
+            continue
+
+        # find relevant columns (resolved once per sheet layout and cached)
+        cols = list(df.columns)
+        fields = {f: cols[i] for f, i in resolve_columns(cols)['columns'].items() if i is not None}
+        if 'مکان' not in fields:
+            log_event('no_room_column', " -> ستون 'مکان' یافت نشد، رد شد: %s", sheet, level=logging.WARNING)
+            continue
+        table = pd.DataFrame({f: df[c] for f, c in fields.items()})
+        for col in (WEEK_COL, ASSIGN_COL, ORIGINAL_ROOM_COL):
+            if col in df.columns:
+                table[col] = df[col]
+        for col in list(GRID_FIELDS.values()) + list(GRID_TIMES.values()):
+            if col not in table.columns:
+                table[col] = ""
+        sheets[sheet] = table.fillna("").astype(str)
+    return sheets
+
+def phase2_create_schedule(temp_file, final_output_file, comment_mode=COMMENT_MODE):
+    """Phase 2: Create class schedule tables from the temporary Excel file
+
+    comment_mode: 'full' (comment on every tile), 'conflicts' (only tiles with
+    several classes) or 'none' (no comments, tiles link to a detail sheet).
+    """
+
+    # temp_file / final_output_file may be paths or in-memory buffers (BytesIO)
+    if isinstance(temp_file, str) and not os.path.exists(temp_file):
+        raise FileNotFoundError(f"فایل موقت یافت نشد: {temp_file}")
+
+    LOG.info("در حال خواندن فایل موقت")
+    grid = schedule_grid(None, sheets=read_phase1_sheets(temp_file))
+
+    # Load the existing workbook (don't create a new one)
+    wb = load_workbook(temp_file)
+    render_schedule(wb, grid, comment_mode)
+
+    log_summary("جدول‌ها")
+    LOG.info("در حال ذخیره فایل نهایی")
+    save_workbook(wb, final_output_file)
+    LOG.info("✅ انجام شد.")
+
+# ==== خط لوله تبدیل: مرحله‌های نام‌دار ====
+# ingest → normalise → backfill → partition → place → render → save
+# هر مرحله تابعی است که «زمینه» (یک dict) را می‌گیرد و کامل می‌کند:
+#   source / output / comment_mode / assign / room_index_file / search_index_file  ورودی‌های اجرا
+#   table, backfilled (ingest تا backfill)  sheets, report (partition)  grid (place)
+#   workbook, counts (render)  stats (زمان و حافظه هر مرحله)
+# مرحله تازه با register_stage افزوده می‌شود (یا مرحله‌ای هم‌نام را جایگزین می‌کند)؛ run_pipeline
+# می‌تواند مرحله‌هایی را رد کند یا برای یک اجرا تابع دیگری (مثلاً نمایش دیگر) به جای مرحله‌ای بگذارد.
+# هر مرحله کلیدهایی از زمینه را که لازم دارد (requires) و می‌سازد (provides) اعلام می‌کند؛ پیش از
+# اجرا بررسی می‌شود که هر نیاز را زمینه اولیه یا مرحله‌ای پیش از آن فراهم کند.
+PIPELINE_STAGES = ['ingest', 'normalise', 'backfill', 'partition', 'place', 'render', 'save']
+PIPELINE_TRACE_MEMORY = False   # حافظه اوج هر مرحله با tracemalloc (کندتر؛ --profile)
+STAGES = {}
+STAGE_KEYS = {}   # مرحله ← (requires, provides)
+
+class PipelineError(ValueError):
+    """Raised before any stage runs when the stages asked for cannot run in that order"""
+
+def register_stage(name, func=None, before=None, after=None, requires=None, provides=None):
+    """Register func as pipeline stage name; usable as a decorator
+
+    A stage of the same name is replaced in place (keeping its requires / provides
+    unless new ones are given). A new name is inserted before / after an existing
+    stage, or before 'save' by default. requires / provides: context keys the stage
+    reads / adds.
+    """
+    if func is None:
+        return lambda f: register_stage(name, f, before, after, requires, provides)
+    if name not in PIPELINE_STAGES:
+        anchor = before or after or ('save' if 'save' in PIPELINE_STAGES else None)
+        if anchor is None:
+            PIPELINE_STAGES.append(name)
+        else:
+            if anchor not in PIPELINE_STAGES:
+                raise ValueError(f"مرحله ناشناخته: {anchor}")
+            PIPELINE_STAGES.insert(PIPELINE_STAGES.index(anchor) + (1 if after else 0), name)
+    STAGES[name] = func
+    if requires is not None or provides is not None or name not in STAGE_KEYS:
+        STAGE_KEYS[name] = (tuple(requires or ()), tuple(provides or ()))
+    return func
+
+def plan_pipeline(ctx, stages=None, skip=(), overrides=None):
+    """Stage name -> function for one run of run_pipeline; raises PipelineError
+
+    Every stage name must be known, and every key a stage requires must be in ctx
+    or provided by a stage that runs before it.
+    """
+    functions = dict(STAGES, **(overrides or {}))
+    names = [name for name in (stages or PIPELINE_STAGES) if name not in skip]
+    unknown = [name for name in names + list(skip) if name not in functions]
+    if unknown:
+        raise PipelineError(f"مرحله ناشناخته: {', '.join(unknown)} (مرحله‌ها: {', '.join(functions)})")
+    available = {key for key, value in ctx.items() if value is not None}
+    for name in names:
+        requires, provides = STAGE_KEYS.get(name, ((), ()))
+        for key in requires:
+            if key not in available:
+                makers = [stage for stage in PIPELINE_STAGES if key in STAGE_KEYS.get(stage, ((), ()))[1]]
+                raise PipelineError(f"مرحله {name} به «{key}» نیاز دارد که "
+                                    + (f"مرحله {'، '.join(makers)} می‌سازد" if makers else "در زمینه اجرا نیست"))
+        available.update(provides)
+    return {name: functions[name] for name in names}
+
+def _resident_bytes():
+    # حافظه مقیم پردازه؛ فقط جایی که /proc هست (در غیر این صورت None)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def format_stage_stats(stats):
+    """One line per run: stage seconds, resident memory change and traced peak (when measured)"""
+    parts = []
+    for stat in stats:
+        text = f"{stat['stage']} {stat['seconds']:.2f}s"
+        if stat['memory'] is not None:
+            text += f" {stat['memory'] / 1048576:+.0f}MB"
+        if stat['peak'] is not None:
+            text += f" (اوج {stat['peak'] / 1048576:.0f}MB)"
+        parts.append(text)
+    return "، ".join(parts)
+
+def run_pipeline(ctx, stages=None, skip=(), overrides=None):
+    """Run stages (default: PIPELINE_STAGES) on ctx in order and return ctx
+
+    skip leaves stages out; overrides maps stage names to functions used for this
+    run only. The plan is checked first (see plan_pipeline). Each stage's wall time,
+    change of resident memory and, with PIPELINE_TRACE_MEMORY, peak of traced
+    allocations are appended to ctx['stats'].
+    """
+    ctx['pipeline'] = functions = plan_pipeline(ctx, stages, skip, overrides)
+    names = list(functions)
+
+    stats = []
+    trace = PIPELINE_TRACE_MEMORY and not tracemalloc.is_tracing()
+    if trace:
+        tracemalloc.start()
+    try:
+        for name in names:
+            rss = _resident_bytes()
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+                traced = tracemalloc.get_traced_memory()[0]
+            started = time.perf_counter()
+            functions[name](ctx)
+            stat = {'stage': name, 'seconds': time.perf_counter() - started, 'memory': None, 'peak': None}
+            if rss is not None:
+                stat['memory'] = _resident_bytes() - rss
+            if tracemalloc.is_tracing():
+                stat['peak'] = tracemalloc.get_traced_memory()[1] - traced
+            stats.append(stat)
+    finally:
+        if trace:
+            tracemalloc.stop()
+    ctx.setdefault('stats', []).extend(stats)
+    LOG.info("⏱️ مرحله‌ها: %s", format_stage_stats(stats), extra={'stages': stats})
+    return ctx
+
+@register_stage('ingest', requires=('source',), provides=('table',))
+def stage_ingest(ctx):
+    """Export columns under their logical names, or the whole prepared table from its checkpoint"""
+    # the checkpoint stands for the default normalise and backfill stages only
+    pipeline = ctx.get('pipeline', {})
+    prepared = pipeline.get('normalise') is stage_normalise and pipeline.get('backfill') is stage_backfill
+    ctx['checkpoint'] = checkpoint_key(ctx['source']) if CHECKPOINT_ENABLED and prepared and checkpoint_dir_ok() else None
+    cached = load_checkpoint(ctx['checkpoint']) if ctx['checkpoint'] else None
+    if cached is not None:
+        LOG.info("♻️ جدول نرمال‌شده از نقطه بازیابی خوانده شد (%d ردیف)", len(cached[0]))
+        ctx['table'], ctx['backfilled'] = cached
+        ctx['restored'] = True
+        return
+    LOG.info("📖 در حال خواندن فایل ورودی ...")
+    ctx['table'], n_columns = read_course_columns(ctx['source'])
+    LOG.info("✅ فایل خوانده شد. تعداد ردیف‌ها: %d، ستون‌ها: %d", len(ctx['table']), n_columns)
+
+@register_stage('normalise', requires=('table',), provides=('normalised',))
+def stage_normalise(ctx):
+    """Missing cells to '' and every cell as text"""
+    if not ctx.get('restored'):
+        ctx['table'] = clean_course_table(ctx['table'])
+    ctx['normalised'] = True
+
+@register_stage('backfill', requires=('table', 'normalised'), provides=('backfilled',))
+def stage_backfill(ctx):
+    """Sessions of تقويم كلاس درس and weekday mapping; checkpoints the prepared table"""
+    if ctx.get('restored'):
+        return
+    ctx['table'], ctx['backfilled'] = backfill_course_table(ctx['table'])
+    if ctx.get('checkpoint'):
+        save_checkpoint(ctx['checkpoint'], ctx['table'], ctx['backfilled'])
+
+@register_stage('partition', requires=('table', 'normalised'), provides=('sheets', 'report'))
+def stage_partition(ctx):
+    """Room proposals (assign), validation classes and the split by weekday"""
+    table = apply_room_assignment(ctx['table'], ctx.get('assign'))
+    if not isinstance(table['روز'].dtype, pd.CategoricalDtype):   # backfill was skipped
+        table = table.assign(**{'روز': normalize_days(table['روز'])})
+    backfilled = ctx.get('backfilled')
+    if backfilled is None:
+        backfilled = pd.Series(False, index=table.index)
+    ctx['table'] = table
+    ctx['sheets'], ctx['report'] = partition_table(table, backfilled)
+    LOG.info("📅 روزهای شناسایی‌شده: %s", list(ctx['sheets']))
+
+@register_stage('place', requires=('table', 'sheets'), provides=('grid',))
+def stage_place(ctx):
+    """Rooms x slots of every weekday with the classes of each tile"""
+    ctx['grid'] = schedule_grid(ctx['table'], sheets=ctx['sheets'])
+
+@register_stage('render', requires=('table', 'sheets', 'report', 'grid'), provides=('workbook', 'counts'))
+def stage_render(ctx):
+    """Workbook: the phase-1 sheets plus one schedule sheet per weekday"""
+    phase1 = io.BytesIO()
+    ctx['counts'] = write_day_sheets(ctx['table'], ctx['sheets'], ctx['report'], phase1)
+    LOG.info("🔎 نتیجه اعتبارسنجی: %s", ctx['counts'])
+    ctx['workbook'] = load_workbook(phase1)
+    render_schedule(ctx['workbook'], ctx['grid'], ctx.get('comment_mode', COMMENT_MODE))
+    log_summary("جدول‌ها")
+
+@register_stage('save', requires=('table', 'workbook'), provides=('saved',))
+def stage_save(ctx):
+    """The workbook to ctx['output'] and the requested room / search indexes"""
+    if ctx.get('output') is not None:
+        LOG.info("در حال ذخیره فایل نهایی")
+        save_workbook(ctx['workbook'], ctx['output'])
+        ctx['saved'] = True
+    save_indexes(ctx['table'], ctx.get('room_index_file'), ctx.get('search_index_file'), ctx.get('grid'))
+    LOG.info("✅ انجام شد.")
+
+def convert_export(source, output, comment_mode=COMMENT_MODE, assign=None, room_index_file=None,
+                   search_index_file=None, skip=(), overrides=None):
+    """Whole conversion: export (path, bytes or buffer) -> schedule workbook (path or buffer)
+
+    Runs the stage pipeline in memory (skip / overrides as in run_pipeline) and
+    returns its context; ctx['stats'] holds the per-stage timings.
+    """
+    ctx = {'source': source, 'output': output, 'comment_mode': comment_mode, 'assign': assign,
+           'room_index_file': room_index_file, 'search_index_file': search_index_file}
+    return run_pipeline(ctx, skip=skip, overrides=overrides)
+
+# ==== فهرست کلاس‌ها: ساختمان / طبقه / شماره با کلید مرتب‌سازی طبیعی ====
+# هر رشته «مکان» یک بار تجزیه می‌شود و نتیجه برای همه شیت‌ها و اجراهای بعدی همین پردازش
+# (نسخه وب، پایش پوشه) نگه داشته می‌شود. فایل کناری اختیاری ظرفیت، ساختمان و طبقه را می‌دهد.
+ROOM_CATALOGUE_FILE = None   # CSV با ستون «مکان» و در صورت نیاز «ظرفیت»، «ساختمان»، «طبقه»
+ROOM_SEP_RE = re.compile(r'\s*[-–—/،,]\s*')
+ROOM_FLOOR_RE = re.compile(r'طبقه\s*(\d+)')
+ROOM_NUMBER_RE = re.compile(r'\d+')
+ROOM_CHUNK_RE = re.compile(r'(\d+)')
+ROOM_META_FIELDS = {'ظرفیت': 'capacity', 'ساختمان': 'building', 'طبقه': 'floor'}
+_room_catalogues = {}
+
+def natural_key(text):
+    """'کلاس 12' < 'کلاس 102': digits compare as numbers, the rest as text"""
+    return tuple((0, int(chunk), '') if chunk.isdigit() else (1, 0, chunk)
+                 for chunk in ROOM_CHUNK_RE.split(text) if chunk)
+
+def parse_room(room, meta=None):
+    """Building, floor, number and sort key of one مکان string
+
+    'ساختمان ب - کلاس 205' -> building 'ساختمان ب', floor 2, number 205. Without a
+    separator there is no building; the floor is an explicit «طبقه N», else the
+    hundreds of the room number. Side-file values (meta) take precedence.
+    """
+    text = normalize_text(room).translate(DIGITS_TABLE)
+    parts = ROOM_SEP_RE.split(text, maxsplit=1)
+    building, rest = (parts[0], parts[1]) if len(parts) > 1 and parts[0] else ("", text)
+    numbers = ROOM_NUMBER_RE.findall(rest)
+    number = int(numbers[-1]) if numbers else None
+    floor_match = ROOM_FLOOR_RE.search(rest)
+    floor = int(floor_match.group(1)) if floor_match else (number // 100 if number is not None else 0)
+    meta = meta or {}
+    building = meta.get('building') or building
+    floor = meta['floor'] if meta.get('floor') is not None else floor
+    return {'building': building, 'floor': floor, 'number': number, 'capacity': meta.get('capacity'),
+            'key': (natural_key(building), floor, natural_key(rest), text)}
+
+def load_room_catalogue(path):
+    """{normalised room: {'capacity', 'building', 'floor'}} from the side file
+
+    Columns are found by name in a «مکان» header row; a file without one is read
+    as room, capacity.
+    """
+    table = pd.read_csv(path, encoding='utf-8-sig', dtype=str, header=None).fillna("")
+    headers = {normalize_header(v): c for c, v in table.iloc[0].items()} if len(table) else {}
+    columns = {field: None for field in ROOM_META_FIELDS.values()}
+    if 'مکان' in headers:
+        table = table.iloc[1:]
+        room_col = headers['مکان']
+        columns = {field: headers.get(name) for name, field in ROOM_META_FIELDS.items()}
+    else:
+        room_col = table.columns[0]
+        if table.shape[1] > 1:
+            columns['capacity'] = table.columns[1]
+    meta = {}
+    for i, room in enumerate(table[room_col].map(normalize_text)):
+        if not room:
+            continue
+        entry = {}
+        for field, col in columns.items():
+            value = table[col].iat[i].strip().translate(DIGITS_TABLE) if col else ""
+            if field == 'building':
+                entry[field] = normalize_text(value) or None
+            else:
+                entry[field] = int(value) if value.isdigit() else None
+        meta[room] = entry
+    return meta
+
+def room_catalogue(path=None):
+    """Parsed rooms plus side-file metadata, one catalogue per side file version"""
+    path = path if path is not None else ROOM_CATALOGUE_FILE
+    signature = (path, os.stat(path).st_mtime_ns) if path else None
+    catalogue = _room_catalogues.get(signature)
+    if catalogue is None:
+        catalogue = {'meta': load_room_catalogue(path) if path else {}, 'rooms': {}}
+        _room_catalogues[signature] = catalogue
+    return catalogue
+
+def room_info(room, catalogue=None):
+    catalogue = catalogue or room_catalogue()
+    info = catalogue['rooms'].get(room)
+    if info is None:
+        info = catalogue['rooms'][room] = parse_room(room, catalogue['meta'].get(normalize_text(room)))
+    return info
+
+def sort_rooms(rooms, catalogue=None):
+    """Rooms in (building, floor, natural name) order"""
+    catalogue = catalogue or room_catalogue()
+    return sorted(rooms, key=lambda room: room_info(room, catalogue)['key'])
+
+# ==== پردازش بخش‌بندی‌شده (نیم‌سال / پردیس / رشته) ====
+PARTITION_KEYS = ('term', 'campus', 'department')
+INDEX_FILE = 'فهرست.xlsx'
+
+def room_building(room):
+    """Building / campus part of a مکان string ('دانشکده فنی - کلاس 101' -> 'دانشکده فنی')"""
+    return room_info(room)['building'] or 'سایر'
+
+def shard_keys(df_selected, partition_by):
+    """One shard label per row, e.g. '4031 - دانشکده فنی' for partition_by=('term', 'campus')"""
+    columns = []
+    for key in partition_by:
+        if key == 'term':
+            col = df_selected['نیم‌سال'].str.strip()
+        elif key == 'campus':
+            buildings = {room: room_building(room) for room in df_selected['مکان'].unique()}
+            col = df_selected['مکان'].map(buildings)
+        elif key == 'department':
+            col = df_selected['رشته'].map(normalize_text)
+        else:
+            raise ValueError(f"کلید بخش‌بندی نامعتبر: {key} (مجاز: {', '.join(PARTITION_KEYS)})")
+        columns.append(col.replace('', 'نامشخص'))
+    keys = columns[0]
+    for col in columns[1:]:
+        keys = keys + ' - ' + col
+    return keys
+
+UNSAFE_FILENAME_RE = re.compile(r'[\\/:*?"<>|]+')
+
+def safe_filename(name):
+    return UNSAFE_FILENAME_RE.sub('_', name).strip() or 'نامشخص'
+
+def _convert_shard(job):
+    """Worker: pipeline from partition on for one shard (runs in a separate process)"""
+    name, df_selected, backfilled, out_path, comment_mode = job
+    # rooms were already proposed for the whole export
+    ctx = run_pipeline({'table': df_selected, 'normalised': True, 'backfilled': backfilled, 'assign': False,
+                        'output': out_path, 'comment_mode': comment_mode},
+                       skip=('ingest', 'normalise', 'backfill'))
+    return {'name': name, 'path': out_path, 'rows': len(df_selected), 'days': list(ctx['sheets']), 'counts': ctx['counts']}
+
+def convert_partitioned(input_file, output_dir, partition_by=('term',), workers=None, comment_mode=COMMENT_MODE):
+    """Split one export into shards and build one workbook per shard in parallel
+
+    The export is read and normalised once; shards are converted by a process pool
+    (one process per core by default) and listed in an index workbook in output_dir.
+    """
+    df_selected, backfilled = load_course_table(input_file)
+    df_selected = apply_room_assignment(df_selected)
+    keys = shard_keys(df_selected, partition_by)
+
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    # positions, not labels: extra calendar sessions share the index label of their row
+    for name, idx in keys.groupby(keys, sort=True).indices.items():
+        out_path = os.path.join(output_dir, safe_filename(name) + '.xlsx')
+        jobs.append((name, df_selected.iloc[idx], backfilled.iloc[idx], out_path, comment_mode))
+    LOG.info("🔹 %d بخش برای پردازش موازی", len(jobs))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_convert_shard, jobs))
+
+    index_path = os.path.join(output_dir, INDEX_FILE)
+    write_shard_index(results, index_path)
+    return results, index_path
+
+def write_shard_index(results, index_path):
+    """Index workbook: one row per shard with its counters and a link to its file"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'فهرست'
+    ws.append(['بخش', 'تعداد ردیف', 'placed', 'backfilled', 'rejected', 'روزها', 'فایل'])
+    for c in ws[1]:
+        c.font = Font(bold=True)
+    for res in results:
+        counts = res['counts']
+        filename = os.path.basename(res['path'])
+        ws.append([res['name'], res['rows'], counts.get('placed', 0), counts.get('backfilled', 0),
+                   counts.get('rejected', 0), '، '.join(res['days']), filename])
+        link = ws.cell(row=ws.max_row, column=7)
+        link.hyperlink = filename
+        link.font = Font(color="0563C1", underline="single")
+    ws.column_dimensions['A'].width = 30
+    ws.column_dimensions['F'].width = 40
+    ws.column_dimensions['G'].width = 30
+    save_workbook(wb, index_path)
+
+# ==== ذخیره نمایه‌ها (JSON با شماره نسخه) ====
+def save_json_index(index, path):
+    """Write an index as JSON, replacing path only once the file is complete"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def load_json_index(path, version, label):
+    """An index saved by save_json_index; ValueError when it is not of this version"""
+    with open(path, encoding='utf-8') as f:
+        index = json.load(f)
+    if index.get('version') != version:
+        raise ValueError(f"نسخه {label} پشتیبانی نمی‌شود: {path}")
+    return index
+
+# ==== نمایه اشغال کلاس‌ها (کلاس × روز × خانه) ====
+# برای هر کلاس و روز دو عدد صحیح بیتی (هفته فرد / زوج)؛ بیت k یعنی خانه k اشغال است.
+# پرسش «کدام کلاس‌ها دوشنبه ۱۰ تا ۱۲ آزادند» بدون ساخت دوباره فایل اکسل پاسخ داده می‌شود.
+ROOM_INDEX_VERSION = 2   # 2: هر خانه‌ای که جلسه با آن هم‌پوشانی دارد اشغال است
+ROOM_INDEX_SUFFIX = '.rooms.json'
+
+def _week_bits(week):
+    # [فرد, زوج]: جلسه بدون فرد/زوج هر دو هفته را اشغال می‌کند
+    return [week != 'زوج', week != 'فرد']
+
+def session_times(df_selected):
+    """Positions of the sessions with a weekday and a time range (end after start) and their start / end minutes"""
+    start = times_to_minutes(df_selected['ساعت شروع'].str.strip())
+    end = times_to_minutes(df_selected['ساعت پایان'].str.strip())
+    valid = df_selected['روز'].isin(WEEKDAYS) & start.notna() & end.notna() & (end > start)
+    keep = np.flatnonzero(valid.to_numpy())
+    return keep, start.iloc[keep], end.iloc[keep]
+
+def session_slot_masks(df_selected, day_start_min=DAY_START_MIN, slot_min=SLOT_MIN):
+    """(position, room, day, odd-week mask, even-week mask) of every session with a weekday and a time range
+
+    Unlike the tiles of phase 2, a slot is occupied as soon as the session overlaps
+    any part of it (start rounded down, end rounded up), so a partly used slot is
+    never reported free and sessions shorter than a slot still count. Only the part
+    before day_start_min is lost. Rooms are normalised, an empty room stays ''.
+    """
+    keep, start, end = session_times(df_selected)
+    usable = df_selected.iloc[keep]
+    n_slots = (TEMPLATE_END_MIN - day_start_min) // slot_min
+
+    first = ((start - day_start_min) // slot_min).clip(lower=0).astype(int).tolist()
+    last = (-((day_start_min - end) // slot_min) - 1).clip(upper=n_slots - 1).astype(int).tolist()
+    rooms = usable['مکان'].str.replace('\u200c', '', regex=False).str.strip().tolist()
+    days = usable['روز'].astype(str).tolist()
+    weeks = usable[WEEK_COL].tolist() if WEEK_COL in usable.columns else [""] * len(usable)
+
+    sessions = []
+    for pos, room, day, week, a, b in zip(keep.tolist(), rooms, days, weeks, first, last):
+        if b < a:
+            continue
+        mask = ((1 << (b - a + 1)) - 1) << a
+        odd, even = _week_bits(week)
+        sessions.append((pos, room, day, mask if odd else 0, mask if even else 0))
+    return sessions, n_slots
+
+def build_room_index(df_selected, day_start_min=DAY_START_MIN, slot_min=SLOT_MIN):
+    """Occupancy bitmasks of every room from the prepared course table
+
+    Every session with a weekday and a time range counts (see session_slot_masks).
+    """
+    sessions, n_slots = session_slot_masks(df_selected, day_start_min, slot_min)
+    occupancy = {}
+    for _, room, day, odd, even in sessions:
+        if not room:
+            continue
+        masks = occupancy.setdefault(room, {}).setdefault(day, [0, 0])
+        masks[0] |= odd
+        masks[1] |= even
+    return {'version': ROOM_INDEX_VERSION, 'day_start_min': day_start_min, 'slot_min': slot_min,
+            'n_slots': n_slots, 'rooms': occupancy}
+
+def load_room_index(path):
+    return load_json_index(path, ROOM_INDEX_VERSION, "نمایه کلاس‌ها")
+
+def _query_day(day):
+    day = normalize_header(day)
+    return DAY_MAP.get(day, day)
+
+def _query_minutes(clock):
+    # same rules as times_to_minutes, for a single value without building a Series
+    text = str(clock).strip().translate(DIGITS_TABLE).replace('.', ':').replace('：', ':')
+    match = TIME_RE.match(text)
+    if not match:
+        raise ValueError(f"ساعت نامعتبر: {clock}")
+    if match['hm']:
+        value = int(match['hm'])
+        return value * 60 if len(match['hm']) <= 2 else (value // 100) * 60 + value % 100
+    return int(match['h']) * 60 + int(match['m'] or 0)
+
+def _room_mask(index, room, day, week=None):
+    masks = index['rooms'].get(room, {}).get(day, [0, 0])
+    if week == 'فرد':
+        return masks[0]
+    if week == 'زوج':
+        return masks[1]
+    return masks[0] | masks[1]
+
+def _slot_range(index, start, end):
+    """Slots overlapping [start, end) as a bitmask"""
+    base, step = index['day_start_min'], index['slot_min']
+    first = max(0, (_query_minutes(start) - base) // step)
+    last = min(index['n_slots'], -(-(_query_minutes(end) - base) // step))
+    if last <= first:
+        raise ValueError(f"بازه زمانی نامعتبر: {start} تا {end}")
+    return ((1 << (last - first)) - 1) << first
+
+def free_rooms(index, day, start, end, week=None):
+    """Rooms with no class overlapping [start, end) on day (week: None, 'فرد' or 'زوج')"""
+    day = _query_day(day)
+    wanted = _slot_range(index, start, end)
+    return sort_rooms(room for room in index['rooms'] if not _room_mask(index, room, day, week) & wanted)
+
+def busy_intervals(index, room, day, week=None):
+    """Occupied (start, end) clock pairs of one room on day"""
+    mask = _room_mask(index, room.replace('\u200c', '').strip(), _query_day(day), week)
+    base, step = index['day_start_min'], index['slot_min']
+    intervals = []
+    k = 0
+    while mask >> k:
+        if mask >> k & 1:
+            run = k
+            while mask >> run & 1:
+                run += 1
+            intervals.append((minute_label(base + k * step), minute_label(base + run * step)))
+            k = run
+        else:
+            k += 1
+    return intervals
+
+def first_free_slot(index, day, length_min, after=None, rooms=None, week=None):
+    """Earliest start of a free run of length_min minutes per room: {room: 'HH:MM'}
+
+    Rooms without such a run that day are left out.
+    """
+    day = _query_day(day)
+    base, step = index['day_start_min'], index['slot_min']
+    need = max(1, -(-int(length_min) // step))
+    first = max(0, -(-(_query_minutes(after) - base) // step)) if after else 0
+    full = (1 << index['n_slots']) - 1
+    result = {}
+    for room in ([r.replace('\u200c', '').strip() for r in rooms] if rooms else index['rooms']):
+        free = ~_room_mask(index, room, day, week) & full
+        # bit k stays set only if slots k .. k+need-1 are all free
+        runs = free
+        for i in range(1, need):
+            runs &= free >> i
+        runs = runs >> first << first
+        if runs:
+            result[room] = minute_label(base + ((runs & -runs).bit_length() - 1) * step)
+    return result
+
+# ==== جدول کلاسی به صورت داده (برای API و برنامه‌های دیگر) ====
+# همان کلاس‌ها، خانه‌ها و کاشی‌های شیت‌های «جدول کلاسی» بدون ساخت فایل اکسل؛
+# هر کاشی بازه‌ای از خانه‌های یک کلاس با کلاس‌های درسی یکسان است.
+GRID_VERSION = 1
+GRID_FIELDS = {'course': 'نام درس', 'teacher': 'نام استاد', 'code': 'کد ارائه درس',
+               'unit_th': 'واحد نظری', 'unit_pr': 'واحد عملی', 'group': 'گروه آموزشی',
+               'degree': 'مقطع', 'reg': 'تعداد ثبت نامی', 'room': 'مکان'}
+GRID_TIMES = {'start': 'ساعت شروع', 'end': 'ساعت پایان'}   # متن ساعت‌ها بدون تغییر
+
+def schedule_grid(df_selected, day_start_min=DAY_START_MIN, slot_min=SLOT_MIN, sheets=None):
+    """Placements of the schedule sheets as plain data (JSON-ready)
+
+    Returns {'version', 'slot_min', 'days': {day: {'slots': [...], 'rooms': [{'room',
+    'tiles'}]}}}; each tile is {'first', 'last', 'from', 'to', 'entries'} with the
+    entries of one run of slots, as phase 2 merges them (duplicates dropped, one
+    entry per course / teacher / code / week). sheets: the rows already split by
+    weekday (default: split_by_day(df_selected)).
+    """
+    days = {}
+    if sheets is None:
+        sheets = split_by_day(df_selected)
+    for day, subset in sheets.items():
+        if day not in WEEKDAYS:
+            continue
+        text = dict(GRID_FIELDS, week=WEEK_COL, reason=ASSIGN_COL, original=ORIGINAL_ROOM_COL)
+        table = pd.DataFrame({key: subset[col].to_numpy() if col in subset.columns else ""
+                              for key, col in text.items()}, index=range(len(subset)))
+        for key in text:
+            table[key] = table[key].astype(str).str.replace('\u200c', '', regex=False).str.strip()
+        for key, col in GRID_TIMES.items():
+            table[key] = subset[col].to_numpy()
+        table['proposed'] = [proposal_note(reason, original) for reason, original
+                             in zip(table.pop('reason'), table.pop('original'))]
+        table = table[list(GRID_FIELDS) + list(GRID_TIMES) + ['week', 'proposed']]
+        table = table.drop_duplicates(subset=['code', 'course', 'teacher', 'room', 'start', 'end', 'week'])
+
+        start = times_to_minutes(table['start'])
+        end = times_to_minutes(table['end'])
+        ends = end.dropna()
+        last_min = ((int(ends.max()) if len(ends) else 20 * 60) + slot_min - 1) // slot_min * slot_min
+        if last_min <= day_start_min:
+            last_min = day_start_min + 10 * 60
+        n_slots = len(range(day_start_min, last_min, slot_min))
+
+        rooms = sort_rooms(table['room'].unique().tolist())
+        placements = {room: [] for room in rooms}
+        for entry, a, b in zip(table.to_dict('records'), start.tolist(), end.tolist()):
+            if pd.isna(a) or pd.isna(b):
+                continue
+            span = slot_span(a, b, n_slots, day_start_min, slot_min)
+            if span is None:
+                continue
+            entry['entry_id'] = f"{entry['course']}|{entry['teacher']}|{entry['code']}" + (f"|{entry['week']}" if entry['week'] else "")
+            placements[entry.pop('room')].append((span[0], span[1], entry))
+
+        days[day] = {
+            'slots': [minute_label(day_start_min + k * slot_min) for k in range(n_slots)],
+            'rooms': [{'room': room, 'tiles': [
+                {'first': j, 'last': k,
+                 'from': minute_label(day_start_min + j * slot_min),
+                 'to': minute_label(day_start_min + (k + 1) * slot_min),
+                 'entries': [{f: v for f, v in ent.items() if f != 'entry_id'} for ent in entries]}
+                for j, k, entries in sweep_tiles(placements[room])]} for room in rooms]
+        }
+    return {'version': GRID_VERSION, 'slot_min': slot_min, 'days': days}
+
+# ==== نمایه جست‌وجو (درس، استاد، کد، مکان) ====
+# هر جلسه جایگذاری‌شده یک «جایگاه» است (روز، کلاس، ساعت و خانه آن در شیت جدول)؛ برای هر فیلد
+# واژه‌های نرمال‌شده (ی/ک عربی، نیم‌فاصله، ارقام فارسی) به‌ترتیب الفبا با فهرست جایگاه‌هایشان
+# نگه داشته می‌شوند و هر واژه پرسش با جست‌وجوی دودویی به‌عنوان پیشوند پیدا می‌شود.
+SEARCH_INDEX_VERSION = 1
+SEARCH_INDEX_SUFFIX = '.search.json'
+SEARCH_FIELDS = ('course', 'teacher', 'code', 'room')
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+SEARCH_LIMIT = 200
+
+def search_tokens(text):
+    """Search words of a text: normalize_text, ASCII digits, case-folded"""
+    return SEARCH_TOKEN_RE.findall(normalize_text(text).translate(DIGITS_TABLE).casefold())
+
+def build_search_index(df_selected, grid=None):
+    """Inverted index of the placed sessions over SEARCH_FIELDS
+
+    Returns {'version', 'placements', 'terms'}: one placement per session and room
+    row of a schedule sheet (with the sheet and cell of its first tile), and per
+    field the sorted words with the placement numbers containing them. grid: the
+    table's schedule_grid when already computed (df_selected is then not used).
+    """
+    placements, seen = [], {}
+    for day, layout in (grid or schedule_grid(df_selected))['days'].items():
+        for row, room in enumerate(layout['rooms'], start=3):
+            for tile in room['tiles']:
+                for entry in tile['entries']:
+                    key = (day, row, tuple(entry.values()))
+                    if key in seen:
+                        continue
+                    seen[key] = len(placements)
+                    placements.append(dict(entry, day=day, room=room['room'], sheet=f"جدول کلاسی {day}"[:31],
+                                           cell=f"{get_column_letter(2 + tile['first'])}{row}"))
+
+    terms = {}
+    for field in SEARCH_FIELDS:
+        postings = {}
+        for i, placement in enumerate(placements):
+            for token in dict.fromkeys(search_tokens(placement[field])):
+                postings.setdefault(token, []).append(i)
+        words = sorted(postings)
+        terms[field] = {'words': words, 'postings': [postings[w] for w in words]}
+    return {'version': SEARCH_INDEX_VERSION, 'placements': placements, 'terms': terms}
+
+def load_search_index(path):
+    return load_json_index(path, SEARCH_INDEX_VERSION, "نمایه جست‌وجو")
+
+def _prefix_matches(terms, prefix):
+    # واژه‌های هم‌پیشوند در فهرست مرتب پشت سر هم‌اند
+    words, postings = terms['words'], terms['postings']
+    found = set()
+    for k in range(bisect_left(words, prefix), len(words)):
+        if not words[k].startswith(prefix):
+            break
+        found.update(postings[k])
+    return found
+
+def search_schedule(index, query, field=None, day=None, limit=SEARCH_LIMIT):
+    """Placements matching every word of query (as a word prefix) in field or any SEARCH_FIELDS
+
+    day limits the results to one weekday; they keep the sheet order (day, room, time).
+    """
+    fields = [field] if field else SEARCH_FIELDS
+    matched = None
+    for token in dict.fromkeys(search_tokens(query)):
+        ids = set().union(*(_prefix_matches(index['terms'][f], token) for f in fields))
+        matched = ids if matched is None else matched & ids
+        if not matched:
+            return []
+    placements = index['placements']
+    results = [placements[i] for i in sorted(matched or ())]
+    if day:
+        day = _query_day(day)
+        results = [p for p in results if p['day'] == day]
+    return results[:limit] if limit else results
+
+def search_index_for(source):
+    """The search index of an export, reusing (or writing) the one saved next to it
+
+    source may also be a saved index (SEARCH_INDEX_SUFFIX).
+    """
+    if source.endswith(SEARCH_INDEX_SUFFIX):
+        return load_search_index(source)
+    path = os.path.splitext(source)[0] + SEARCH_INDEX_SUFFIX
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+        with contextlib.suppress(ValueError):
+            return load_search_index(path)
+    df_selected, _ = load_course_table(source)
+    index = build_search_index(apply_room_assignment(df_selected))
+    save_json_index(index, path)
+    LOG.info("🔍 نمایه جست‌وجو: %d جایگاه، %s", len(index['placements']), path)
+    return index
+
+# ==== پیشنهاد مکان برای کلاس‌های بدون مکان یا دارای تداخل ====
+# جلسه‌ها به ترتیب روز و ساعت شروع، هر کدام به اولین کلاس آزاد با کوچک‌ترین ظرفیت کافی
+# داده می‌شوند (تقسیم‌بندی بازه‌ها به روش حریصانه)؛ کلاس‌های بدون ظرفیت معلوم در آخر.
+ASSIGN_ROOMS = False        # با --assign-rooms یا گزینه رابط وب روشن می‌شود
+ASSIGN_COL = 'پیشنهاد مکان'
+ORIGINAL_ROOM_COL = 'مکان اولیه'
+ASSIGN_SHEET = 'پیشنهاد مکان'
+ASSIGN_REASONS = {
+    'EMPTY': 'مکان خالی بود',
+    'CONFLICT': 'با کلاس دیگری در همان مکان و زمان تداخل داشت',
+    'UNASSIGNED': 'کلاس آزاد با ظرفیت کافی پیدا نشد'
+}
+PROPOSED_LABEL = 'پیشنهادی'
+
+def assign_rooms(df_selected, capacities=None):
+    """Propose rooms for sessions without a room or clashing with another class in theirs
+
+    Sessions are kept in row order; a later session overlapping a kept one of a
+    different offering (course, teacher, code) in the same room, day and week parity
+    is moved. Returns a copy with the proposals in مکان, the reason code in ASSIGN_COL
+    and the previous room in ORIGINAL_ROOM_COL; rows left without a room are marked
+    UNASSIGNED and keep their original room.
+    """
+    capacities = {normalize_text(room): cap for room, cap in (capacities or {}).items()}
+    sessions, _ = session_slot_masks(df_selected)
+    offering = (df_selected['نام درس'] + '|' + df_selected['نام استاد'] + '|' + df_selected['کد ارائه درس'])
+    offering = offering.str.replace('\u200c', '', regex=False).tolist()
+    registered = pd.to_numeric(df_selected['تعداد ثبت نامی'].str.strip().str.translate(DIGITS_TABLE),
+                               errors='coerce').fillna(0).tolist()
+
+    busy = {}      # (room, day) -> [odd, even] occupied slots
+    kept = {}      # (room, day) -> [(odd, even, offering)]
+    pending = []
+    for pos, room, day, odd, even in sessions:
+        if not room:
+            pending.append(('EMPTY', pos, day, odd, even))
+            continue
+        key = (room, day)
+        if any((odd & k_odd or even & k_even) and k_id != offering[pos] for k_odd, k_even, k_id in kept.get(key, ())):
+            pending.append(('CONFLICT', pos, day, odd, even))
+            continue
+        kept.setdefault(key, []).append((odd, even, offering[pos]))
+        masks = busy.setdefault(key, [0, 0])
+        masks[0] |= odd
+        masks[1] |= even
+
+    # best fit: smallest known capacity first, then rooms of unknown capacity
+    catalogue = {room for _, room, _, _, _ in sessions if room}
+    known = {normalize_text(room) for room in catalogue}
+    catalogue = list(catalogue) + [room for room in capacities if room not in known]
+    capacity = {room: capacities.get(normalize_text(room)) for room in catalogue}
+    catalogue.sort(key=lambda room: (capacity[room] is None, capacity[room] or 0, room_info(room)['key']))
+
+    result = df_selected.copy()
+    proposals = [""] * len(result)
+    original = [""] * len(result)
+    rooms = result['مکان'].tolist()
+    # interval partitioning: sessions by start, each into the first room that is free
+    pending.sort(key=lambda item: (item[2], ((item[3] | item[4]) & -(item[3] | item[4])).bit_length(), item[1]))
+    for reason, pos, day, odd, even in pending:
+        chosen = None
+        for room in catalogue:
+            if capacity[room] is not None and capacity[room] < registered[pos]:
+                continue
+            masks = busy.get((room, day), (0, 0))
+            if not (masks[0] & odd or masks[1] & even):
+                chosen = room
+                break
+        if chosen is None:
+            proposals[pos] = 'UNASSIGNED'
+            continue
+        masks = busy.setdefault((chosen, day), [0, 0])
+        masks[0] |= odd
+        masks[1] |= even
+        proposals[pos] = reason
+        original[pos] = rooms[pos]
+        rooms[pos] = chosen
+
+    result['مکان'] = rooms
+    result[ASSIGN_COL] = proposals
+    result[ORIGINAL_ROOM_COL] = original
+    return result
+
+def apply_room_assignment(df_selected, enabled=None):
+    """assign_rooms when enabled (default: ASSIGN_ROOMS), with the capacities of the room catalogue"""
+    if not (ASSIGN_ROOMS if enabled is None else enabled):
+        return df_selected
+    capacities = {room: meta['capacity'] for room, meta in room_catalogue()['meta'].items()
+                  if meta['capacity'] is not None}
+    result = assign_rooms(df_selected, capacities)
+    counts = result[ASSIGN_COL].value_counts()
+    LOG.info("🏷️ پیشنهاد مکان: %s", {code: int(counts.get(code, 0)) for code in ASSIGN_REASONS})
+    return result
+
+def write_assignment_report(writer, df):
+    """Sheet of the rows whose room was proposed (or could not be); nothing without ASSIGN_COL"""
+    if ASSIGN_COL not in df.columns:
+        return
+    marked = df[ASSIGN_COL] != ""
+    report = df.loc[marked, ['نام درس', 'نام استاد', 'کد ارائه درس', 'روز', 'ساعت شروع', 'ساعت پایان',
+                             'تعداد ثبت نامی', ORIGINAL_ROOM_COL, 'مکان']].copy()
+    report.insert(0, 'شرح', df.loc[marked, ASSIGN_COL].map(ASSIGN_REASONS))
+    report.insert(0, 'کد دلیل', df.loc[marked, ASSIGN_COL])
+    report.insert(0, 'ردیف فایل', report.index + 2)
+    report.to_excel(writer, sheet_name=ASSIGN_SHEET, index=False)
+
+def proposal_note(reason, original):
+    """Tile/tooltip marker of a proposed room ('' for rooms taken from the export)"""
+    if reason not in ('EMPTY', 'CONFLICT'):
+        return ""
+    return f"{PROPOSED_LABEL} (مکان اولیه: {original})" if original else PROPOSED_LABEL
+
+# ==== تقویم iCalendar برای هر استاد و هر کلاس ====
+# هر جلسه یک رویداد هفتگی (یا دوهفته‌یکبار برای فرد/زوج) از شروع نیم‌سال است؛ متن رویدادها
+# یک بار ساخته می‌شود و هر فید فقط فهرستی از شماره رویدادهاست.
+ICAL_TERM_WEEKS = 16
+ICAL_TZID = 'Asia/Tehran'
+ICAL_FEEDS = {'teacher': ('نام استاد', 'استاد'), 'room': ('مکان', 'مکان')}   # ستون، پوشه
+ICAL_BYDAY = ['SA', 'SU', 'MO', 'TU', 'WE', 'TH', 'FR']                     # به ترتیب WEEKDAYS
+_ICAL_TIMEZONE = (
+    "BEGIN:VTIMEZONE\r\nTZID:Asia/Tehran\r\nBEGIN:STANDARD\r\nDTSTART:19700101T000000\r\n"
+    "TZOFFSETFROM:+0330\r\nTZOFFSETTO:+0330\r\nTZNAME:+0330\r\nEND:STANDARD\r\nEND:VTIMEZONE\r\n"
+)
+
+TERM_DATE_RE = re.compile(r'\s*(\d{4})[-/](\d{1,2})[-/](\d{1,2})\s*')
+
+def jalali_to_gregorian(jy, jm, jd):
+    """Solar Hijri date -> datetime.date (33-year cycle arithmetic)"""
+    jy += 1595
+    days = -355668 + 365 * jy + (jy // 33) * 8 + ((jy % 33) + 3) // 4 + jd
+    days += (jm - 1) * 31 if jm < 7 else (jm - 7) * 30 + 186
+    gy = 400 * (days // 146097)
+    days %= 146097
+    if days > 36524:
+        days -= 1
+        gy += 100 * (days // 36524)
+        days %= 36524
+        if days >= 365:
+            days += 1
+    gy += 4 * (days // 1461)
+    days %= 1461
+    if days > 365:
+        gy += (days - 1) // 365
+        days = (days - 1) % 365
+    return date(gy, 1, 1) + timedelta(days=days)
+
+def parse_term_start(text):
+    """'2025-09-23' or a Solar Hijri date such as '1404/07/01' -> datetime.date"""
+    match = TERM_DATE_RE.fullmatch(str(text).translate(DIGITS_TABLE))
+    if not match:
+        raise ValueError(f"تاریخ شروع نیم‌سال نامعتبر: {text}")
+    y, m, d = map(int, match.groups())
+    return jalali_to_gregorian(y, m, d) if y < 1700 else date(y, m, d)
+
+def ical_escape(text):
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+def ical_fold(line):
+    """Fold a content line at 75 octets without splitting a UTF-8 character"""
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + '\r\n'
+    parts, start, limit = [], 0, 75
+    while start < len(data):
+        end = min(start + limit, len(data))
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(data[start:end].decode('utf-8'))
+        start, limit = end, 74   # continuation lines begin with a space
+    return '\r\n '.join(parts) + '\r\n'
+
+def ical_events(df_selected, term_start, weeks=ICAL_TERM_WEEKS, stamp=None):
+    """One VEVENT text per session with a weekday and a time range, with the table positions they came from
+
+    Sessions are taken as they are, whatever the grid (start of day, slot length)
+    of the workbook; a repeated session (DUPLICATE in the validation report) gives
+    one event, and every UID is unique. Weeks are counted from the Saturday on or
+    before term_start; فرد sessions fall in weeks 1, 3, ... and زوج in weeks 2, 4, ....
+    """
+    positions, start, end = session_times(df_selected)
+    rows = df_selected.iloc[positions]
+    start, end = start.astype(int).tolist(), end.astype(int).tolist()
+    weeks_col = rows[WEEK_COL].tolist() if WEEK_COL in rows.columns else [""] * len(rows)
+    clean = lambda col: rows[col].str.replace('\u200c', '', regex=False).str.strip().tolist()
+    courses, teachers, codes, rooms = clean('نام درس'), clean('نام استاد'), clean('کد ارائه درس'), clean('مکان')
+    days = rows['روز'].astype(str).tolist()
+
+    stamp = (stamp or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+    saturday = term_start - timedelta(days=(term_start.weekday() - 5) % 7)
+    until = (saturday + timedelta(weeks=weeks) - timedelta(days=1)).strftime('%Y%m%dT235959Z')
+    events, kept, seen = [], [], {}
+    for i, (course, teacher, code, room, day, week, a, b) in enumerate(
+            zip(courses, teachers, codes, rooms, days, weeks_col, start, end)):
+        key = f"{code}|{course}|{teacher}|{room}|{day}|{a}|{week}"
+        ends = seen.setdefault(key, set())
+        if b in ends:
+            continue   # same session again
+        if ends:
+            key += f"|{b}"   # same class and start with another end: keep the UIDs apart
+        ends.add(b)
+        kept.append(i)
+        offset = WEEKDAYS.index(day)
+        first = saturday + timedelta(days=offset)
+        week_no = 0
+        if first < term_start:
+            first += timedelta(weeks=1)
+            week_no = 1
+        if week in WEEK_PARITIES and week_no % 2 != WEEK_PARITIES.index(week):
+            first += timedelta(weeks=1)
+        uid = hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+        description = f"استاد: {teacher}\nکد: {code}" + (f"\nهفته: {week}" if week else "")
+        lines = [
+            "BEGIN:VEVENT",
+            f"UID:{uid}@class-schedule",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART;TZID={ICAL_TZID}:{first:%Y%m%d}T{a // 60:02d}{a % 60:02d}00",
+            f"DTEND;TZID={ICAL_TZID}:{first:%Y%m%d}T{b // 60:02d}{b % 60:02d}00",
+            f"RRULE:FREQ=WEEKLY;INTERVAL={2 if week in WEEK_PARITIES else 1};BYDAY={ICAL_BYDAY[offset]};UNTIL={until}",
+            f"SUMMARY:{ical_escape(course)}",
+            f"LOCATION:{ical_escape(room)}",
+            f"DESCRIPTION:{ical_escape(description)}",
+            "END:VEVENT",
+        ]
+        events.append(''.join(ical_fold(line) for line in lines))
+    return events, {'teacher': [teachers[i] for i in kept], 'room': [rooms[i] for i in kept]}
+
+def export_ical(df_selected, output_dir, term_start, weeks=ICAL_TERM_WEEKS, feeds=tuple(ICAL_FEEDS)):
+    """Write one .ics feed per teacher and per room under output_dir: {feed: file count}
+
+    Events are rendered once; a single pass over them groups event numbers by
+    feed key, then each feed file is streamed out.
+    """
+    events, keys = ical_events(df_selected, term_start, weeks)
+    groups = {feed: {} for feed in feeds}
+    for i in range(len(events)):
+        for feed, members in groups.items():
+            name = keys[feed][i]
+            if name:
+                members.setdefault(safe_filename(name), []).append(i)
+
+    written = {}
+    for feed, members in groups.items():
+        folder = os.path.join(output_dir, ICAL_FEEDS[feed][1])
+        os.makedirs(folder, exist_ok=True)
+        for name, numbers in members.items():
+            with open(os.path.join(folder, name + '.ics'), 'w', encoding='utf-8', newline='') as f:
+                f.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//class_schedule//FA\r\nCALSCALE:GREGORIAN\r\n")
+                f.write(ical_fold(f"X-WR-CALNAME:{ical_escape(name)}"))
+                f.write(_ICAL_TIMEZONE)
+                for i in numbers:
+                    f.write(events[i])
+                f.write("END:VCALENDAR\r\n")
+        written[feed] = len(members)
+    return written
+
+# ==== گزارش تغییرات بین دو خروجی آموزشیار ====
+# پیوند درهم‌سازی‌شده (hash join) در دو مرحله: ابتدا جلسه‌های کاملاً یکسان کنار گذاشته می‌شوند،
+# سپس باقی‌مانده‌ها با «کد ارائه درس + شماره جلسه» جفت می‌شوند؛ جفت‌نشده‌ها اضافه یا حذف شده‌اند.
+DIFF_FIELDS = ['نام درس', 'نام استاد', 'روز', 'ساعت شروع', 'ساعت پایان', 'مکان', WEEK_COL]
+DIFF_KINDS = {
+    'ADDED': 'جلسه جدید',
+    'REMOVED': 'جلسه حذف‌شده',
+    'CHANGED': 'جلسه تغییرکرده'
+}
+DIFF_SHEET = 'تغییرات'
+
+def _diff_frame(df_selected):
+    """Comparable sessions: code plus DIFF_FIELDS, text normalised and times as HH:MM"""
+    report = classify_rows(df_selected, np.zeros(len(df_selected), dtype=bool))
+    rows = df_selected[(report['کد دلیل'] != 'DUPLICATE').to_numpy()]
+    table = pd.DataFrame({'کد ارائه درس': rows['کد ارائه درس']}, index=rows.index)
+    for field in DIFF_FIELDS:
+        table[field] = rows[field].astype(str) if field in rows.columns else ""
+    text = table.columns.drop('روز')   # روز is already canonical (with its ZWNJ)
+    table[text] = table[text].apply(lambda col: col.str.replace('\u200c', '', regex=False).str.strip())
+    for field in ('ساعت شروع', 'ساعت پایان'):
+        minutes = times_to_minutes(table[field])
+        valid = minutes.notna()
+        table.loc[valid, field] = [minute_label(int(m)) for m in minutes[valid]]
+    table['ردیف فایل'] = rows.index + 2
+    return table.reset_index(drop=True)
+
+def diff_exports(old_selected, new_selected):
+    """Session-level changes between two prepared course tables (one row per change)"""
+    old, new = _diff_frame(old_selected), _diff_frame(new_selected)
+    signature = ['کد ارائه درس'] + DIFF_FIELDS
+
+    # stage 1: identical sessions (with multiplicity) are unchanged
+    old['_n'] = old.groupby(signature, sort=False).cumcount()
+    new['_n'] = new.groupby(signature, sort=False).cumcount()
+    same = old[signature + ['_n']].merge(new[signature + ['_n']], on=signature + ['_n'], how='inner')
+    old = old.merge(same, on=signature + ['_n'], how='left', indicator=True)
+    old = old[old['_merge'] == 'left_only'].drop(columns=['_merge'])
+    new = new.merge(same, on=signature + ['_n'], how='left', indicator=True)
+    new = new[new['_merge'] == 'left_only'].drop(columns=['_merge'])
+
+    # stage 2: the rest paired by offering code and session number
+    old['_n'] = old.groupby('کد ارائه درس', sort=False).cumcount()
+    new['_n'] = new.groupby('کد ارائه درس', sort=False).cumcount()
+    joined = old.merge(new, on=['کد ارائه درس', '_n'], how='outer', suffixes=(' (قبلی)', ' (جدید)'), indicator=True)
+
+    kind = joined['_merge'].map({'left_only': 'REMOVED', 'right_only': 'ADDED', 'both': 'CHANGED'}).astype(str)
+    changed = pd.Series("", index=joined.index)
+    both = kind == 'CHANGED'
+    for field in DIFF_FIELDS:
+        differs = both & (joined[f'{field} (قبلی)'] != joined[f'{field} (جدید)'])
+        changed[differs] += field + '، '
+    changed = changed.str.rstrip('، ')
+
+    columns = ['ردیف فایل (قبلی)', 'ردیف فایل (جدید)', 'کد ارائه درس']
+    for field in DIFF_FIELDS:
+        columns += [f'{field} (قبلی)', f'{field} (جدید)']
+    result = joined[columns].copy()
+    result.insert(0, 'موارد تغییر', changed)
+    result.insert(0, 'شرح', kind.map(DIFF_KINDS))
+    result.insert(0, 'نوع', kind)
+    order = np.lexsort((result['کد ارائه درس'].astype(str).to_numpy(), kind.map(list(DIFF_KINDS).index).to_numpy()))
+    return result.iloc[order].reset_index(drop=True)
+
+def write_diff_report(changes, path):
+    """Changes as CSV (by extension) or as a workbook with a changes sheet and counters"""
+    if path.lower().endswith('.csv'):
+        changes.to_csv(path, index=False, encoding='utf-8-sig')
+        return
+    counts = changes['نوع'].value_counts()
+    summary = [(DIFF_KINDS[kind], int(counts.get(kind, 0))) for kind in DIFF_KINDS]
+    fields = changes['موارد تغییر'].str.split('، ').explode()
+    field_counts = fields[fields != ""].value_counts()
+    summary += [(f"تغییر {field}", int(field_counts.get(field, 0))) for field in DIFF_FIELDS if field_counts.get(field, 0)]
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        changes.to_excel(writer, sheet_name=DIFF_SHEET, index=False)
+        pd.DataFrame(summary, columns=['تغییر', 'تعداد']).to_excel(writer, sheet_name='خلاصه تغییرات', index=False)
+
+# ==== پایش پوشه (تبدیل خودکار فایل‌های جدید) ====
+WATCH_INTERVAL = 2.0   # ثانیه بین دو بررسی پوشه (یا انتظار inotify)
+WATCH_DEBOUNCE = 3.0   # فایل باید این مدت بدون تغییر بماند (نوشتن آن تمام شده باشد)
+
+def watch_output_path(input_file):
+    return os.path.splitext(input_file)[0] + '.xlsx'
+
+def _convert_in_place(job):
+    """Worker: convert one CSV and move the results next to it atomically"""
+    input_file, comment_mode = job
+    out_path = watch_output_path(input_file)
+    out_dir = os.path.dirname(out_path) or '.'
+    fd, partial = tempfile.mkstemp(dir=out_dir, prefix='.', suffix='.xlsx.part')
+    os.close(fd)
+    try:
+        stem = os.path.splitext(input_file)[0]
+        convert_export(input_file, partial, comment_mode, room_index_file=stem + ROOM_INDEX_SUFFIX,
+                       search_index_file=stem + SEARCH_INDEX_SUFFIX)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(partial, 0o666 & ~umask)   # mkstemp creates the file private
+        os.replace(partial, out_path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return out_path
+
+def _scan_inputs(directory):
+    """{path: (mtime, size)} of the CSV files in directory"""
+    found = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith('.csv') and not entry.name.startswith('.'):
+                st = entry.stat()
+                found[entry.path] = (st.st_mtime_ns, st.st_size)
+    return found
+
+def watch_folder(directory, workers=None, comment_mode=COMMENT_MODE,
+                 interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+    """Convert new or changed CSV files in directory until interrupted
+
+    Changes are picked up with inotify when inotify_simple is installed and by
+    polling otherwise. A file is converted once it has stayed unchanged for
+    debounce seconds; conversions run in a pool of warm worker processes and the
+    workbook is written next to the input (input.xlsx) with an atomic rename.
+    """
+    directory = os.path.abspath(directory)
+    notifier = None
+    if INotify is not None:
+        notifier = INotify()
+        notifier.add_watch(directory, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+                           | inotify_flags.MODIFY | inotify_flags.CREATE)
+
+    # inputs already converted (output newer than the input) are not redone
+    done = {}
+    for path, sig in _scan_inputs(directory).items():
+        out_path = watch_output_path(path)
+        if os.path.exists(out_path) and os.stat(out_path).st_mtime_ns >= sig[0]:
+            done[path] = sig
+
+    pending = {}   # path -> (signature, time it was first seen with it)
+    running = {}   # future -> (path, signature)
+    LOG.info("👀 پایش پوشه %s (%s)", directory, 'inotify' if notifier else 'بررسی دوره‌ای')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                if notifier is not None:
+                    notifier.read(timeout=int(interval * 1000))
+                else:
+                    time.sleep(interval)
+
+                now = time.monotonic()
+                busy = {path for path, _ in running.values()}
+                for path, sig in _scan_inputs(directory).items():
+                    if done.get(path) == sig or path in busy:
+                        continue
+                    if pending.get(path, (None,))[0] != sig:
+                        pending[path] = (sig, now)
+
+                # no more jobs in flight than workers, so later edits are not queued behind stale ones
+                limit = workers or os.cpu_count() or 1
+                for path, (sig, seen) in list(pending.items()):
+                    if len(running) >= limit:
+                        break
+                    if now - seen >= debounce:
+                        del pending[path]
+                        running[pool.submit(_convert_in_place, (path, comment_mode))] = (path, sig)
+                        LOG.info("🔹 تبدیل %s", os.path.basename(path))
+
+                for future in [f for f in running if f.done()]:
+                    path, sig = running.pop(future)
+                    try:
+                        LOG.info("✅ %s", future.result())
+                    except Exception as e:
+                        LOG.error("❌ خطا در تبدیل %s: %s", os.path.basename(path), e)
+                    done[path] = sig
+        except KeyboardInterrupt:
+            LOG.info("⏹ پایش متوقف شد")
+        finally:
+            if notifier is not None:
+                notifier.close()
+
+# ==== مقایسه خروجی با نسخه مرجع (golden) ====
+# هر مسیر سریع‌تر باید همان جدول نسخه قبلی را بسازد: هر دو نسخه روی یک ورودی اجرا و محتوای
+# نرمال‌شده کارپوشه‌ها (مقدار، ادغام، رنگ، متن کامنت) مقایسه می‌شود.
+GOLDEN_FRONTS = ('cli', 'gradio')
+GRADIO_MARKER = "\nimport gradio as gr\n"   # نسخه‌های پیش از create_app برنامه وب را هنگام import می‌ساختند
+
+def reference_source(ref):
+    """Source text of class_schedule.py from a file path or a git revision of this repository"""
+    if os.path.isfile(ref):
+        with open(ref, encoding='utf-8') as f:
+            return f.read()
+    result = subprocess.run(['git', 'show', f'{ref}:class_schedule.py'], capture_output=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.decode('utf-8').replace('\r\n', '\n')
+
+def load_engine(source, front='cli'):
+    """Fresh namespace of one class_schedule.py version; 'gradio' also builds its web app
+
+    Versions that built the web app on import are cut before it for 'cli'.
+    """
+    # the first versions had the Gradio import glued to the last line of the CLI half
+    source = source.replace("main()" + GRADIO_MARKER.lstrip('\n'), "main()" + GRADIO_MARKER)
+    if front == 'cli':
+        source = source.split(GRADIO_MARKER, 1)[0]
+    namespace = {'__name__': 'class_schedule_golden', '__file__': os.path.abspath(__file__)}
+    exec(compile(source, f'class_schedule_golden[{front}]', 'exec'), namespace)
+    if front == 'gradio' and 'create_app' in namespace and GRADIO_MARKER not in source:
+        namespace['create_app']()
+    # runs are timed and compared from scratch, never from a checkpoint
+    namespace['CHECKPOINT_ENABLED'] = False
+    return namespace
+
+def run_engine(engine, input_file, output_file):
+    """Phase 1 + phase 2 of one engine with its console output suppressed; returns seconds"""
+    fd, temp_file = tempfile.mkstemp(suffix='_phase1.xlsx')
+    os.close(fd)
+    disabled, LOG.disabled = LOG.disabled, True
+    try:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if not engine['phase1_extract_data'](input_file, temp_file):
+                raise RuntimeError(f"فاز اول ناموفق بود: {input_file}")
+            engine['phase2_create_schedule'](temp_file, output_file)
+        return time.perf_counter() - started
+    finally:
+        LOG.disabled = disabled
+        os.remove(temp_file)
+
+def tooltip_blocks(text):
+    """Tooltip text with its entry blocks in sorted order (lines inside a block keep theirs)
+
+    A block starts after a ─ rule or at each «درس:» line, so fields stay with their entry.
+    """
+    blocks, block = [], []
+    for line in text.split('\n'):
+        rest = line.lstrip('─')
+        if (rest != line or rest.startswith('درس:')) and block:
+            blocks.append('\n'.join(block))
+            block = []
+        if rest:
+            block.append(rest)
+    if block:
+        blocks.append('\n'.join(block))
+    return '\n─\n'.join(sorted(blocks))
+
+def workbook_snapshot(path, sheet_prefix=None):
+    """Normalised workbook content: {sheet: (merged ranges, {(row, col): (value, fill, comment)})}
+
+    Lines of multi-line tile texts and entry blocks of comments are sorted, since
+    their order is not part of the schedule.
+    """
+    def lines(v):
+        return '\n'.join(sorted(v.split('\n'))) if isinstance(v, str) and '\n' in v else v
+
+    snapshot = {}
+    wb = load_workbook(path)
+    for ws in wb.worksheets:
+        if sheet_prefix and not ws.title.startswith(sheet_prefix):
+            continue
+        cells = {}
+        for row in ws.iter_rows():
             for c in row:
-                c.alignment = Alignment(horizontal="center", vertical="center")
-    
-    print("در حال ذخیره فایل نهایی:", final_output_file)
-    wb.save(final_output_file)
-    print("✅ انجام شد.")
+                fill = c.fill.fgColor.rgb if c.fill is not None and c.fill.fill_type else None
+                comment = tooltip_blocks(c.comment.text) if c.comment else None
+                if c.value is not None or fill or comment:
+                    cells[(c.row, c.column)] = (lines(c.value), fill, comment)
+        snapshot[ws.title] = (sorted(str(r) for r in ws.merged_cells.ranges), cells)
+    return snapshot
+
+def first_divergence(expected, actual):
+    """Description of the first difference between two snapshots, or None"""
+    if list(expected) != list(actual):
+        missing = [t for t in expected if t not in actual]
+        extra = [t for t in actual if t not in expected]
+        if not missing and not extra:
+            return f"ترتیب شیت‌ها متفاوت است: {list(actual)}"
+        return f"شیت‌ها متفاوت‌اند: فقط در مرجع {missing}، فقط در جدید {extra}"
+    for title, (merges_a, cells_a) in expected.items():
+        merges_b, cells_b = actual[title]
+        if merges_a != merges_b:
+            only = sorted(set(merges_a) ^ set(merges_b))
+            return f"{title}: ادغام‌ها متفاوت‌اند (اولین: {only[0]})"
+        for key in sorted(set(cells_a) | set(cells_b)):
+            a, b = cells_a.get(key), cells_b.get(key)
+            if a != b:
+                cell = f"{get_column_letter(key[1])}{key[0]}"
+                parts = ('مقدار', 'رنگ', 'کامنت')
+                what = [parts[i] for i in range(3) if (a or (None,) * 3)[i] != (b or (None,) * 3)[i]]
+                return f"{title}!{cell} ({'، '.join(what)}): مرجع={a!r} / جدید={b!r}"
+    return None
+
+def write_synthetic_export(path, rows=300, seed=1):
+    """Anonymised export in the Amozeshyar column layout, with the edge cases the parser handles"""
+    rng = random.Random(seed)
+    width = max(SELECTED_COLUMNS.values()) + 1
+    header = [f'ستون{i}' for i in range(width)]
+    for field, pos in SELECTED_COLUMNS.items():
+        header[pos] = field
+    days = ['شنبه', 'يكشنبه', 'دوشنبه', 'سه شنبه', 'چهارشنبه', 'پنجشنبه', 'جمعه', '']
+    rooms = [f'کلاس {n}' for n in (101, 102, 205, 7)] + ['ساختمان ب - 12', 'آزمایشگاه 3', '']
+
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(header)
+        for i in range(rows):
+            start = rng.choice([8, 9, 10, 11, 13, 14, 15, 16, 17, 18]) * 60 + rng.choice([0, 0, 15, 30])
+            end = start + rng.choice([60, 90, 120, 180])
+            day = rng.choice(days)
+            room = rng.choice(rooms)
+            calendar = f"{rng.choice(days[:6])} {minute_label(start)} تا {minute_label(end)} - {room}"
+            if rng.random() < 0.2:
+                calendar += f" ، {rng.choice(days[:6])} {minute_label(start)} تا {minute_label(end)} (فرد)"
+            row = [''] * width
+            values = {
+                'نام درس': f'درس {rng.randint(1, 40)}', 'کد ارائه درس': str(1000 + i // 2),
+                'واحد نظری': str(rng.randint(1, 3)), 'واحد عملی': str(rng.randint(0, 1)), 'مکان': room,
+                'گروه آموزشی': f'گروه {rng.randint(1, 5)}', 'مقطع': rng.choice(['کارشناسی', 'کارشناسی ارشد']),
+                'تعداد ثبت نامی': str(rng.randint(3, 60)), 'نیم‌سال': rng.choice(['4031', '4032']),
+                'نام استاد': f'استاد {rng.randint(1, 25)}', 'رشته': f'رشته {rng.randint(1, 4)}',
+                'روز': day, 'ساعت شروع': minute_label(start), 'ساعت پایان': minute_label(end),
+                'تقويم كلاس درس': calendar,
+            }
+            r = rng.random()
+            if r < 0.1:      # روز و ساعت فقط در تقویم
+                values.update({'روز': '', 'ساعت شروع': '', 'ساعت پایان': ''})
+            elif r < 0.13:   # ساعت ناخوانا
+                values['ساعت شروع'] = 'xx'
+            elif r < 0.15:   # پیش از شروع جدول
+                values.update({'ساعت شروع': '07:00', 'ساعت پایان': '07:20'})
+            for field, value in values.items():
+                row[SELECTED_COLUMNS[field]] = value
+            out.writerow(row)
+
+def golden_compare(reference, inputs, front='cli', sheet_prefix=None, workdir=None):
+    """Run the reference version and this file on each input and compare the workbooks
+
+    Returns one result dict per input: name, divergence (None when equal) and both run times.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='class_schedule_golden_')
+    engines = {}
+    for label, source in (('reference', reference_source(reference)),
+                          ('current', open(os.path.abspath(__file__), encoding='utf-8').read())):
+        with contextlib.redirect_stdout(io.StringIO()):
+            engines[label] = load_engine(source, front)
+
+    results = []
+    for input_file in inputs:
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        outputs, seconds = {}, {}
+        for label, engine in engines.items():
+            outputs[label] = os.path.join(workdir, f'{name}_{label}.xlsx')
+            seconds[label] = run_engine(engine, input_file, outputs[label])
+        divergence = first_divergence(workbook_snapshot(outputs['reference'], sheet_prefix),
+                                      workbook_snapshot(outputs['current'], sheet_prefix))
+        results.append({'name': name, 'divergence': divergence, **seconds})
+    return results
+
+def command_parser():
+    """Parser of the command-line mode"""
+    parser = argparse.ArgumentParser(prog='class_schedule.py', description="تبدیل خروجی آموزشیار به جدول کلاسی")
+    log_mode = parser.add_mutually_exclusive_group()
+    log_mode.add_argument('--quiet', dest='log_mode', action='store_const', const='quiet',
+                          help="فقط هشدارها و خطاها")
+    log_mode.add_argument('--verbose', dest='log_mode', action='store_const', const='verbose',
+                          help="گزارش هر رویداد (با نمونه‌گیری و محدودیت نرخ)")
+    log_mode.add_argument('--log-json', dest='log_mode', action='store_const', const='json',
+                          help="گزارش ساخت‌یافته، یک شیء JSON در هر سطر")
+    parser.add_argument('--log-rate', type=int, default=LOG_RATE, help="حداکثر پیام هر دسته در ثانیه (0: نامحدود)")
+    parser.add_argument('--log-sample', type=int, default=LOG_SAMPLE, help="از هر N پیام یک دسته یکی چاپ شود")
+    parser.add_argument('--no-cache', action='store_true', help="بدون نقطه بازیابی جدول نرمال‌شده")
+    parser.add_argument('--template-dir', default=None,
+                        help=f"پوشه قالب جدول‌ها (پیش‌فرض: پوشه تنظیمات کاربر؛ یا متغیر {TEMPLATE_ENV})")
+    parser.add_argument('--assign-rooms', action='store_true',
+                        help="پیشنهاد مکان برای کلاس‌های بدون مکان یا دارای تداخل")
+    parser.add_argument('--room-catalogue', '--capacities', dest='room_catalogue', default=None,
+                        help="CSV کلاس‌ها: مکان و در صورت نیاز ظرفیت، ساختمان، طبقه")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_conv = sub.add_parser('convert', help="تبدیل یک فایل خروجی آموزشیار به جدول کلاسی")
+    p_conv.add_argument('input', help="فایل CSV یا XLSX خروجی آموزشیار")
+    p_conv.add_argument('output', help="فایل اکسل خروجی")
+    p_conv.add_argument('--comments', choices=COMMENT_MODES, default=COMMENT_MODE)
+    p_conv.add_argument('--skip', action='append', default=[], metavar='STAGE',
+                        help=f"رد کردن یک مرحله (قابل تکرار): {', '.join(PIPELINE_STAGES)}")
+    p_conv.add_argument('--profile', action='store_true', help="جدول زمان و حافظه (اوج) هر مرحله")
+
+    p_part = sub.add_parser('partition', help="یک فایل خروجی برای هر نیم‌سال / پردیس / رشته")
+    p_part.add_argument('input', help="فایل CSV خروجی آموزشیار")
+    p_part.add_argument('output_dir', help="پوشه فایل‌های خروجی")
+    p_part.add_argument('--by', default='term',
+                        help=f"کلیدهای بخش‌بندی جداشده با ویرگول ({', '.join(PARTITION_KEYS)})")
+    p_part.add_argument('--workers', type=int, default=None, help="تعداد پردازش موازی (پیش‌فرض: تعداد هسته‌ها)")
+    p_part.add_argument('--comments', choices=COMMENT_MODES, default=COMMENT_MODE)
+
+    p_rooms = sub.add_parser('rooms', help="کلاس‌های آزاد / اشغال از نمایه اشغال کلاس‌ها")
+    rooms_sub = p_rooms.add_subparsers(dest='action', required=True)
+    r_index = rooms_sub.add_parser('index', help="ساخت نمایه از فایل CSV خروجی آموزشیار")
+    r_index.add_argument('input', help="فایل CSV خروجی آموزشیار")
+    r_index.add_argument('--out', help=f"مسیر نمایه (پیش‌فرض: کنار فایل ورودی با پسوند {ROOM_INDEX_SUFFIX})")
+    r_free = rooms_sub.add_parser('free', help="کلاس‌های آزاد در یک بازه")
+    r_busy = rooms_sub.add_parser('busy', help="بازه‌های اشغال یک کلاس")
+    r_first = rooms_sub.add_parser('first-free', help="اولین زمان آزاد به طول مشخص برای هر کلاس")
+    for p_query in (r_free, r_busy, r_first):
+        p_query.add_argument('index', help="فایل نمایه")
+        p_query.add_argument('--day', required=True)
+        p_query.add_argument('--week', choices=WEEK_PARITIES, default=None, help="فقط هفته‌های فرد یا زوج")
+    r_free.add_argument('--from', dest='start', required=True, help="مثلاً 10:00")
+    r_free.add_argument('--to', dest='end', required=True, help="مثلاً 12:00")
+    r_busy.add_argument('--room', required=True)
+    r_first.add_argument('--length', type=int, required=True, help="طول به دقیقه")
+    r_first.add_argument('--after', default=None, help="زودتر از این ساعت نباشد")
+    r_first.add_argument('--room', action='append', dest='rooms', help="فقط این کلاس (قابل تکرار)")
+
+    p_ical = sub.add_parser('ical', help="فایل تقویم (ics) برای هر استاد و هر کلاس")
+    p_ical.add_argument('input', help="فایل CSV خروجی آموزشیار")
+    p_ical.add_argument('output_dir', help="پوشه فایل‌های ics")
+    p_ical.add_argument('--term-start', required=True, help="تاریخ شروع نیم‌سال، مثلاً 1404/07/01 یا 2025-09-23")
+    p_ical.add_argument('--weeks', type=int, default=ICAL_TERM_WEEKS, help="تعداد هفته‌های نیم‌سال")
+    p_ical.add_argument('--feeds', default=','.join(ICAL_FEEDS), help="teacher، room یا هر دو (جداشده با ویرگول)")
+
+    p_search = sub.add_parser('search', help="جست‌وجوی درس، استاد، کد یا مکان در جدول")
+    p_search.add_argument('source', help=f"فایل خروجی آموزشیار (CSV/XLSX) یا نمایه {SEARCH_INDEX_SUFFIX}")
+    p_search.add_argument('query', nargs='+', help="عبارت جست‌وجو (هر واژه می‌تواند ابتدای یک واژه باشد)")
+    p_search.add_argument('--field', choices=SEARCH_FIELDS, default=None, help="فقط در این فیلد")
+    p_search.add_argument('--day', default=None)
+    p_search.add_argument('--limit', type=int, default=SEARCH_LIMIT, help="حداکثر نتیجه (0: همه)")
+
+    p_diff = sub.add_parser('diff', help="گزارش تغییرات جلسه‌ها بین دو خروجی آموزشیار")
+    p_diff.add_argument('old', help="فایل CSV قبلی")
+    p_diff.add_argument('new', help="فایل CSV جدید")
+    p_diff.add_argument('output', help="فایل گزارش (.xlsx یا .csv)")
+
+    p_watch = sub.add_parser('watch', help="تبدیل خودکار فایل‌های CSV جدید یا تغییرکرده یک پوشه")
+    p_watch.add_argument('directory', help="پوشه‌ای که خروجی‌های آموزشیار در آن قرار می‌گیرند")
+    p_watch.add_argument('--workers', type=int, default=None, help="تعداد تبدیل هم‌زمان (پیش‌فرض: تعداد هسته‌ها)")
+    p_watch.add_argument('--interval', type=float, default=WATCH_INTERVAL, help="ثانیه بین دو بررسی")
+    p_watch.add_argument('--debounce', type=float, default=WATCH_DEBOUNCE,
+                         help="ثانیه‌هایی که فایل باید بدون تغییر بماند")
+    p_watch.add_argument('--comments', choices=COMMENT_MODES, default=COMMENT_MODE)
+
+    p_golden = sub.add_parser('golden', help="مقایسه خروجی این نسخه با یک نسخه مرجع")
+    p_golden.add_argument('inputs', nargs='*', help="فایل‌های CSV (خروجی واقعی ناشناس‌شده)")
+    p_golden.add_argument('--reference', default='HEAD', help="مسیر فایل یا نسخه git نسخه مرجع (پیش‌فرض: HEAD)")
+    p_golden.add_argument('--front', choices=GOLDEN_FRONTS, default='cli')
+    p_golden.add_argument('--synthetic', type=int, nargs='*', default=None, metavar='ROWS',
+                          help="ورودی‌های مصنوعی با این تعداد ردیف (پیش‌فرض بدون ورودی: 300 و 3000)")
+    p_golden.add_argument('--sheets', default=None, help="فقط شیت‌هایی که با این عبارت شروع می‌شوند")
+    p_golden.add_argument('--workdir', default=None, help="پوشه نگهداری خروجی‌ها برای بررسی")
+
+    p_serve = sub.add_parser('serve', help="اجرای نسخه وب و رابط HTTP (بدون پنجره Tk)")
+    p_serve.add_argument('--host', default=os.environ.get('GRADIO_SERVER_NAME', '127.0.0.1'))
+    p_serve.add_argument('--port', type=int, default=int(os.environ.get('GRADIO_SERVER_PORT', 7860)))
+    return parser
+
+def run_command(argv):
+    """Command-line mode (no dialogs); without arguments main() runs the graphical flow"""
+    parser = command_parser()
+    args = parser.parse_args(argv)
+    configure_logging(args.log_mode, rate=args.log_rate, sample=args.log_sample)
+    if args.no_cache:
+        global CHECKPOINT_ENABLED
+        CHECKPOINT_ENABLED = False
+    if args.template_dir:
+        global TEMPLATE_DIR
+        TEMPLATE_DIR = args.template_dir
+    if args.room_catalogue:
+        global ROOM_CATALOGUE_FILE
+        ROOM_CATALOGUE_FILE = args.room_catalogue
+    if args.assign_rooms:
+        global ASSIGN_ROOMS
+        ASSIGN_ROOMS = True
+    if args.command == 'golden':
+        return run_golden_command(args)
+    if args.command == 'serve':
+        return serve(args.host, args.port)
+    if args.command == 'watch':
+        watch_folder(args.directory, workers=args.workers, comment_mode=args.comments,
+                     interval=args.interval, debounce=args.debounce)
+        return 0
+    if args.command == 'rooms':
+        return run_rooms_command(args)
+    if args.command == 'convert':
+        if args.profile:
+            global PIPELINE_TRACE_MEMORY
+            PIPELINE_TRACE_MEMORY = True
+        try:
+            ctx = convert_export(args.input, args.output, args.comments, skip=args.skip)
+        except PipelineError as e:   # raised before any stage runs
+            parser.error(str(e))
+        if args.profile:
+            for stat in ctx['stats']:
+                memory = '' if stat['memory'] is None else f"{stat['memory'] / 1048576:+8.1f} MB"
+                peak = '' if stat['peak'] is None else f"{stat['peak'] / 1048576:8.1f} MB"
+                print(f"{stat['stage']:<10} {stat['seconds']:8.3f} s  {memory}  {peak}")
+        if not ctx.get('saved'):
+            print("ℹ️ مرحله save اجرا نشد؛ فایل خروجی ذخیره نشد")
+            return 0
+        print(f"✅ {args.output}")
+        return 0
+    if args.command == 'search':
+        results = search_schedule(search_index_for(args.source), ' '.join(args.query), args.field, args.day, args.limit)
+        for p in results:
+            week = f" ({p['week']})" if p['week'] else ""
+            print(f"{p['day']}  {p['start']}-{p['end']}{week}  {p['room'] or '—'}  "
+                  f"{p['course']} — {p['teacher']} [{p['code']}]  {p['sheet']}!{p['cell']}")
+        return 0 if results else 1
+    if args.command == 'diff':
+        tables = [load_course_table(path)[0] for path in (args.old, args.new)]
+        changes = diff_exports(*tables)
+        write_diff_report(changes, args.output)
+        counts = changes['نوع'].value_counts()
+        print('، '.join(f"{DIFF_KINDS[kind]}: {int(counts.get(kind, 0))}" for kind in DIFF_KINDS))
+        print(f"📑 گزارش: {args.output}")
+        return 0
+    if args.command == 'ical':
+        feeds = [f.strip() for f in args.feeds.split(',') if f.strip()]
+        unknown = set(feeds) - set(ICAL_FEEDS)
+        if unknown:
+            parser.error(f"فید نامعتبر: {', '.join(sorted(unknown))}")
+        df_selected, _ = load_course_table(args.input)
+        df_selected = apply_room_assignment(df_selected)
+        written = export_ical(df_selected, args.output_dir, parse_term_start(args.term_start), args.weeks, feeds)
+        for feed, count in written.items():
+            print(f"📅 {ICAL_FEEDS[feed][1]}: {count} فایل در {os.path.join(args.output_dir, ICAL_FEEDS[feed][1])}")
+        return 0
+    if args.command == 'partition':
+        partition_by = [k.strip() for k in args.by.split(',') if k.strip()]
+        results, index_path = convert_partitioned(args.input, args.output_dir, partition_by,
+                                                  workers=args.workers, comment_mode=args.comments)
+        for res in results:
+            print(f"✅ {res['name']}: {res['path']}")
+        print(f"📑 فهرست: {index_path}")
+    return 0
+
+def run_golden_command(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='class_schedule_golden_')
+    os.makedirs(workdir, exist_ok=True)
+    inputs = list(args.inputs)
+    sizes = args.synthetic if args.synthetic is not None else ([] if inputs else [300, 3000])
+    for rows in sizes:
+        path = os.path.join(workdir, f'synthetic_{rows}.csv')
+        write_synthetic_export(path, rows, seed=rows)
+        inputs.append(path)
+
+    failed = 0
+    for res in golden_compare(args.reference, inputs, args.front, args.sheets, workdir):
+        timing = f"{res['reference']:.2f}s → {res['current']:.2f}s ({res['reference'] / res['current']:.2f}×)"
+        if res['divergence'] is None:
+            print(f"✅ {res['name']}: یکسان  {timing}")
+        else:
+            failed += 1
+            print(f"❌ {res['name']}: {res['divergence']}  {timing}")
+    print(f"📁 خروجی‌ها: {workdir}")
+    return 1 if failed else 0
+
+def run_rooms_command(args):
+    if args.action == 'index':
+        df_selected, _ = load_course_table(args.input)
+        df_selected = apply_room_assignment(df_selected)
+        path = args.out or os.path.splitext(args.input)[0] + ROOM_INDEX_SUFFIX
+        index = build_room_index(df_selected)
+        save_json_index(index, path)
+        LOG.info("🏫 %d کلاس: %s", len(index['rooms']), path)
+        return 0
+
+    index = load_room_index(args.index)
+    if args.action == 'free':
+        for room in free_rooms(index, args.day, args.start, args.end, args.week):
+            print(room)
+    elif args.action == 'busy':
+        for start, end in busy_intervals(index, args.room, args.day, args.week):
+            print(f"{start} - {end}")
+    else:
+        found = first_free_slot(index, args.day, args.length, args.after, args.rooms, args.week)
+        for room, start in sorted(found.items(), key=lambda item: (item[1], item[0])):
+            print(f"{start}  {room}")
+    return 0
 
 def main():
     """Main function to run the complete process"""
-    print("🎓 برنامه تولید جدول کلاسی")
-    print("=" * 50)
+    # Tk only for the dialogs of this flow: the module itself imports without tkinter or a display
+    import tkinter as tk
+    from tkinter import messagebox
+    configure_logging()
+    LOG.info("🎓 برنامه تولید جدول کلاسی")
+    LOG.info("=" * 50)
     
     # Show welcome message first
     show_welcome_message()
@@ -579,34 +2872,28 @@ def main():
     # Select input CSV file
     input_file = select_input_file()
     if not input_file:
-        print("❌ هیچ فایلی انتخاب نشد.")
+        LOG.warning("❌ هیچ فایلی انتخاب نشد.")
         return
     
-    print(f"📁 فایل ورودی: {input_file}")
+    LOG.info("📁 فایل ورودی: %s", input_file)
     
     # Select output Excel file
     output_file = select_output_file()
     if not output_file:
-        print("❌ محل ذخیره فایل انتخاب نشد.")
+        LOG.warning("❌ محل ذخیره فایل انتخاب نشد.")
         return
     
-    print(f"📁 فایل خروجی: {output_file}")
-    
-    # Create temporary file in system temp directory to avoid access issues
-    temp_file = os.path.join(tempfile.gettempdir(), "temp_schedule_phase1.xlsx")
+    LOG.info("📁 فایل خروجی: %s", output_file)
     
     try:
-        # Phase 1: Extract data from CSV
-        print("\n🔹 مرحله 1: استخراج داده‌ها از فایل CSV...")
-        if not phase1_extract_data(input_file, temp_file):
-            return
+        # Phase 1 (in memory) + phase 2
+        LOG.info("\n🔹 استخراج داده‌ها و ایجاد جداول کلاسی...")
+        stem = os.path.splitext(output_file)[0]
+        convert_export(input_file, output_file, room_index_file=stem + ROOM_INDEX_SUFFIX,
+                       search_index_file=stem + SEARCH_INDEX_SUFFIX)
         
-        # Phase 2: Create schedule tables
-        print("\n🔹 مرحله 2: ایجاد جداول کلاسی...")
-        phase2_create_schedule(temp_file, output_file)
-        
-        print("\n🎉 برنامه با موفقیت به پایان رسید!")
-        print(f"📊 فایل نهایی تولید شد: {output_file}")
+        LOG.info("\n🎉 برنامه با موفقیت به پایان رسید!")
+        LOG.info("📊 فایل نهایی تولید شد: %s", output_file)
         
         # Show success message
         root = tk.Tk()
@@ -614,705 +2901,649 @@ def main():
         messagebox.showinfo("موفق", f"برنامه با موفقیت اجرا شد!\nفایل نهایی: {os.path.basename(output_file)}")
         
     except Exception as e:
-        print(f"❌ خطا در اجرای برنامه: {e}")
+        LOG.error("❌ خطا در اجرای برنامه: %s", e)
         
         # Show error message
         root = tk.Tk()
         root.withdraw()
         messagebox.showerror("خطا", f"خطا در اجرای برنامه:\n{str(e)}")
-        
-    finally:
-        # Clean up temporary file if it exists
-        if os.path.exists(temp_file):
-            try:
-                # Make sure the file is closed before deleting
-                import gc
-                gc.collect()
-                os.remove(temp_file)
-                print(f"✅ فایل موقت پاک شد: {temp_file}")
-            except Exception as e:
-                print(f"⚠️ نتوانست فایل موقت را پاک کند: {e}")
 
-if __name__ == "__main__":
-    main()import gradio as gr
-import pandas as pd
-import tempfile
-import os
-import io
-import hashlib
-from math import ceil
-from openpyxl import load_workbook, Workbook
-from openpyxl.utils import get_column_letter
-from openpyxl.comments import Comment
-from openpyxl.styles import Alignment, Font, PatternFill
-import re
-import atexit
-import glob
+# ==== نسخه وب (Gradio) و رابط HTTP ====
+# gradio، fastapi و uvicorn فقط در create_app / serve بارگذاری می‌شوند: import این ماژول (آزمون‌ها، پردازه‌های
+# تبدیل) هیچ برنامه وب، پوشه موقت یا پردازه‌ای نمی‌سازد و برنامه پس از خواندن گزینه‌های خط فرمان ساخته می‌شود.
+
+# فایل‌های دانلود: پوشه هر فایل نام هش محتوای آن است (خروجی یکسان ← نشانی و ETag یکسان)؛
+# پوشه‌هایی که DOWNLOAD_TTL استفاده نشده‌اند حذف می‌شوند
+DOWNLOAD_DIR = None   # با اولین دانلود ساخته و هنگام خروج حذف می‌شود
+DOWNLOAD_TTL = 15 * 60   # seconds
+DOWNLOAD_NAME = "جدول_کلاسی_نهایی.xlsx"
+_download_lock = threading.Lock()
+
+def download_dir():
+    """DOWNLOAD_DIR, created (and registered for removal at exit) on first use"""
+    global DOWNLOAD_DIR
+    with _download_lock:
+        if DOWNLOAD_DIR is None:
+            DOWNLOAD_DIR = tempfile.mkdtemp(prefix='class_schedule_downloads_')
+            atexit.register(shutil.rmtree, DOWNLOAD_DIR, ignore_errors=True)
+    return DOWNLOAD_DIR
 
-def cleanup_temp_files():
-    """Clean up any remaining temporary files"""
-    temp_files = glob.glob("/tmp/*_final.xlsx") + glob.glob("/tmp/*_phase1.xlsx")
-    for temp_file in temp_files:
+def save_download(data, filename=DOWNLOAD_NAME, etag=None):
+    """Hand the finished workbook bytes to Gradio as a file in a content-addressed folder
+
+    The file keeps OUTPUT_TIMESTAMP as its mtime, so the ETag / Last-Modified the
+    file route derives from it stay the same for the same bytes and browsers
+    revalidate with "not modified" instead of downloading again.
+    """
+    now, root = time.time(), download_dir()
+    for entry in os.scandir(root):
+        if now - entry.stat().st_mtime > DOWNLOAD_TTL:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    folder = os.path.join(root, (etag or content_etag(data)).strip('"'))
+    path = os.path.join(folder, filename)
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        stamp = OUTPUT_TIMESTAMP.timestamp()
+        os.utime(path, (stamp, stamp))
+    os.utime(folder)   # still in use: restart its TTL
+    return path
+
+def upload_job(func):
+    """Job over one upload returning (result, name): failures become (None, error message)"""
+    @functools.wraps(func)
+    def job(file, comment_mode=COMMENT_MODE, assign=None):
         try:
-            if os.path.exists(temp_file):
-                os.unlink(temp_file)
-                print(f"🧹 Cleaned up: {temp_file}")
+            return func(file, comment_mode, assign)
+        except MemoryError:
+            LOG.error("❌ Memory budget exceeded in %s", func.__name__)
+            return None, "حافظه مجاز برای این فایل کافی نبود"
         except Exception as e:
-            print(f"⚠️ Could not clean up {temp_file}: {e}")
+            LOG.exception("❌ Error in %s: %s", func.__name__, e)
+            return None, f"خطا: {str(e)}"
+    return job
 
-# Register cleanup function
-atexit.register(cleanup_temp_files)
+def convert_in_memory(file, comment_mode, assign):
+    """Workbook bytes of the uploaded file and its schedule grid"""
+    LOG.info("🔹 Starting file processing...")
+    final_buffer = io.BytesIO()
+    ctx = convert_export(file, final_buffer, comment_mode, assign)
+    LOG.info("✅ Processing complete. %d bytes", final_buffer.tell())
+    return final_buffer.getvalue(), ctx['grid']
 
-def extract_time_from_calendar(calendar_text):
-    """Extract start time from تقويم كلاس درس column"""
-    if pd.isna(calendar_text) or not calendar_text:
-        return None
-    
-    calendar_str = str(calendar_text).strip()
-    
-    # Pattern to match time in format "HH:MM تا HH:MM"
-    time_pattern = r'(\d{1,2}:\d{2})\s*تا\s*\d{1,2}:\d{2}'
-    match = re.search(time_pattern, calendar_str)
-    
-    if match:
-        return match.group(1)  # Return the start time
-    
-    return None
+@upload_job
+def process_file(file, comment_mode, assign):
+    """Process the uploaded file in memory and return the workbook bytes"""
+    return convert_in_memory(file, comment_mode, assign)[0], DOWNLOAD_NAME
 
-def phase1_extract_data(input_file, temp_output_file):
-    """Phase 1: Extract important data from CSV and save to Excel"""
-    try:
-        print("🔹 Phase 1: Starting data extraction...")
-        
-        # Read the uploaded file
-        if hasattr(input_file, 'name'):  # Gradio file object
-            file_path = input_file.name
+@upload_job
+def process_file_and_grid(file, comment_mode, assign):
+    """process_file that also returns the grid the search index is built from: ((bytes, grid), name)"""
+    return convert_in_memory(file, comment_mode, assign), DOWNLOAD_NAME
+
+GRID_STAGES = ('ingest', 'normalise', 'backfill', 'partition', 'place')
+
+@upload_job
+def process_grid(file, comment_mode, assign):
+    """The schedule grid of the uploaded file (see schedule_grid), as process_file returns its bytes"""
+    return run_pipeline({'source': file, 'assign': assign}, GRID_STAGES)['grid'], None
+
+@upload_job
+def process_search_index(file, comment_mode, assign):
+    """The search index of the uploaded file (see build_search_index), as process_grid"""
+    ctx = run_pipeline({'source': file, 'assign': assign}, GRID_STAGES)
+    return build_search_index(ctx['table'], ctx['grid']), None
+
+# ==== پذیرش آپلودها و بودجه منابع ====
+# پیش از پردازش کامل، سرآیند فایل بررسی و تعداد ردیف از روی حجم تخمین زده می‌شود؛ هر تبدیل در
+# پردازه جدا با سقف زمان و حافظه اجرا می‌شود و مجموع حافظه کارهای هم‌زمان از MEMORY_BUDGET بیشتر نمی‌شود.
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+MAX_UPLOAD_ROWS = 100_000
+MAX_XLSX_EXPANDED_BYTES = 512 * 1024 * 1024   # حجم باز‌شده اعضای zip (در برابر zip bomb)
+JOB_TIME_LIMIT = 300                          # ثانیه
+JOB_MEMORY_LIMIT = 1536 * 1024 * 1024         # سقف حافظه هر تبدیل
+JOB_MEMORY_BASE = 64 * 1024 * 1024            # تخمین حافظه: پایه + ردیف × هزینه هر ردیف
+JOB_BYTES_PER_ROW = 16 * 1024
+MEMORY_BUDGET = 3 * 1024 * 1024 * 1024        # مجموع حافظه تبدیل‌های هم‌زمان
+QUEUE_TIMEOUT = 120                           # حداکثر انتظار در صف (ثانیه)
+SNIFF_BYTES = 64 * 1024
+XLSX_BYTES_PER_ROW = 1500                     # وقتی شیت بُعد (dimension) ندارد
+_DIMENSION_RE = re.compile(rb'<(?:\w+:)?dimension ref="[A-Z]+\d+(?::[A-Z]+(\d+))?"')
+
+class AdmissionError(ValueError):
+    """Raised when an upload is refused before (or instead of) being converted"""
+
+class ServerBusyError(AdmissionError):
+    """Raised when an admitted upload waited QUEUE_TIMEOUT without getting its memory"""
+
+def sniff_upload(data):
+    """Cheap checks of an upload: {'kind', 'bytes', 'rows' (estimated), 'memory' (estimated)}
+
+    Only the header / archive directory is parsed; raises AdmissionError (or
+    SchemaError for a CSV header without the required columns).
+    """
+    size = len(data)
+    if size > MAX_UPLOAD_BYTES:
+        raise AdmissionError(f"حجم فایل ({size // 1048576} مگابایت) بیش از حد مجاز ({MAX_UPLOAD_BYTES // 1048576} مگابایت) است")
+    if not size:
+        raise AdmissionError("فایل خالی است")
+
+    if data[:4] == XLSX_MAGIC:
+        kind = 'xlsx'
+        try:
+            archive = zipfile.ZipFile(io.BytesIO(data))
+            members = archive.infolist()
+        except zipfile.BadZipFile:
+            raise AdmissionError("فایل xlsx معتبر نیست")
+        if sum(m.file_size for m in members) > MAX_XLSX_EXPANDED_BYTES:
+            raise AdmissionError("محتوای باز‌شده فایل xlsx بیش از حد مجاز است")
+        sheets = [m for m in members if m.filename.startswith('xl/worksheets/') and m.filename.endswith('.xml')]
+        if not sheets:
+            raise AdmissionError("فایل xlsx هیچ شیتی ندارد")
+        sheet = min(sheets, key=lambda m: m.filename)
+        with archive.open(sheet) as f:
+            match = _DIMENSION_RE.search(f.read(4096))
+        if match and match.group(1):
+            rows = int(match.group(1)) - 1
         else:
-            file_path = input_file
-            
-        print(f"🔹 Reading file: {file_path}")
-        
-        # Determine file type and read
-        if file_path.endswith('.csv'):
-            df = pd.read_csv(file_path, encoding='utf-8-sig')
-            print("✅ CSV file read successfully")
+            rows = sheet.file_size // XLSX_BYTES_PER_ROW
+    else:
+        kind = 'csv'
+        head = data[:SNIFF_BYTES].decode('utf-8-sig', errors='replace')
+        lines = head.splitlines()
+        if not lines:
+            raise AdmissionError("سطر عنوان فایل CSV پیدا نشد")
+        validate_header(next(csv.reader([lines[0]])))
+        sample = lines[1:-1] if len(data) > SNIFF_BYTES else lines[1:]
+        if sample:
+            per_row = sum(len(line.encode('utf-8')) + 1 for line in sample) / len(sample)
+            rows = int((size - len(lines[0].encode('utf-8'))) / per_row)
         else:
-            df = pd.read_excel(file_path)
-            print("✅ Excel file read successfully")
-        
-        print(f"✅ File read successfully. Rows: {len(df)}, Columns: {len(df.columns)}")
-        
-        # ==== انتخاب ستون‌ها بر اساس شماره ====
-        selected_columns = {
-            'نام درس': 2,           # C
-            'کد ارائه درس': 0,      # A
-            'واحد نظری': 11,        # L
-            'واحد عملی': 12,        # M
-            'مکان': 22,             # W
-            'گروه آموزشی': 43,      # AR
-            'مقطع': 53,             # BB
-            'تعداد ثبت نامی': 57,   # BF
-            'نیم‌سال': 59,          # BH
-            'نام استاد': 68,        # BQ
-            'رشته': 70,             # BS
-            'روز': 72,              # BU
-            'ساعت شروع': 73,        # BV
-            'ساعت پایان': 74,       # BW
-            'تقويم كلاس درس': 71   # BT - برای استخراج زمان‌های خالی
-        }
-        
-        # ==== استخراج فقط ستون‌های مورد نیاز ====
-        df_selected = df.iloc[:, list(selected_columns.values())].copy()
-        df_selected.columns = list(selected_columns.keys())
-        
-        # ==== پر کردن ساعت‌های شروع خالی از ستون تقويم كلاس درس ====
-        print("🔹 Checking for empty start times...")
-        empty_start_count = df_selected['ساعت شروع'].isna().sum()
-        empty_start_count += (df_selected['ساعت شروع'] == '').sum()
-        print(f"🔹 Found {empty_start_count} empty start times")
-        
-        if empty_start_count > 0:
-            print("🔹 Filling empty start times from تقويم كلاس درس column...")
-            filled_count = 0
-            
-            for idx, row in df_selected.iterrows():
-                start_time = str(row['ساعت شروع']).strip() if pd.notna(row['ساعت شروع']) else ""
-                calendar_text = row['تقويم كلاس درس']
-                
-                # If start time is empty but we have calendar data
-                if not start_time and pd.notna(calendar_text) and str(calendar_text).strip():
-                    extracted_time = extract_time_from_calendar(calendar_text)
-                    if extracted_time:
-                        df_selected.at[idx, 'ساعت شروع'] = extracted_time
-                        filled_count += 1
-                        print(f"   ↳ Filled row {idx}: {extracted_time}")
-            
-            print(f"✅ Filled {filled_count} empty start times from calendar data")
-        
-        # ==== پاکسازی و نرمال‌سازی ====
-        def normalize_text(s):
-            return (
-                str(s)
-                .replace('\u200c', '')   # حذف نیم‌فاصله
-                .replace('ي', 'ی')       # ی عربی → فارسی
-                .replace('ك', 'ک')       # ک عربی → فارسی
-                .replace('‌', '')        # حذف ZWNJ اضافی
-                .strip()
-            )
-        
-        df_selected = df_selected.fillna("").astype(str)
-        df_selected['روز'] = df_selected['روز'].apply(normalize_text)
-        
-        # ==== نگاشت دقیق اسامی روزها ====
-        day_map = {
-            'شنبه': 'شنبه',
-            'یکشنبه': 'یکشنبه',
-            'يکشنبه': 'یکشنبه',
-            'يكشنبه': 'یکشنبه',
-            'یكشنبه': 'یکشنبه',
-            'دوشنبه': 'دوشنبه',
-            'سه شنبه': 'سه‌شنبه',
-            'سه‌شنبه': 'سه‌شنبه',
-            'چهارشنبه': 'چهارشنبه',
-            'چهار شنبه': 'چهارشنبه',
-            'پنجشنبه': 'پنج‌شنبه',
-            'پنج شنبه': 'پنج‌شنبه',
-            'پنج‌شنبه': 'پنج‌شنبه',
-            'پنچشنبه': 'پنج‌شنبه',
-            'پنچ شنبه': 'پنج‌شنبه',
-            'جمعه': 'جمعه'
-        }
-        
-        df_selected['روز'] = df_selected['روز'].apply(
-            lambda x: day_map[x] if x in day_map else x
-        )
-        
-        # ==== لیست روزهای معتبر ====
-        days = ['شنبه', 'یکشنبه', 'دوشنبه', 'سه‌شنبه', 'چهارشنبه', 'پنج‌شنبه', 'جمعه']
-        
-        # ==== تقسیم داده‌ها به شیت‌های مجزا و مرتب‌سازی ====
-        sheets = {}
-        for day in days:
-            subset = df_selected[df_selected['روز'] == day].copy()
-            if not subset.empty:
-                # مرتب‌سازی بر اساس ساعت شروع
-                # تبدیل ساعت شروع به عدد برای مرتب‌سازی
-                def time_to_sortable(time_str):
-                    if not time_str or str(time_str).strip() == "":
-                        return 0
-                    try:
-                        # تبدیل زمان به دقیقه از ابتدای روز
-                        time_str = str(time_str).strip()
-                        time_str = time_str.translate(str.maketrans('۰۱۲۳۴۵۶۷۸۹', '0123456789'))
-                        if ':' in time_str:
-                            parts = time_str.split(':')
-                            hours = int(parts[0])
-                            minutes = int(parts[1]) if len(parts) > 1 else 0
-                            return hours * 60 + minutes
-                        else:
-                            # اگر فقط عدد باشد (مثلاً "8")
-                            return int(time_str) * 60
-                    except:
-                        return 0
-                
-                subset['ساعت شروع مرتب'] = subset['ساعت شروع'].apply(time_to_sortable)
-                subset = subset.sort_values(by='ساعت شروع مرتب', ascending=True).drop(columns=['ساعت شروع مرتب'])
-                sheets[day] = subset
-        
-        # ==== داده‌های با روز نامشخص ====
-        unknown = df_selected[~df_selected['روز'].isin(days)]
-        if not unknown.empty:
-            sheets['نامشخص'] = unknown
-        
-        # ==== ذخیره در فایل اکسل ====
-        with pd.ExcelWriter(temp_output_file, engine='openpyxl') as writer:
-            for day, subset in sheets.items():
-                # حذف ستون تقويم كلاس درس از خروجی نهایی
-                subset_to_save = subset.drop(columns=['تقويم كلاس درس'], errors='ignore')
-                subset_to_save.to_excel(writer, sheet_name=day[:30], index=False)
-        
-        print("✅ فایل اکسل موقت ساخته شد")
+            rows = 0
+
+    if rows > MAX_UPLOAD_ROWS:
+        raise AdmissionError(f"تعداد ردیف‌ها (حدود {rows}) بیش از حد مجاز ({MAX_UPLOAD_ROWS}) است")
+    memory = JOB_MEMORY_BASE + rows * JOB_BYTES_PER_ROW
+    if memory > JOB_MEMORY_LIMIT:
+        raise AdmissionError("این فایل برای پردازش روی این سرور بیش از حد بزرگ است")
+    return {'kind': kind, 'bytes': size, 'rows': rows, 'memory': memory}
+
+class MemoryScheduler:
+    """First-come first-served admission of jobs against a shared memory budget (bytes)"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.waiting = deque()
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, amount, timeout=None):
+        amount = min(amount, self.budget)   # a job alone always fits
+        ticket = object()
+        with self.cond:
+            self.waiting.append(ticket)
+            admitted = self.cond.wait_for(
+                lambda: self.waiting[0] is ticket and self.used + amount <= self.budget, timeout)
+            self.waiting.remove(ticket)
+            if admitted:
+                self.used += amount
+            self.cond.notify_all()
+        if not admitted:
+            raise ServerBusyError("سرور مشغول است؛ چند دقیقه بعد دوباره تلاش کنید")
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.used -= amount
+                self.cond.notify_all()
+
+MEMORY_SCHEDULER = MemoryScheduler(MEMORY_BUDGET)
+
+# پردازه‌های تبدیل از fork سرور وب (با نخ‌ها و قفل‌های باز) ساخته نمی‌شوند: forkserver که این ماژول و
+# کتابخانه‌هایش را یک بار بارگذاری کرده و هر کار را از روی آن می‌سازد، یا در ویندوز spawn. تابع کار باید
+# با نام ماژول (class_schedule، یا __main__ که هر پردازه دوباره اجرا می‌کند) قابل import باشد.
+# کتابخانه‌ها با نام بارگذاری می‌شوند چون forkserver پایتون 3.11 مسیر __main__ و sys.path را نمی‌گیرد؛
+# بخش وب در پردازه‌های تبدیل بارگذاری نمی‌شود.
+JOB_PRELOAD = ['pandas', 'numpy', 'openpyxl']
+JOB_CONTEXT = None   # در اولین استفاده (job_context) انتخاب می‌شود
+
+def job_context():
+    """Multiprocessing context of the conversion jobs, configured on first use"""
+    global JOB_CONTEXT
+    if JOB_CONTEXT is None:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(list(dict.fromkeys(['__main__', __name__] + JOB_PRELOAD)))
+        else:
+            context = multiprocessing.get_context('spawn')
+        JOB_CONTEXT = context
+    return JOB_CONTEXT
+
+def start_job_server():
+    """Start the forkserver (and its preload) now rather than on the first upload"""
+    context = job_context()
+    if context.get_start_method() == 'forkserver':
+        proc = context.Process(target=os.getpid, daemon=True)
+        proc.start()
+        proc.join()
+
+# تنظیمات خط فرمان (مثلاً serve --assign-rooms) که پردازه تبدیل، با ماژولی که دوباره بارگذاری کرده، از سرور می‌گیرد
+JOB_SETTINGS = ('ROOM_CATALOGUE_FILE', 'TEMPLATE_DIR', 'ASSIGN_ROOMS', 'LOG_SETTINGS')
+
+def job_settings():
+    """Current values of JOB_SETTINGS, handed to each isolated job"""
+    return {name: globals()[name] for name in JOB_SETTINGS}
+
+def _isolated_job(conn, job, data, comment_mode, assign, memory_limit, settings):
+    """Child process: apply the server settings and logging, cap the address space, run job, send its (result, name / error) back"""
+    globals().update(settings)
+    configure_logging(*LOG_SETTINGS)
+    try:
+        import resource
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[0]) * resource.getpagesize()
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        limit = current + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    except (ImportError, OSError, ValueError):
+        pass   # no per-process memory cap on this platform; the time limit still applies
+    # uploads of other users never go to (or come from) the on-disk checkpoints
+    global CHECKPOINT_ENABLED
+    CHECKPOINT_ENABLED = False
+    conn.send(job(data, comment_mode, assign))
+    conn.close()
+
+def run_isolated(data, comment_mode=COMMENT_MODE, assign=None,
+                 time_limit=JOB_TIME_LIMIT, memory_limit=JOB_MEMORY_LIMIT, job=process_file):
+    """job (process_file or process_grid) in a separate process, cancelled when it exceeds its budgets"""
+    context = job_context()
+    receiver, sender = context.Pipe(duplex=False)
+    proc = context.Process(target=_isolated_job, daemon=True,
+                           args=(sender, job, data, comment_mode, assign, memory_limit, job_settings()))
+    proc.start()
+    sender.close()
+    try:
+        if not receiver.poll(time_limit):
+            raise AdmissionError(f"پردازش بیش از {time_limit} ثانیه طول کشید و متوقف شد")
+        return receiver.recv()
+    except EOFError:
+        raise AdmissionError("پردازش این فایل ناتمام ماند (احتمالاً به دلیل کمبود حافظه)")
+    finally:
+        if proc.is_alive():
+            proc.terminate()
+            proc.join(5)
+            if proc.is_alive():
+                proc.kill()
+        proc.join()
+        receiver.close()
+
+def convert_upload(data, comment_mode=COMMENT_MODE, assign=None, job=process_file):
+    """Admission-controlled conversion of one upload: sniff, wait for memory, run isolated"""
+    info = sniff_upload(data)
+    LOG.info("🔹 Upload admitted: %s, ~%d rows, ~%d MB", info['kind'], info['rows'], info['memory'] // 1048576)
+    with MEMORY_SCHEDULER.reserve(info['memory'], QUEUE_TIMEOUT):
+        return run_isolated(data, comment_mode, assign, job=job)
+
+# ==== رابط HTTP/JSON برای سامانه‌های دیگر ====
+# POST /api/convert  یک یا چند فایل (multipart، فیلد files): یک فایل ← xlsx، چند فایل ← zip جریانی
+# POST /api/grid     جدول محاسبه‌شده یک فایل به صورت JSON (در صورت نیاز فقط یک روز)
+# GET  /api/status   وضعیت بودجه حافظه و صف
+# فایل‌های یک درخواست هم‌زمان و از همان مسیر پذیرش رابط وب (sniff_upload و MEMORY_SCHEDULER) تبدیل می‌شوند؛
+# هر فایل تازه در کار خودش از فایل موقت آپلود خوانده می‌شود.
+API_PREFIX = '/api'
+API_MAX_FILES = 20
+API_MAX_REQUEST_BYTES = 4 * MAX_UPLOAD_BYTES   # کل بدنه یک درخواست، پیش از خواندن آن
+API_WORKERS = 8          # تبدیل‌های هم‌زمان درخواست‌ها؛ حافظه را MEMORY_SCHEDULER محدود می‌کند
+API_KEEP_ALIVE = 30      # ثانیه نگه‌داشتن اتصال بیکار
+XLSX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+BATCH_NAME = 'جدول‌های_کلاسی.zip'
+BATCH_MANIFEST = 'manifest.json'
+
+API_POOL = ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix='api')
+
+def attachment(filename):
+    # نام فارسی در filename* (RFC 6266)؛ filename ساده برای کلاینت‌های قدیمی
+    return {'Content-Disposition': f"attachment; filename=\"schedule{os.path.splitext(filename)[1]}\"; "
+                                   f"filename*=UTF-8''{quote(filename)}"}
+
+def output_name(upload_name, used=None):
+    """Workbook name for an uploaded file, unique within used (which it updates)"""
+    stem = safe_filename(os.path.splitext(os.path.basename(upload_name or ''))[0])
+    name, n = stem + '.xlsx', 1
+    while used is not None and name in used:
+        n += 1
+        name = f"{stem} ({n}).xlsx"
+    if used is not None:
+        used.add(name)
+    return name
+
+def read_upload(upload):
+    # یک بایت بیش از حد مجاز کافی است تا sniff_upload فایل بزرگ را رد کند
+    return upload.file.read(MAX_UPLOAD_BYTES + 1)
+
+def api_job(upload, comment_mode=COMMENT_MODE, assign=None, job=process_file):
+    """convert_upload of one uploaded file, read only now: (result, None, 200) or (None, error message, HTTP status)"""
+    try:
+        result, message = convert_upload(read_upload(upload), comment_mode, assign, job)
+    except ServerBusyError as e:
+        return None, str(e), 503
+    except (AdmissionError, SchemaError) as e:
+        return None, str(e), 422
+    if result is None:
+        return None, message, 422
+    return result, None, 200
+
+class _ZipStream(io.RawIOBase):
+    """Write-only, unseekable sink: ZipFile writes members into it, the response drains it"""
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
         return True
-        
-    except Exception as e:
-        print(f"❌ خطا در فاز اول: {e}")
-        import traceback
-        print(f"🔍 Traceback:\n{traceback.format_exc()}")
-        return False
 
-def phase2_create_schedule(temp_file, final_output_file):
-    """Phase 2: Create class schedule tables from the temporary Excel file"""
-    
-    # Configuration
-    SLOT_MIN = 30   # minutes
-    DAY_START_MIN = 8 * 60  # start at 08:00
-    
-    if not os.path.exists(temp_file):
-        raise FileNotFoundError(f"فایل موقت یافت نشد: {temp_file}")
-    
-    print("در حال خواندن فایل موقت")
-    xls = pd.ExcelFile(temp_file)
-    print("شیت‌های یافت شده:", xls.sheet_names)
-    
-    # helper: normalize time string -> minutes
-    def to_minutes(t):
-        if pd.isna(t) or str(t).strip() == "":
-            return None
-        s = str(t).strip()
-        s = s.translate(str.maketrans('۰۱۲۳۴۵۶۷۸۹','0123456789'))
-        s = s.replace('.', ':').replace('：', ':')
-        # if input like "8" -> "8:00"
-        if ':' not in s and s.isdigit() and len(s) <= 2:
-            try:
-                return int(s) * 60
-            except:
-                return None
-        if ':' in s:
-            parts = s.split(':')
-            try:
-                h = int(parts[0])
-                m = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
-                return h*60 + m
-            except:
-                return None
-        # fallback try digits-only like "0830"
-        if s.isdigit() and len(s) in (3,4):
-            if len(s)==3: s = '0'+s
-            hh = int(s[:-2]); mm = int(s[-2:])
-            return hh*60 + mm
-        return None
-    
-    def minute_label(m):
-        hh = m//60; mm = m%60
-        return f"{hh:02d}:{mm:02d}"
-    
-    # helper: find columns robustly
-    def find_col(df_cols, candidates):
-        for cand in candidates:
-            for c in df_cols:
-                if str(c).strip() == cand:
-                    return c
-        for cand in candidates:
-            for c in df_cols:
-                if cand in str(c):
-                    return c
-        return None
-    
-    # generate consistent light color based on course name
-    def get_light_color(course_name):
-        """Generate a consistent light pastel color based on course name"""
-        if not course_name:
-            return "FFFFFF"
-        # Use hash to get consistent color for same course
-        hash_val = int(hashlib.md5(course_name.encode()).hexdigest()[:8], 16)
-        
-        # Generate pastel colors using HSL technique (light colors)
-        hues = [0, 30, 60, 120, 180, 240, 300]  # Red, Orange, Yellow, Green, Cyan, Blue, Magenta
-        hue = hues[hash_val % len(hues)]
-        
-        # Light pastel colors (high lightness, medium saturation)
-        if hue == 0:    # Red
-            return "FFE6E6"  # Very light red
-        elif hue == 30:  # Orange
-            return "FFE8CC"  # Very light orange
-        elif hue == 60:  # Yellow
-            return "FFF9C4"  # Very light yellow
-        elif hue == 120: # Green
-            return "E6F7E6"  # Very light green
-        elif hue == 180: # Cyan
-            return "E6F7F7"  # Very light cyan
-        elif hue == 240: # Blue
-            return "E6E6FF"  # Very light blue
-        else:           # Magenta
-            return "F7E6F7"  # Very light magenta
-    
-    # build slots globally as needed per sheet (end depends on data)
-    def build_slots(min_start, max_end):
-        # ensure start is DAY_START_MIN
-        start = DAY_START_MIN
-        # round end up to nearest slot
-        end = ((max_end + SLOT_MIN - 1)//SLOT_MIN)*SLOT_MIN
-        if end <= start:
-            end = start + 10 * 60  # fallback to 10 hours
-        return list(range(start, end, SLOT_MIN))
-    
-    # collect which sheets we will build tables for
-    weekday_names = ['شنبه','یکشنبه','دوشنبه','سه‌شنبه','چهارشنبه','پنج‌شنبه','جمعه']
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def stream_batch(names, futures):
+    """ZIP of a batch, in upload order; each workbook is sent as soon as it is converted
+
+    Members are stored (xlsx is already compressed); failed files do not abort the
+    batch but are listed with their error in BATCH_MANIFEST, written last.
+    """
+    sink = _ZipStream()
+    manifest, used = [], set()
+    try:
+        with _FixedTimeZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, future in zip(names, futures):
+                data, message, _ = future.result()
+                if data is None:
+                    manifest.append({'file': name, 'error': message})
+                else:
+                    out = output_name(name, used)
+                    archive.writestr(out, data)
+                    manifest.append({'file': name, 'output': out, 'etag': content_etag(data), 'bytes': len(data)})
+                yield sink.drain()
+            archive.writestr(BATCH_MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+        yield sink.drain()
+    finally:
+        for future in futures:   # client gone: drop the conversions not started yet
+            future.cancel()
+
+def create_api():
+    """FastAPI app of the HTTP API under API_PREFIX; form defaults are read from the current settings"""
+    from fastapi import FastAPI, File, Form, Request, UploadFile
+    from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+    api = FastAPI(title="برنامه جدول کلاسی", docs_url=API_PREFIX + '/docs', openapi_url=API_PREFIX + '/openapi.json')
+
+    def api_error(status, message, headers=None):
+        return JSONResponse({'error': message}, status_code=status, headers=headers)
+
+    @api.middleware('http')
+    async def limit_request_size(request: Request, call_next):
+        """Refuse API uploads without a length or over API_MAX_REQUEST_BYTES before their body is read"""
+        if request.method == 'POST' and request.url.path.startswith(API_PREFIX + '/'):
+            length = request.headers.get('content-length', '')
+            if not length.isdigit():
+                return api_error(411, "طول درخواست (Content-Length) مشخص نیست")
+            if int(length) > API_MAX_REQUEST_BYTES:
+                return api_error(413, f"حجم درخواست بیش از حد مجاز ({API_MAX_REQUEST_BYTES // 1048576} مگابایت) است")
+        return await call_next(request)
+
+    @api.post(API_PREFIX + '/convert')
+    def api_convert(request: Request, files: list[UploadFile] = File(...),
+                    comment_mode: str = Form(COMMENT_MODE), assign: bool = Form(ASSIGN_ROOMS)):
+        """One export -> its workbook (with ETag / If-None-Match); several -> a streamed ZIP"""
+        if comment_mode not in COMMENT_MODES:
+            return api_error(422, f"comment_mode باید یکی از {COMMENT_MODES} باشد")
+        if len(files) > API_MAX_FILES:
+            return api_error(413, f"حداکثر {API_MAX_FILES} فایل در هر درخواست")
+        names = [f.filename or 'export' for f in files]
+
+        if len(files) == 1:
+            result, message, status = api_job(files[0], comment_mode, assign)
+            if result is None:
+                return api_error(status, message, {'Retry-After': '60'} if status == 503 else None)
+            etag = content_etag(result)
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+                return Response(status_code=304, headers=headers)
+            headers.update(attachment(output_name(names[0])))
+            return Response(result, media_type=XLSX_MEDIA_TYPE, headers=headers)
+
+        futures = [API_POOL.submit(api_job, f, comment_mode, assign) for f in files]
+        return StreamingResponse(stream_batch(names, futures),
+                                 media_type='application/zip', headers=attachment(BATCH_NAME))
+
+    @api.post(API_PREFIX + '/grid')
+    def api_grid(file: UploadFile = File(...), assign: bool = Form(ASSIGN_ROOMS), day: str = Form('')):
+        """Rooms x slots of every weekday (or only day) with the classes of each tile"""
+        grid, message, status = api_job(file, COMMENT_MODE, assign, process_grid)
+        if grid is None:
+            return api_error(status, message, {'Retry-After': '60'} if status == 503 else None)
+        if day:
+            day = _query_day(day)
+            if day not in WEEKDAYS:
+                return api_error(422, f"روز نامعتبر: {day}")
+            grid['days'] = {day: grid['days'].get(day, {'slots': [], 'rooms': []})}
+        return grid
+
+    @api.get(API_PREFIX + '/status')
+    def api_status():
+        return {'memory_budget': MEMORY_SCHEDULER.budget, 'memory_used': MEMORY_SCHEDULER.used,
+                'waiting': len(MEMORY_SCHEDULER.waiting), 'max_upload_bytes': MAX_UPLOAD_BYTES,
+                'max_upload_rows': MAX_UPLOAD_ROWS, 'max_files': API_MAX_FILES,
+                'max_request_bytes': API_MAX_REQUEST_BYTES}
+
+    return api
+
+# ==== جست‌وجو در جدول ساخته‌شده ====
+# تبدیل، جدول محاسبه‌شده (grid) را همراه فایل اکسل برمی‌گرداند و برای هر فایل (به ازای محتوا و گزینه
+# پیشنهاد مکان) در حافظه نگه داشته می‌شود؛ نمایه فقط در اولین جست‌وجو از همان جدول ساخته می‌شود.
+SEARCH_CACHE_SIZE = 16
+SEARCH_HEADERS = ['روز', 'ساعت', 'مکان', 'درس', 'استاد', 'کد', 'هفته', 'خانه']
+_search_indexes = OrderedDict()   # کلید ← نمایه، یا جدول محاسبه‌شده تا اولین جست‌وجو
+_search_lock = threading.Lock()
+
+def _search_key(data, assign):
+    return content_etag(data), bool(ASSIGN_ROOMS if assign is None else assign)
+
+def _cache_search(key, value):
+    with _search_lock:
+        _search_indexes[key] = value
+        _search_indexes.move_to_end(key)
+        while len(_search_indexes) > SEARCH_CACHE_SIZE:
+            _search_indexes.popitem(last=False)
+
+def remember_grid(data, assign, grid):
+    """Keep the grid of a converted upload until its first search"""
+    key = _search_key(data, assign)
+    with _search_lock:
+        if 'placements' in _search_indexes.get(key, {}):
+            return   # already indexed
+    _cache_search(key, grid)
+
+def upload_search_index(data, assign=None):
+    """Search index of an upload: cached, built from the grid of its conversion, or converted under admission control"""
+    key = _search_key(data, assign)
+    with _search_lock:
+        cached = _search_indexes.get(key)
+    if cached is not None and 'placements' in cached:
+        index = cached
+    elif cached is not None:
+        index = build_search_index(None, cached)
+    else:
+        index, message = convert_upload(data, COMMENT_MODE, assign, process_search_index)
+        if index is None:
+            raise ValueError(message)
+    _cache_search(key, index)
+    return index
+
+def search_rows(index, query):
+    """Table rows of the placements matching query"""
+    return [[p['day'], f"{p['start']}-{p['end']}", p['room'], p['course'], p['teacher'], p['code'],
+             p['week'], f"{p['sheet']}!{p['cell']}"] for p in search_schedule(index, query)]
+
+def create_ui():
+    """Gradio Blocks of the web app (Persian RTL layout); defaults are read from the current settings"""
+    import gradio as gr
+
+    with gr.Blocks(
+        title="برنامه جدول کلاسی",
+        theme=gr.themes.Soft(),
+        css="""
+        .container {
+            direction: rtl;
+            text-align: right;
+            font-family: Tahoma;
+        }
+        """
+    ) as demo:
     
-    # Load the existing workbook (don't create a new one)
-    wb = load_workbook(temp_file)
+        gr.Markdown("""
+        # 🎓 برنامه تولید جدول کلاسی دانشگاه
+        **نسخه 1 - آبان 1404 - نیماوزیری**
     
-    # remove prior phase2 sheets if they exist (start fresh)
-    for s in wb.sheetnames[:]:
-        if s.startswith("جدول کلاسی "):
-            wb.remove(wb[s])
+        لطفا فایل خروجی آموزشیار (CSV) را آپلود کنید
+        """)
     
-    # iterate through Phase1 weekday sheets
-    for sheet in xls.sheet_names:
-        if sheet not in weekday_names:
-            continue
-        print("در حال پردازش شیت:", sheet)
-        df = pd.read_excel(xls, sheet_name=sheet)
-        if df.empty:
-            print(" -> شیت خالی است، رد شد.")
-            continue
-        
-        # find relevant columns robustly
-        cols = list(df.columns)
-        col_room = find_col(cols, ['مکان','نام مكان','مكان'])
-        col_course = find_col(cols, ['نام درس','نام کلاس درس','نام کلاس'])
-        col_teacher = find_col(cols, ['نام استاد','نام كامل استاد','PR S_FNAME','نام كامل'])
-        col_code = find_col(cols, ['کد ارائه درس','کد ارائه','کد درس'])
-        col_unit_th = find_col(cols, ['واحد نظری','تعداد واحد نظري','تعداد واحد'])
-        col_unit_pr = find_col(cols, ['واحد عملی','تعداد واحد عملي'])
-        col_group = find_col(cols, ['گروه آموزشی','نام گروه آموزشي','گروه'])
-        col_degree = find_col(cols, ['مقطع'])
-        col_reg = find_col(cols, ['تعداد ثبت نامی','تعداد ثبت نامي','تعداد ثبت نام'])
-        col_M = find_col(cols, ['ساعت شروع','ساعت شروع کلاس','M','BV'])
-        col_N = find_col(cols, ['ساعت پایان','ساعت پایان کلاس','N','BW'])
-        
-        if col_room is None:
-            print(" -> ستون 'مکان' یافت نشد، رد شد.")
-            continue
-        
-        # normalize textual columns
-        for c in [col_room, col_course, col_teacher, col_code, col_unit_th, col_unit_pr, col_group, col_degree, col_reg]:
-            if c is not None and c in df.columns:
-                df[c] = df[c].fillna("").astype(str).str.replace('\u200c','').str.strip()
-        # times
-        if col_M in df.columns:
-            df['_M_min'] = df[col_M].apply(to_minutes)
-        else:
-            df['_M_min'] = None
-        if col_N in df.columns:
-            df['_N_min'] = df[col_N].apply(to_minutes)
-        else:
-            df['_N_min'] = None
-        
-        # drop exact duplicates (same code, same room, same times)
-        keycols = [c for c in [col_code, col_course, col_teacher, col_room, col_M, col_N] if c is not None]
-        if keycols:
-            df = df.drop_duplicates(subset=keycols)
-        
-        # determine slots (start at 08:00, end by max end)
-        starts = df['_M_min'].dropna().tolist()
-        ends = df['_N_min'].dropna().tolist()
-        max_end = max(ends) if ends else (20*60)
-        slots = build_slots(DAY_START_MIN, max_end)
-        slot_labels = [minute_label(s) for s in slots]
-        
-        # prepare rooms: one row per unique room (exact string)
-        rooms = df[col_room].fillna("").astype(str).unique().tolist()
-        # build a grid: dict room -> list per slot (None or list of entries)
-        grid = {room: [None]*len(slots) for room in rooms}
-        
-        # fill grid: for each record mark slot indices that fully fit inside [M,N)
-        for idx, row in df.iterrows():
-            room = str(row[col_room])
-            start = row.get('_M_min', None)
-            end = row.get('_N_min', None)
-            if start is None or end is None:
-                continue
-            
-            # find start_idx: first slot s.t. slots[i] <= start < slots[i]+SLOT_MIN
-            start_idx = None
-            for i, s in enumerate(slots):
-                if s <= start < s + SLOT_MIN:
-                    start_idx = i
-                    break
-            if start_idx is None:
-                start_idx = min(range(len(slots)), key=lambda k: abs(slots[k]-start))
-            
-            # end_idx: last index where slot_start + SLOT_MIN <= end (fully contained)
-            end_idx = None
-            for i, s in enumerate(slots):
-                if s + SLOT_MIN <= end:
-                    end_idx = i
-            if end_idx is None or end_idx < start_idx:
-                continue
-            
-            # Create unique entry identifier to avoid duplicates
-            entry_id = f"{row[col_course] if col_course else ''}|{row[col_teacher] if col_teacher else ''}|{row[col_code] if col_code else ''}"
+        with gr.Row():
+            with gr.Column(scale=1):
+                file_input = gr.File(
+                    label="📁 آپلود فایل",
+                    file_types=[".csv", ".xlsx"],
+                    type="binary"
+                )
             
-            # Create entry data
-            entry_data = {
-                'course': row[col_course] if col_course else "",
-                'teacher': row[col_teacher] if col_teacher else "",
-                'code': row[col_code] if col_code else "",
-                'unit_th': row[col_unit_th] if col_unit_th else "",
-                'unit_pr': row[col_unit_pr] if col_unit_pr else "",
-                'group': row[col_group] if col_group else "",
-                'degree': row[col_degree] if col_degree else "",
-                'reg': row[col_reg] if col_reg else "",
-                'M': row[col_M] if col_M else "",
-                'N': row[col_N] if col_N else "",
-                'entry_id': entry_id
-            }
+                comment_mode_input = gr.Radio(
+                    label="💬 توضیحات کاشی‌ها",
+                    choices=[
+                        ("کامنت روی همه کاشی‌ها", "full"),
+                        ("فقط کاشی‌های دارای تداخل", "conflicts"),
+                        ("بدون کامنت (شیت جزئیات)", "none")
+                    ],
+                    value=COMMENT_MODE
+                )
             
-            # assign entry to each slot in range
-            for k in range(start_idx, end_idx+1):
-                if grid[room][k] is None:
-                    grid[room][k] = []
-                
-                # Check if this exact entry already exists to avoid duplicates
-                existing_entry_ids = [e['entry_id'] for e in grid[room][k]]
-                if entry_id not in existing_entry_ids:
-                    grid[room][k].append(entry_data)
-        
-        # Create phase2 sheet
-        out_name = f"جدول کلاسی {sheet}"
-        out_name = out_name[:31]
-        ws = wb.create_sheet(title=out_name)
-        
-        # Title row merged
-        total_cols = 1 + len(slot_labels)
-        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=total_cols)
-        title_cell = ws.cell(row=1, column=1, value=f"جدول کلاسی {sheet}")
-        title_cell.font = Font(size=14, bold=True)
-        title_cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # header row (slot labels) in row 2
-        ws.cell(row=2, column=1, value="مکان / ساعت").font = Font(bold=True)
-        for j, lbl in enumerate(slot_labels, start=2):
-            c = ws.cell(row=2, column=j, value=lbl)
-            c.alignment = Alignment(horizontal="center", vertical="center")
-            c.font = Font(size=9)
-        
-        # write room rows beginning at row 3
-        start_row = 3
-        for i, room in enumerate(rooms):
-            r = start_row + i
-            ws.cell(row=r, column=1, value=room)
-            ws.cell(row=r, column=1).alignment = Alignment(horizontal="center", vertical="center")
-            ws.row_dimensions[r].height = 22
+                assign_input = gr.Checkbox(
+                    label="🏷️ پیشنهاد مکان برای کلاس‌های بدون مکان یا دارای تداخل",
+                    value=ASSIGN_ROOMS
+                )
             
-            # merge contiguous slots with same content
-            j = 0
-            while j < len(slots):
-                cell_entries = grid[room][j]
-                if not cell_entries:
-                    j += 1
-                    continue
-                
-                # Find contiguous slots with identical content
-                k = j
-                while k+1 < len(slots) and grid[room][k+1] == cell_entries:
-                    k += 1
-                
-                excel_start = 2 + j
-                excel_end = 2 + k
-                
-                # Merge cells
-                if excel_end > excel_start:
-                    ws.merge_cells(start_row=r, start_column=excel_start, end_row=r, end_column=excel_end)
-                
-                anchor = ws.cell(row=r, column=excel_start)
-                
-                # Display content (avoid duplicates)
-                unique_entries = []
-                seen_entry_ids = set()
-                for ent in cell_entries:
-                    if ent['entry_id'] not in seen_entry_ids:
-                        unique_entries.append(ent)
-                        seen_entry_ids.add(ent['entry_id'])
-                
-                # Format display text - only show unique entries
-                display_lines = []
-                tooltip_lines = []
-                
-                for ent in unique_entries:
-                    display_line = f"{ent['course']} — {ent['teacher']}"
-                    display_lines.append(display_line)
-                    
-                    # Simplified tooltip
-                    tooltip_text = (
-                        f"درس: {ent['course']}\n"
-                        f"استاد: {ent['teacher']}\n"
-                        f"کد: {ent['code']}\n"
-                        f"واحد: {ent['unit_th']}(ن) + {ent['unit_pr']}(ع)\n"
-                        f"ثبت‌نام: {ent['reg']}\n"
-                        f"ساعت: {ent['M']} - {ent['N']}"
-                    )
-                    tooltip_lines.append(tooltip_text)
-                
-                # Only show unique display lines (avoid duplicates in display)
-                unique_display_lines = list(set(display_lines))
-                anchor.value = "\n".join(unique_display_lines)
-                anchor.alignment = Alignment(wrap_text=True, horizontal="center", vertical="center")
-                
-                # Add tooltip comment with increased height
-                if tooltip_lines:
-                    try:
-                        comment_text = "\n" + "─" * 30 + "\n".join(tooltip_lines)
-                        anchor.comment = Comment(comment_text, "برنامه‌ساز")
-                        anchor.comment.width = 350
-                        anchor.comment.height = 200
-                    except Exception as e:
-                        print(f"خطا در افزودن کامنت: {e}")
-                
-                # Apply light color based on course name
-                if unique_entries:
-                    first_course = unique_entries[0]['course']
-                    color_hex = get_light_color(first_course)
-                    fill = PatternFill(start_color=color_hex, end_color=color_hex, fill_type="solid")
-                    anchor.fill = fill
-                    
-                    # Apply same fill to all merged cells
-                    for col in range(excel_start, excel_end + 1):
-                        ws.cell(row=r, column=col).fill = fill
-                
-                j = k + 1
-        
-        # Adjust column widths
-        ws.column_dimensions[get_column_letter(1)].width = 25
-        for col_idx in range(2, 2 + len(slot_labels)):
-            col_letter = get_column_letter(col_idx)
-            ws.column_dimensions[col_letter].width = 8
-        
-        # center alignment for header area
-        for row in ws.iter_rows(min_row=2, max_row=2, min_col=1, max_col=1+len(slot_labels)):
-            for c in row:
-                c.alignment = Alignment(horizontal="center", vertical="center")
+                process_btn = gr.Button(
+                    "🚀 شروع پردازش",
+                    variant="primary",
+                    size="lg"
+                )
     
-    print("در حال ذخیره فایل نهایی")
-    wb.save(final_output_file)
-    print("✅ انجام شد.")
-
-def process_file(file):
-    """Process the uploaded file and return download link"""
-    temp_phase1 = None
-    temp_final = None
-    
-    try:
-        print("🔹 Starting file processing...")
-        
-        # Create temporary files
-        with tempfile.NamedTemporaryFile(delete=False, suffix='_phase1.xlsx') as tmp1:
-            temp_phase1 = tmp1.name
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='_final.xlsx') as tmp2:
-            temp_final = tmp2.name
-        
-        print(f"🔹 Temporary files created: {temp_phase1}, {temp_final}")
-        
-        # Run phase 1
-        print("🔹 Starting Phase 1...")
-        if phase1_extract_data(file, temp_phase1):
-            print("✅ Phase 1 completed successfully")
+        with gr.Row():
+            with gr.Column(scale=1):
+                status_display = gr.Textbox(
+                    label="وضعیت",
+                    interactive=False,
+                    value="در انتظار آپلود فایل...",
+                    lines=2
+                )
             
-            # Run phase 2
-            print("🔹 Starting Phase 2...")
-            phase2_create_schedule(temp_phase1, temp_final)
-            print("✅ Phase 2 completed successfully")
-            
-            # Return the file path, not the bytes data
-            print(f"✅ Processing complete. Final file: {temp_final}")
-            return temp_final, "جدول_کلاسی_نهایی.xlsx"
-        else:
-            print("❌ Phase 1 failed")
-            return None, "خطا در پردازش فاز اول"
-            
-    except Exception as e:
-        print(f"❌ Error in process_file: {str(e)}")
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"🔍 Full traceback:\n{error_details}")
-        return None, f"خطا: {str(e)}"
-    
-    finally:
-        # Clean up temporary files (except the final one which Gradio will handle)
-        if temp_phase1 and os.path.exists(temp_phase1):
-            try:
-                os.unlink(temp_phase1)
-                print("✅ Phase 1 temp file cleaned up")
-            except Exception as e:
-                print(f"⚠️ Could not delete phase1 temp file: {e}")
-
-# Create the interface with Persian RTL layout
-with gr.Blocks(
-    title="برنامه جدول کلاسی",
-    theme=gr.themes.Soft(),
-    css="""
-    .container {
-        direction: rtl;
-        text-align: right;
-        font-family: Tahoma;
-    }
-    """
-) as demo:
-    
-    gr.Markdown("""
-    # 🎓 برنامه تولید جدول کلاسی دانشگاه
-    **نسخه 1 - آبان 1404 - نیماوزیری**
-    
-    لطفا فایل خروجی آموزشیار (CSV) را آپلود کنید
-    """)
-    
-    with gr.Row():
-        with gr.Column(scale=1):
-            file_input = gr.File(
-                label="📁 آپلود فایل",
-                file_types=[".csv", ".xlsx"],
-                type="filepath"
-            )
+                download_output = gr.File(
+                    label="📥 دانلود فایل خروجی",
+                    file_types=[".xlsx"],
+                    visible=False
+                )
             
-            process_btn = gr.Button(
-                "🚀 شروع پردازش",
-                variant="primary",
-                size="lg"
-            )
+                # ETag of the file currently offered for download
+                etag_state = gr.State(None)
     
-    with gr.Row():
-        with gr.Column(scale=1):
-            status_display = gr.Textbox(
-                label="وضعیت",
-                interactive=False,
-                value="در انتظار آپلود فایل...",
-                lines=2
-            )
+        with gr.Row():
+            with gr.Column(scale=1):
+                search_input = gr.Textbox(
+                    label="🔍 جست‌وجو در جدول (درس، استاد، کد یا مکان)",
+                    placeholder="مثلاً: فیزیک احمدی"
+                )
             
-            download_output = gr.File(
-                label="📥 دانلود فایل خروجی",
-                file_types=[".xlsx"],
-                visible=False
-            )
+                search_results = gr.Dataframe(
+                    headers=SEARCH_HEADERS,
+                    value=[],
+                    interactive=False,
+                    wrap=True
+                )
     
-    # Process function
-    def process_and_update(file):
-        if file is None:
-            return "لطفا ابتدا فایل را آپلود کنید", None
+        # Process function
+        def process_and_update(file, comment_mode, assign, last_etag):
+            if file is None:
+                return "لطفا ابتدا فایل را آپلود کنید", None, None
         
-        try:
-            file_path, filename = process_file(file)
-            if file_path and os.path.exists(file_path):
-                return "✅ پردازش با موفقیت انجام شد!", gr.update(value=file_path, label=filename, visible=True)
-            else:
-                return f"❌ {filename}", gr.update(visible=False)
+            try:
+                result, filename = convert_upload(file, comment_mode, assign, process_file_and_grid)
+                if result:
+                    data, grid = result
+                    remember_grid(file, assign, grid)
+                    etag = content_etag(data)
+                    if etag == last_etag:
+                        # same bytes as the file already offered: nothing to transfer
+                        return "✅ پردازش انجام شد؛ خروجی با فایل قبلی یکسان است.", gr.update(), etag
+                    path = save_download(data, filename, etag)
+                    short = etag.strip('"')[:12]
+                    return (f"✅ پردازش با موفقیت انجام شد! (شناسه محتوا: {short})",
+                            gr.update(value=path, label=filename, visible=True), etag)
+                else:
+                    return f"❌ {filename}", gr.update(visible=False), None
                 
-        except Exception as e:
-            error_msg = f"❌ خطا: {str(e)}"
-            print(f"Final error: {error_msg}")
-            return error_msg, gr.update(visible=False)
+            except Exception as e:
+                error_msg = f"❌ خطا: {str(e)}"
+                LOG.error("Final error: %s", error_msg)
+                return error_msg, gr.update(visible=False), None
     
-    process_btn.click(
-        fn=process_and_update,
-        inputs=file_input,
-        outputs=[status_display, download_output]
-    )
+        # Search the index of the uploaded file (built once per file, right after the conversion)
+        def search_and_show(file, assign, query):
+            if file is None or not query.strip():
+                return []
+            try:
+                return search_rows(upload_search_index(file, assign), query)
+            except Exception as e:
+                LOG.error("Search error: %s", e)
+                return []
     
-    # Add a cleanup trigger when the download is used
-    def cleanup_after_download():
-        """Clean up files after some time"""
-        import time
-        time.sleep(60)  # Wait 60 seconds before cleanup
-        cleanup_temp_files()
+        process_btn.click(
+            fn=process_and_update,
+            inputs=[file_input, comment_mode_input, assign_input, etag_state],
+            outputs=[status_display, download_output, etag_state],
+            concurrency_limit=None   # MEMORY_SCHEDULER decides how many conversions run at once
+        )
     
-    # You can trigger cleanup when new file is uploaded
-    file_input.change(
-        fn=lambda: cleanup_temp_files(),
-        inputs=None,
-        outputs=None
-    )
+        search_input.change(
+            fn=search_and_show,
+            inputs=[file_input, assign_input, search_input],
+            outputs=search_results,
+            trigger_mode="always_last",
+            concurrency_limit=None
+        )
+
+    return demo
+
+def create_app():
+    """The HTTP API under API_PREFIX with the Gradio app mounted at /
+
+    Built when called (by serve, after the command line is read), so the form
+    defaults follow --assign-rooms.
+    """
+    import gradio as gr
+    return gr.mount_gradio_app(create_api(), create_ui(), path="/")
+
+def serve(host='127.0.0.1', port=7860):
+    """Run the web app and the HTTP API until the server stops (the serve command)"""
+    import uvicorn
+    start_job_server()
+    uvicorn.run(create_app(), host=host, port=port, timeout_keep_alive=API_KEEP_ALIVE)
+    return 0
 
 if __name__ == "__main__":
-    demo.launch()
\ No newline at end of file
+    sys.exit(main() if len(sys.argv) == 1 else run_command(sys.argv[1:]))
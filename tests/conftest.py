@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import class_schedule  # noqa: E402
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """class_schedule with its templates and checkpoints under tmp_path, also for engines golden_compare loads"""
+    templates = str(tmp_path / 'templates')
+    monkeypatch.setenv(class_schedule.TEMPLATE_ENV, templates)
+    monkeypatch.setattr(class_schedule, 'TEMPLATE_DIR', templates)
+    monkeypatch.setattr(class_schedule, 'CHECKPOINT_DIR', str(tmp_path / 'checkpoints'))
+    class_schedule.configure_logging('quiet')
+    return vars(class_schedule)
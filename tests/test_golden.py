@@ -0,0 +1,27 @@
+"""Golden-output check: this version must build the same workbooks as a frozen reference version
+
+Run with `python -m pytest`. When the output changes on purpose, replace golden_reference.py
+with the class_schedule.py of the commit that changed it.
+"""
+import os
+
+import pytest
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden_reference.py')
+
+
+@pytest.mark.parametrize('rows', [300, 3000])
+def test_matches_reference(engine, tmp_path, rows):
+    path = str(tmp_path / f'synthetic_{rows}.csv')
+    engine['write_synthetic_export'](path, rows, seed=rows)
+    result, = engine['golden_compare'](REFERENCE, [path], workdir=str(tmp_path))
+    assert result['divergence'] is None, result['divergence']
+
+
+def test_tooltip_blocks_keep_fields_with_their_entry(engine):
+    first = "\n" + "─" * 30 + "درس: الف\nاستاد: یک\nکد: 1\nدرس: ب\nاستاد: دو\nکد: 2"
+    reordered = "\n" + "─" * 30 + "درس: ب\nاستاد: دو\nکد: 2\nدرس: الف\nاستاد: یک\nکد: 1"
+    swapped = "\n" + "─" * 30 + "درس: الف\nاستاد: دو\nکد: 1\nدرس: ب\nاستاد: یک\nکد: 2"
+    blocks = engine['tooltip_blocks']
+    assert blocks(first) == blocks(reordered)
+    assert blocks(first) != blocks(swapped)
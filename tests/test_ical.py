@@ -0,0 +1,20 @@
+"""iCal export: one event per session, unique UIDs"""
+import re
+
+import pandas as pd
+
+
+def _session(**fields):
+    row = {'نام درس': 'ریاضی ۱', 'نام استاد': 'استاد ۱', 'کد ارائه درس': '1001', 'مکان': 'کلاس 101',
+           'روز': 'شنبه', 'ساعت شروع': '08:00', 'ساعت پایان': '10:00'}
+    row.update(fields)
+    return row
+
+
+def test_repeated_rows_give_one_event(engine):
+    df = pd.DataFrame([_session(), _session(), _session(**{'ساعت پایان': '09:30'})], dtype=str)
+    events, keys = engine['ical_events'](df, pd.Timestamp('2024-09-21').date())
+    uids = [re.search(r'UID:(\S+)', event).group(1) for event in events]
+    assert len(events) == 2
+    assert len(set(uids)) == 2
+    assert keys['teacher'] == ['استاد ۱'] * 2 and keys['room'] == ['کلاس 101'] * 2
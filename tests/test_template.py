@@ -0,0 +1,32 @@
+"""Schedule sheets are copies of the editable template, including its images"""
+import io
+
+from openpyxl import load_workbook
+from openpyxl.drawing.image import Image
+from PIL import Image as PILImage
+
+
+def test_template_logo_on_every_sheet(engine, tmp_path, monkeypatch):
+    monkeypatch.setitem(engine, 'CHECKPOINT_ENABLED', False)
+    engine['_template_cache'].clear()
+    engine['load_template']()
+    path = engine['template_path']()
+    wb = load_workbook(path)
+    logo = io.BytesIO()
+    PILImage.new('RGB', (40, 20), (200, 30, 30)).save(logo, 'PNG')
+    image = Image(logo)
+    image.anchor = 'C1'
+    wb[engine['TEMPLATE_SHEET']].add_image(image)
+    wb.save(path)
+
+    source = str(tmp_path / 'export.csv')
+    engine['write_synthetic_export'](source, 100, seed=1)
+    for run in range(2):   # the second run reuses the cached template
+        output = str(tmp_path / f'schedule_{run}.xlsx')
+        engine['convert_export'](source, output)
+        sheets = [ws for ws in load_workbook(output).worksheets if ws.title.startswith('جدول کلاسی')]
+        assert sheets
+        for ws in sheets:
+            assert len(ws._images) == 1
+            assert ws._images[0].anchor._from.col == 2 and ws._images[0].anchor._from.row == 0
+    engine['_template_cache'].clear()